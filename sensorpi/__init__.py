@@ -12,29 +12,7 @@ Create NEW database: python3 -m sensorpi.db new
 
 
 Individual Test: python3 -m sensorpi.tests.gps_test
-'''
 
+Live samples over a socket or bluetooth rfcomm: see telemetry.py
+'''
 
-#
-########################################################
-## Bluetooth setup
-########################################################
-# '''
-# Start bluetooth DEBUG
-# '''
-# if DEBUG:
-#     print('debug:', DEBUG)
-#     try:
-#         # Load watch command for bluetooth
-#         # do this after 10 second delay from code to allow pi to finish booting.
-#         bserial = True
-#         os.system("screen -S ble -X stuff 'sudo rfcomm release rfcomm1 1 ^M' ")
-#         os.system("screen -S ble -X stuff 'sudo rfcomm watch rfcomm1 1 & ^M' ")
-#         # open('/dev/rfcomm1','w',1)
-#         # bserial.write('starting')
-#         # bserial.close()
-#         print('debug using bluetooth serial: on')
-#     except:print('no bluetooth serial')
-#
-########################################################
-########################################################
\ No newline at end of file
@@ -23,7 +23,7 @@ __email__ = "D.Ellis@leeds.ac.uk"
 __status__ = "Prototype"
 
 # Built-in/Generic Imports
-import time,sys,os,pickle, socket
+import time,sys,os, socket
 from datetime import date,datetime
 from re import sub
 
@@ -37,6 +37,17 @@ from re import sub
 CSV = False
 CONTINUOUS = False
 DHT_module = False
+DB_PROFILE = 'sd' # sqlite storage profile, see storage.py
+PARTITION = 'day' # serverpi archive files per 'day' or 'week'
+RETENTION = 30    # partitions kept on the serverpi after upload
+OPC_EXTRA = []    # further OPCs as (name, spi bus, spi device), e.g. [('b',0,1)]; each is SERIAL-name in the db
+R1_FRAMES = True  # read histograms as checksum verified frames, see r1frame.py
+INGEST = None     # (host, port) of the serverpi ingest service, see ingest.py; None uses upload.sync
+WATCHDOG = True   # re-initialise a hung OPC or GPS, see watchdog.py
+TELEMETRY = None  # stream samples live to 'unix:/run/sensorpi.sock', 'tcp::8766' or 'rfcomm:/dev/rfcomm1', see telemetry.py
+TELEMETRY_LOC = False # include the (encrypted) LOC in telemetry frames
+WARM_STANDBY = True # keep the OPC running between cycles, powering down only for SCHOOL and NIGHT, see dutycycle.py
+HW_WATCHDOG = None # '/dev/watchdog' (dtparam=watchdog=on) to reset the Pi if the process wedges
 
 hostname = socket.gethostname()
 hostname = hostname.upper().lower()
@@ -45,6 +56,10 @@ if not "bbsensor" in hostname:   # For static sensor or serverpi, force continuo
 
 # how long do we wait before polling a histogram (s)
 SAMPLING_DELAY = 5
+# portable sensors: vary the delay with PM spikes and movement, see adaptive.py
+ADAPTIVE = True
+SAMPLING_DELAY_min = 2
+SAMPLING_DELAY_max = 15
 
 ### hours (not inclusive)
 NIGHT = [18,7]  # stop 07 - 6:59
@@ -97,12 +112,25 @@ from .SensorMod.gps.geolocate import lat,lon,alt
 loc = {'gpstime':datetime.utcnow().strftime("%H%M%S"),'lat':lat,'lon':lon,'alt':alt}
 
 # Exec modules
+from .clock import clock
+from . import loop
+from . import supervisor
+from .cyclebuffer import CycleBuffer
+results = CycleBuffer(SAMPLE_LENGTH_slow//SAMPLING_DELAY + 8) # reused every cycle
 from .SensorMod.exitcondition import GPIO
 from .SensorMod import power
 from .crypt import scramble
 if not CSV:
     from .SensorMod import db
     from .SensorMod.db import builddb, __RDIR__
+    from . import storage
+    log.info('DB journal mode = %s'%storage.tune(db.conn,DB_PROFILE))
+    meter = storage.WriteMeter(__RDIR__, DB_PROFILE, os.path.join(__RDIR__,'.storage.json'))
+    if TYPE == 3:
+        from .partition import Partitions
+        partitions = Partitions(os.path.join(__RDIR__,'partitions'), PARTITION, DB_PROFILE)
+        from .coverage import Coverage
+        coverage = Coverage(os.path.join(__RDIR__,'coverage.db'))
 else:
     log.critical('WRITING CSV ONLY')
     from .SensorMod.db import __RDIR__
@@ -118,19 +146,47 @@ from .SensorMod import R1
 ########################################################
 ##  Setup
 ########################################################
-gpsdaemon = gps.init(wait=False)
-if not gpsdaemon and "bbsensor" in hostname:
+from .gpsbuffer import FixBuffer, follow, NOFIX, Receiver
+receiver = Receiver(gps)
+fixes = FixBuffer()
+follow(fixes, gps)
+if not receiver.daemon and "bbsensor" in hostname:
     log.warning('NO GPS FOUND!')
     if OLED_module : oled.standby(message = "   -- NO GLONASS --   ")
 
 try:
    alpha = R1.alpha
+   if R1_FRAMES:
+       from .r1frame import R1Frame
+       alpha = R1Frame(R1.alpha)
    log.info ("OPC found. Proceeding")
    OPC = True
 except:
     OPC: False
     log.warning ("OPC library could not be imported")
 
+rate = None
+if ADAPTIVE and "bbsensor" in hostname:
+    from .adaptive import RateController
+    rate = RateController(SAMPLING_DELAY_min, SAMPLING_DELAY_max, SAMPLING_DELAY, fixes, os.path.join(__RDIR__,'rates.csv'))
+
+instruments = []
+if OPC and OPC_EXTRA:
+    from . import multiopc
+    instruments = [multiopc.Instrument('a', alpha)]
+    for name,bus,device in OPC_EXTRA:
+        try:
+            extra = multiopc.spi_opc(bus,device)
+            if R1_FRAMES: extra = R1Frame(extra)
+            instruments.append(multiopc.Instrument(name, extra, multiopc.serial(SERIAL, name)))
+            log.info('OPC {} found on spi{}.{}'.format(name,bus,device))
+        except Exception as e:
+            log.warning('OPC {} on spi{}.{} not available - {}'.format(name,bus,device,e))
+    if WARM_STANDBY: log.warning('WARM_STANDBY is not used with OPC_EXTRA: the OPCs are powered off between cycles')
+elif OPC and WARM_STANDBY:
+    from .dutycycle import DutyCycle
+    alpha = DutyCycle(alpha, clock)
+
 if not OPC:
     if "bbsensor" in hostname or "bbstatic" in hostname:
         log.warning("No OPC present. Stopping program")
@@ -148,12 +204,44 @@ def interrupt(channel):
 
 GPIO.add_event_detect(21, GPIO.RISING, callback=interrupt, bouncetime=300)
 
+# kill -USR1 or a .profile file profiles the next cycles, see profiling.py
+from . import profiling
+profiler = profiling.Profiler(os.path.join(__RDIR__,'.profile'))
+
+# live samples for local subscribers, see telemetry.py
+telemetry = None
+if TELEMETRY:
+    from .telemetry import Publisher
+    try:
+        telemetry = Publisher(TELEMETRY, SERIAL, loc=TELEMETRY_LOC)
+    except (IOError, OSError, ValueError) as e:
+        log.warning('Telemetry on {} not available - {}'.format(TELEMETRY, e))
+
+# heartbeats from each stage; a stalled device is re-initialised, see watchdog.py
+from .watchdog import Watchdog
+watchdog = Watchdog(os.path.join(__RDIR__,'watchdog.csv'), HW_WATCHDOG)
+
+def reinit_opc(opc):
+    getattr(opc,'standby',opc.off)()
+    clock.sleep(2)
+    opc.on()
+
+watchdog.watch('sampler', max(60, 4*SAMPLING_DELAY_max), lambda: reinit_opc(alpha))
+for inst in instruments: # with OPC_EXTRA each OPC has a stage of its own, see multiopc
+    watchdog.watch(inst.stage, max(60, 4*SAMPLING_DELAY_max), lambda inst=inst: reinit_opc(inst.alpha))
+watchdog.watch('writer', 120)
+watchdog.watch('gps', 600, receiver.reinit, lambda: str(getattr(gps,'last',None)), restart=False)
+watchdog.watch('uploader', 1800)
+if WATCHDOG: watchdog.start()
+receiver.watchdog = watchdog
+if receiver.daemon and CONTINUOUS: watchdog.arm('gps')
+
 log.info('########################################################')
 log.info('starting {}'.format(datetime.now()))
 log.info('########################################################')
 
 
-if OPC: R1.clean(alpha)
+if OPC: R1.clean(R1.alpha)
 
 while loading.isAlive():
     log.debug('stopping loading blink ...')
@@ -200,12 +288,54 @@ else:
 ## Main Loop
 ########################################################
 
+def measurement(pm, now):
+    '''
+    Build a MEASUREMENTS row from a histogram read at now (utc datetime).
+    Returns None for an empty histogram. Also called from the multiopc threads.
+    '''
+    if float(pm['PM1'])+float(pm['PM10'])  <= 0: return None
+
+    if DHT_module: rh,temp = DHT.read()
+    else:
+        temp = pm['Temperature']
+        rh   = pm[  'Humidity' ]
+
+
+    # position at the middle of the histogram's sampling period
+    mid = clock.time() - float(pm['Sampling Period'])/2.
+    if fixes.count: loc = fixes.at(mid)
+    elif receiver.daemon : loc = dict(NOFIX, **gps.last)
+    else:
+        if "bbsensor" in hostname: loc = dict(NOFIX)
+        else: loc = dict(NOFIX, gpstime=now.strftime("%H%M%S"), lat=lat, lon=lon, alt=alt)
+
+    unixtime = int(now.strftime("%s")) # to the second
+
+    # pickled on the way to the db
+    if hasattr(pm,'bins'): bins = [float(b) for b in pm.bins]
+    else: bins = [float(pm['Bin %s'%i]) for i in range(16)]
+
+    row = [SERIAL,
+            TYPE,
+            loc['gpstime'][:6],
+            scramble(('%(lat)s_%(lon)s_%(alt)s_%(age)s_%(fix)s_%(nsat)s'%loc).encode('utf-8')),
+            float(pm['PM1']),
+            float(pm['PM2.5']),
+            float(pm['PM10']),
+            float(temp),
+            float(rh),
+            bins,
+            float(pm['Sampling Period']),
+            int(pm['Reject count glitch']),
+            unixtime,]
+    return row
+
 def runcycle(SAMPLE_LENGTH):
     '''
     # data = {'SERIAL':SERIAL,
     #         'TYPE':TYPE,
     #         'TIME':now.strftime("%H%M%S"),
-    #         'LOC' :scramble(('%s_%s_%s'%(lat,lon,alt)).encode('utf-8')),
+    #         'LOC' :scramble(('%s_%s_%s_%s_%s_%s'%(lat,lon,alt,age,fix,nsat)).encode('utf-8')),
     #         'PM1' :float(pm['PM1']),
     #         'PM3' :float(pm['PM2.5']),
     #         'PM10':float(pm['PM10']),
@@ -220,67 +350,29 @@ def runcycle(SAMPLE_LENGTH):
 
     #(SERIAL,TYPE,d["TIME"],d["LOC"],d["PM1"],d["PM3"],d["PM10"],d["SP"],d["RC"],)
     '''
-    global SAMPLING_DELAY
-
-    results = []
-
-    alpha.on()
-    time.sleep(1)
-    start = time.time()
-    alpha.pm() # remove first value
-    while time.time()-start < SAMPLE_LENGTH:
-        now = datetime.utcnow()
-
-        # sampling delay
-        time.sleep(SAMPLING_DELAY) # keep as 1
-
-        pm = alpha.histogram()
-        #print(pm)
-        if float(pm['PM1'])+float(pm['PM10'])  > 0:  #if there are results.
-
-            if DHT_module: rh,temp = DHT.read()
-            else:
-                temp = pm['Temperature']
-                rh   = pm[  'Humidity' ]
+    show = None
+    if OLED_module:
+        show = lambda row: oled.updatedata(str(clock.utcnow()).split('.')[0],row)
 
+    def sampled(pm, now):
+        watchdog.beat('sampler')
+        row = measurement(pm, now)
+        if telemetry and row: telemetry.publish(row)
+        return row
 
-            if gpsdaemon : loc = gps.last.copy()
-            else:
-                if "bbsensor" in hostname: loc = dict(zip('gpstime lat lon alt'.split(),['000000','','','']))
-                else: loc = {'gpstime':now.strftime("%H%M%S"),'lat':lat,'lon':lon,'alt':alt}
-
-            unixtime = int(now.strftime("%s")) # to the second
-
-            bins = pickle.dumps([float(pm['Bin %s'%i]) for i in range(16)])
-
-            results.append( [SERIAL,
-                             TYPE,
-                             loc['gpstime'][:6],
-                             scramble(('%(lat)s_%(lon)s_%(alt)s'%loc).encode('utf-8')),
-                             float(pm['PM1']),
-                             float(pm['PM2.5']),
-                             float(pm['PM10']),
-                             float(temp),
-                             float(rh),
-                             bins,
-                             float(pm['Sampling Period']),
-                             int(pm['Reject count glitch']),
-                             unixtime,] )
-
+    results.reset()
+    return loop.runcycle(alpha, SAMPLE_LENGTH, SAMPLING_DELAY, sampled, clock, lambda: STOP, show, results, rate)
 
-            if OLED_module:
-                now = str(datetime.utcnow()).split('.')[0]
-                oled.updatedata(now,results[-1])
 
-        if STOP:
-            alpha.off()
-            time.sleep(1)
-            break
-
-
-    alpha.off()
-    time.sleep(1)# Let the rpi turn off the fan
-    return results
+def write(d):
+    '''
+    Store a CycleBuffer of rows and account for the bytes it cost.
+    '''
+    with watchdog.stage('writer'):
+        storage.insert(db.conn, d.rows())
+        if TYPE == 3 and len(d): coverage.add(d.header[0], d.column('UNIXTIME').tolist()) # the OPC's SERIAL, see multiopc
+    per_row = meter.record(len(d), TYPE)
+    if per_row: log.debug('{:.0f} bytes written per row'.format(per_row))
 
 
 ########################################################
@@ -291,20 +383,29 @@ def rebuilddb(DATE):
 
     global LAST_SAVE
 
-    cursor=db.conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    table_list=[]
-    for table_item in cursor.fetchall():
-        table_list.append(table_item[0])
+    if TYPE == 3:
+        # serverpi keeps its history as partition files, see partition.py
+        coverage.scan(db.conn) # rows that arrived through upload.sync
+        partitions.rollover(db.conn)
 
-    for table_name in table_list:
-        log.debug('Dropping table : {}'.format(table_name))
-        db.conn.execute('DROP TABLE IF EXISTS ' + table_name)
+    else:
+        cursor=db.conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        table_list=[]
+        for table_item in cursor.fetchall():
+            table_list.append(table_item[0])
 
-    log.debug('rebuilding db')
-    builddb.builddb(db.conn)
+        for table_name in table_list:
+            log.debug('Dropping table : {}'.format(table_name))
+            db.conn.execute('DROP TABLE IF EXISTS ' + table_name)
 
-    log.info('Staging complete {} {}'.format(DATE, datetime.utcnow().strftime("%X")))
+        log.debug('rebuilding db')
+        builddb.builddb(db.conn)
+        storage.tune(db.conn, DB_PROFILE, rebuild=True) # the empty db takes the profile's page size
+
+    storage.checkpoint(db.conn,'TRUNCATE')
+
+    log.info('Staging complete {} {}'.format(DATE, clock.utcnow().strftime("%X")))
 
     with open (os.path.join(__RDIR__,'.uploads'),'r') as f:
         lines=f.readlines()
@@ -328,7 +429,12 @@ def upload_to_server(DATE):
             loading = power.blink_nonblock_inf_update()
             ## SYNC
             try:
-                upload_success = upload.sync(SERIAL,db.conn)
+                with watchdog.stage('uploader'):
+                    if INGEST:
+                        from . import ingest
+                        upload_success = ingest.push(SERIAL,db.conn,*INGEST,reportdir=os.path.join(__RDIR__,'profiles'))
+                    else:
+                        upload_success = upload.sync(SERIAL,db.conn)
             except Exception as e:
                 log.error("Error in attempting staging upload to serverpi - {}".format(e))
                 upload_success = False
@@ -401,7 +507,8 @@ def upload_to_external(DATE):
             #check if connected to wifi
             ## SYNC
             try:
-                upload_success = upload.upload()
+                with watchdog.stage('uploader'):
+                    upload_success = upload.upload()
             except Exception as e:
                 log.error("Error in trying to upload data to external storage")
                 log.error("Error message : {}".format(e))
@@ -418,6 +525,10 @@ def upload_to_external(DATE):
 
                 LAST_UPLOAD = DATE
 
+                if TYPE == 3:
+                    partitions.mark_uploaded()
+                    partitions.expire(RETENTION)
+
             else:
                 log.debug('Upload failed on {}, hour = {}'.format(DATE, hour))
 
@@ -438,147 +549,71 @@ MAIN
 ## Run Loop
 ########################################################
 
-SAMPLE_LENGTH=300 # initial sample set is only 10 seconds for db save debugging purposes. This then gets autoupdated within the relevant sections.
-
-while True:
-    #update less frequenty in loop
-    # DATE = date.today().strftime("%d/%m/%Y")
-
-
-
-    if SAMPLE_LENGTH>0:
-        #alpha.on()
-        #time.sleep(3)
-        power.ledoff()
-
-        ## run cycle
-        if OPC:
+def cycle(SAMPLE_LENGTH):
+    '''
+    One sampling cycle, written to the db (or csv).
+    '''
+    #alpha.on()
+    #time.sleep(3)
+    power.ledoff()
+    profiler.begin()
+
+    ## run cycle
+    if OPC and len(instruments) > 1 and not CSV:
+        if OLED_module: oled.standby(message = "   --  multi opc  --   ")
+        n = multiopc.run(instruments, SAMPLE_LENGTH, SAMPLING_DELAY, measurement, write, lambda: STOP, clock, watchdog,
+                         telemetry and telemetry.publish)
+        log.info('DB saved {} rows at {}'.format(n, clock.utcnow().strftime("%X")))
+
+    elif OPC:
+        with watchdog.stage('sampler'):
             d = runcycle(SAMPLE_LENGTH)
 
-            ''' add to db'''
-            if not CSV:
-                if OLED_module: oled.standby(message = "   --  write db  --   ")
-                db.conn.executemany("INSERT INTO MEASUREMENTS (SERIAL,TYPE,TIME,LOC,PM1,PM3,PM10,T,RH,BINS,SP,RC,UNIXTIME) \
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", d );
-                db.conn.commit() # dont forget to commit!
-                log.info('DB saved at {}'.format(datetime.utcnow().strftime("%X")))
-            else:
-                if OLED_module: oled.standby(message = "   --  write csv  --   ")
-                DataFrame(d,columns=columns).to_csv(CSVfile,mode='a')
-                log.info('CSV saved at {}'.format(datetime.utcnow().strftime("%X")))
-
-            #if DEBUG:
-                # if bserial : os.system("screen -S ble -X stuff 'sudo echo \"%s\" > /dev/rfcomm1 ^M' " %'_'.join([str(i) for i in d[-1]]))
-
-        power.ledon()
-
-    if STOP:
-        alpha.off()
-        time.sleep(1)
-        break
-
-
-    hour = datetime.now().hour
-
-    if CSV:
-        log.debug('CSV - skipping conditionals')
-
-    elif CONTINUOUS:
-        log.debug('continuous running')
-
-        if (hour > SCHOOL[0]) and (hour < SCHOOL[1]):
-
-            if OPC: alpha.off()
-            time.sleep(1)
-
-            DATE = date.today().strftime("%d/%m/%Y")
-
-            log.debug('@ School, hour={}'.format(hour))
-            ''' at school - try upload'''
-            ''' rfkill block wifi; to turn it on, rfkill unblock wifi. For Bluetooth, rfkill block bluetooth and rfkill unblock bluetooth.'''
-
-            if TYPE == 3:
-
-                stagedata(DATE)
-
-            else:
-
-                upload_to_server(DATE)
-
-                update(DATE)
-
+        ''' add to db'''
+        if not CSV:
+            if OLED_module: oled.standby(message = "   --  write db  --   ")
+            write(d)
+            log.info('DB saved at {}'.format(clock.utcnow().strftime("%X")))
         else:
+            if OLED_module: oled.standby(message = "   --  write csv  --   ")
+            DataFrame(list(d.rows(copy=True)),columns=columns).to_csv(CSVfile,mode='a')
+            log.info('CSV saved at {}'.format(clock.utcnow().strftime("%X")))
 
-            if OPC: alpha.off()
-            time.sleep(1)
-
-            DATE = date.today().strftime("%d/%m/%Y")
-
-            if TYPE == 3:
-
-                 upload_to_external(DATE)
-
-                 update(DATE)
-
-    else:
-        if (hour > NIGHT[0]) or (hour < NIGHT[1]): #>18 | <7
-
-            if OPC: alpha.off()
-            time.sleep(1)
-
-            ''' hometime - SLEEP '''
-            log.debug('NightSleep, hour={}'.format(hour))
-            if gpsdaemon and gpsdaemon.is_alive() == True: gps.stop_event.set() #stop gps
-            power.ledon()
-            SAMPLE_LENGTH = -1 # Dont run !  SAMPLE_LENGTH_slow
-            if OLED_module: oled.standby()
-            time.sleep(30*60) # sleep 0.5h
-            TYPE = 4
+    report = profiler.end()
+    if report: profiling.store(os.path.join(__RDIR__,'profiles'), SERIAL, report)
 
-        elif (hour > SCHOOL[0]) and (hour < SCHOOL[1]): # >7 <9 & >15 <18 utc (9-15)
+    power.ledon()
 
-            if OPC: alpha.off()
-            time.sleep(1)
+def idle():
+    if OPC: alpha.off()
+    if not (OPC and getattr(alpha,'warm',False)): clock.sleep(1)
 
-            DATE = date.today().strftime("%d/%m/%Y")
+def standby():
+    if OPC and hasattr(alpha,'standby'): alpha.standby() # a long idle window
+    power.ledon()
+    if OLED_module: oled.standby()
 
-            log.debug('@ School, hour={}'.format(hour))
-            ''' at school - try upload'''
-            ''' rfkill block wifi; to turn it on, rfkill unblock wifi. For Bluetooth, rfkill block bluetooth and rfkill unblock bluetooth.'''
+def checkpoint():
+    if not CSV: storage.checkpoint(db.conn)
 
-            if gpsdaemon and gpsdaemon.is_alive() == True: gps.stop_event.set() #stop gps
+def mode(name):
+    log.debug('{}, hour={}'.format(name,hour))
 
-            upload_to_server(DATE)
+def gps_stop():
+    receiver.stop()
 
-            update(DATE)
+def gps_start():
+    receiver.start()
 
-            SAMPLE_LENGTH = SAMPLE_LENGTH_slow
 
-            # sleep for 18 minutes - check break statement every minute
-
-
-            if OLED_module: oled.standby()
-            # check if we are trying to stop the device every minute
-            for i in range(14):
-                time.sleep(60) #5 sets of 5 min
-                if STOP:break
-
-            TYPE = 4
-
-        else:
-
-            if OPC: alpha.off()
-            time.sleep(1)
-
-            log.debug('en route - FASTSAMPLE, hour={}'.format(hour))
-
-            if gpsdaemon: log.debug('GPS alive = {}'.format(gpsdaemon.is_alive()))
+SAMPLE_LENGTH=300 # initial sample set is only 10 seconds for db save debugging purposes. This then gets autoupdated within the relevant sections.
+hour = clock.now().hour
 
-            if gpsdaemon and gpsdaemon.is_alive() == False:
-                gpsdaemon = gps.init(wait=False)
+# when restarted by the supervisor after an update, log how long we were down
+if supervisor.supervised(): supervisor.resumed(__RDIR__)
 
-            SAMPLE_LENGTH = SAMPLE_LENGTH_fast
-            TYPE = 2
+# the schedule state machine reads and sets this module's globals
+loop.run(sys.modules[__name__], clock)
 
 
 ########################################################
@@ -586,12 +621,25 @@ while True:
 
 
 log.info('exiting - STOP: %s'%STOP)
+watchdog.stop()
+log.info('watchdog: %s'%watchdog.metrics())
+if telemetry:
+    log.info('telemetry: %s'%telemetry.metrics())
+    telemetry.close()
+if OPC and hasattr(alpha,'standby'):
+    alpha.standby()
+    log.info('duty cycle: %s'%alpha.metrics())
 if not CSV:
     db.conn.commit()
+    storage.checkpoint(db.conn,'TRUNCATE') # hand over an empty journal
     db.conn.close()
 power.ledon()
 if OLED_module: oled.shutdown()
 if not (os.system("git status --branch --porcelain | grep -q behind")):
     now = datetime.utcnow().strftime("%F %X")
+    if supervisor.supervised():
+        log.critical('Updates available. Restarting through the supervisor at %s'%now)
+        supervisor.handover(__RDIR__)
+        sys.exit(supervisor.EXIT_UPDATE)
     log.critical('Updates available. We need to reboot. Shutting down at %s'%now)
     os.system("sudo reboot")
@@ -0,0 +1,134 @@
+'''
+Event driven sampling rate for portable sensors.
+
+RateController sets the delay between histograms (SAMPLING_DELAY) from the
+data as it streams in. A PM spike (PM2.5 well above its running mean) or
+movement (GPS speed) drops the delay straight to the minimum; once
+conditions have been steady for HOLD samples it backs off step by step to
+the maximum. A "spike" lasting over SPIKE_MAX seconds is a new level (the
+sensor was carried indoors, or the air changed) and becomes the baseline.
+Spike and movement each have separate on/off thresholds so the rate does
+not flap.
+
+Every change is logged and appended to rates.csv in __RDIR__
+(unixtime,delay,reason) so the effective sampling can be reconstructed;
+each row's SP column also holds the period the OPC actually integrated over.
+
+Test: python3 -m sensorpi.tests adaptive
+'''
+
+import os,math
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+ALPHA = .05        # weight of each sample in the running PM mean/variance
+Z_ON,Z_OFF = 3.,1.5  # spike enters/leaves at this many std above the mean
+SPIKE_MIN = 2.     # ug/m3 - ignore spikes smaller than this
+SPIKE_MAX = 600.   # s - a spike lasting longer than this is a new baseline
+V_ON,V_OFF = 1.,.5 # m/s - moving enters/leaves at these speeds
+SPEED_WINDOW = 10. # s of GPS track used for the speed
+HOLD = 6           # steady samples before backing off
+BACKOFF = 1.5      # delay multiplier per back off step
+
+
+def distance(a, b):
+    ''' metres between two fixes (equirectangular, fine over a few seconds) '''
+    lat = math.radians((float(a['lat'])+float(b['lat']))/2.)
+    dy = math.radians(float(b['lat'])-float(a['lat']))
+    dx = math.radians(float(b['lon'])-float(a['lon']))*math.cos(lat)
+    return 6371000.*math.hypot(dx,dy)
+
+
+def speed(fixes, t, window=SPEED_WINDOW):
+    '''
+    Speed in m/s over the window ending at t from a gpsbuffer.FixBuffer,
+    or None without two recent real fixes.
+    '''
+    a,b = fixes.at(t-window),fixes.at(t)
+    if a['age'] == '' or b['age'] == '' or a['age'] > window or b['age'] > window: return None
+    try:
+        return distance(a,b)/window
+    except (ValueError,KeyError):
+        return None
+
+
+class RateController(object):
+
+    def __init__(self, fast, slow, start=None, fixes=None, logfile=None):
+        self.fast = fast
+        self.slow = slow
+        self.delay = start if start is not None else slow
+        self.fixes = fixes
+        self.logfile = logfile
+        self.mean = None
+        self.var = 0.
+        self.spike = False
+        self.since = None  # when the spike began
+        self.moving = False
+        self.calm = 0
+        self.changes = 0
+
+    def pm_event(self, pm25, t):
+        '''
+        Update the running PM2.5 statistics; True while in a spike.
+        The statistics are frozen during a spike so it does not become the
+        baseline, for at most SPIKE_MAX seconds: then the baseline restarts
+        at the current level.
+        '''
+        if self.mean is None:
+            self.mean = pm25
+            return False
+        excess = pm25 - self.mean
+        z = excess/math.sqrt(self.var) if self.var > 0 else 0.
+        if self.spike:
+            self.spike = z > Z_OFF
+            if self.spike and t - self.since > SPIKE_MAX:
+                log.info('PM2.5 at {:.1f} for {:.0f} s, taking it as the baseline'.format(pm25, t - self.since))
+                self.mean = pm25
+                self.spike = False
+                return False
+        else:
+            self.spike = z > Z_ON and excess > SPIKE_MIN
+            if self.spike: self.since = t
+        if not self.spike:
+            self.mean += ALPHA*excess
+            self.var = (1-ALPHA)*(self.var + ALPHA*excess*excess)
+        return self.spike
+
+    def move_event(self, t):
+        if self.fixes is None: return False
+        v = speed(self.fixes, t)
+        if v is None: return self.moving
+        self.moving = v > (V_OFF if self.moving else V_ON)
+        return self.moving
+
+    def update(self, pm, t):
+        '''
+        Call with each histogram and its unix time. Returns the delay to
+        use before the next histogram.
+        '''
+        spike = self.pm_event(float(pm['PM2.5']), t)
+        moving = self.move_event(t)
+
+        if spike or moving:
+            self.calm = 0
+            self.set(self.fast, t, 'spike' if spike else 'moving')
+        else:
+            self.calm += 1
+            if self.calm >= HOLD and self.delay < self.slow:
+                self.calm = 0
+                self.set(min(self.delay*BACKOFF, self.slow), t, 'steady')
+        return self.delay
+
+    def set(self, delay, t, reason):
+        delay = round(delay,1)
+        if delay == self.delay: return
+        log.info('sampling delay {} -> {} s ({})'.format(self.delay, delay, reason))
+        self.delay = delay
+        self.changes += 1
+        if self.logfile:
+            new = not os.path.exists(self.logfile)
+            with open(self.logfile,'a') as f:
+                if new: f.write('unixtime,delay,reason\n')
+                f.write('%d,%s,%s\n'%(t,delay,reason))
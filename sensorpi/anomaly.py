@@ -0,0 +1,229 @@
+'''
+Fleet drift and anomaly detection.
+
+A degrading laser or a clogged inlet shows as a sensor reading away from
+the sensors around it, and from its own past, well before it fails. For
+every day each SERIAL is compared with the fleet at the same time:
+
+    level    median over the day's hours of its mean log(1+PM3) less the
+             fleet median for that hour: among the sensors at school while
+             it was at school (co-located), the whole fleet otherwise
+    shape    Hellinger distance of its day's bin count distribution from
+             the fleet median distribution
+    history  its level against the median of its own last HISTORY days
+
+Each becomes a robust z score (median and MAD across the fleet, or across
+its own history), computed with NumPy over all sensors at once. Scores
+beyond Z are written as alerts to anomaly.db, ranked by score, so visits
+go to the boxes that need them. Days are only recomputed when their
+partition changes (partition.Days, as in exposure.py), oldest first so
+history is there; a recomputed day also recomputes the HISTORY days after
+it, whose history scores it is part of.
+
+Usage: python3 -m sensorpi.anomaly [--json] [FROM [TO]]    (YYYY-MM-DD, default the last week)
+'''
+
+import os,sys,json,pickle,sqlite3,warnings
+import numpy as np
+
+from .SensorMod.log_manager import getlog
+from .exposure import environment, SCHOOL
+from .partition import Days
+log = getlog(__name__)
+
+DAY = 86400
+Z = 3.5            # robust z beyond which a sensor is flagged
+MIN_PEERS = 3      # sensors needed for a fleet median
+MIN_HOURS = 3      # hours compared for a level
+MIN_COUNTS = 1000  # particles counted for a bin shape
+HISTORY = 14       # days of a sensor's own past compared with
+MIN_HISTORY = 5
+MIN_SCALE = .05    # floor on the spread of levels (log units, about 5%)
+MIN_SHAPE = .01    # and of Hellinger distances
+
+
+def robust_z(x, floor, centre=None):
+    ''' (x - median)/(1.4826 MAD) of the finite values; NaN with too few '''
+    x = np.asarray(x, float)
+    ok = np.isfinite(x)
+    if ok.sum() < MIN_PEERS: return np.full(x.shape, np.nan)
+    med = np.median(x[ok]) if centre is None else centre
+    scale = max(1.4826*np.median(np.abs(x[ok] - med)), floor)
+    return (x - med)/scale
+
+
+def nanmedian(a, axis):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all NaN slices
+        return np.nanmedian(a, axis=axis)
+
+
+def hourly(sensor, hour, school, value, n):
+    ''' mean log(1+value) per sensor, hour and (not) at school: (n, 24, 2), NaN where empty '''
+    ok = np.isfinite(value) & (value >= 0)
+    flat = ((sensor*24 + hour)*2 + school)[ok]
+    count = np.bincount(flat, minlength=n*48)
+    total = np.bincount(flat, np.log1p(value[ok]), minlength=n*48)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+    mean[count == 0] = np.nan
+    return mean.reshape(n, 24, 2)
+
+
+def levels(cells):
+    '''
+    Median deviation of each sensor from the fleet median of the cells
+    it shares with at least MIN_PEERS sensors, and the cells compared.
+    '''
+    n = len(cells)
+    fleet = nanmedian(cells, 0)
+    d = cells - fleet
+    d[:, np.isfinite(cells).sum(axis=0) < MIN_PEERS] = np.nan
+    d = d.reshape(n, -1)
+    hours = np.isfinite(d).sum(axis=1)
+    level = nanmedian(d, 1)
+    level[hours < MIN_HOURS] = np.nan
+    return level, hours
+
+
+def shapes(sensor, bins, n):
+    ''' each sensor's share of the day's counts per bin: (n, 16), NaN rows with too few counts '''
+    totals = np.stack([np.bincount(sensor, bins[:,k], n) for k in range(bins.shape[1])], axis=1)
+    count = totals.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = totals/count[:,None]
+    share[count < MIN_COUNTS] = np.nan
+    return share
+
+
+def hellinger(p, q):
+    return np.sqrt(.5*np.sum((np.sqrt(p) - np.sqrt(q))**2, axis=-1))
+
+
+def analyse(rows, school=SCHOOL):
+    '''
+    One day's rows (SERIAL, TYPE, UNIXTIME, PM3, BINS) compared across the
+    fleet: {serial: (rows, level, hours, shape distance, z level, z shape)}.
+    '''
+    if not rows: return {}
+    names,sensor = np.unique(np.array([r[0] for r in rows]), return_inverse=True)
+    n = len(names)
+    TYPE = np.array([r[1] or 0 for r in rows])
+    t = np.array([r[2] for r in rows], np.int64)
+    pm = np.array([np.nan if r[3] is None else r[3] for r in rows], float)
+    bins = np.array([pickle.loads(r[4]) if r[4] else [0.]*16 for r in rows], float)
+
+    at_school = (environment(TYPE, t, school) == 'school').astype(np.int64)
+    level,hours = levels(hourly(sensor, (t % DAY)//3600, at_school, pm, n))
+
+    share = shapes(sensor, np.nan_to_num(bins), n)
+    fleet = nanmedian(share, 0)
+    fleet = fleet/np.nansum(fleet) if np.isfinite(fleet).all() else fleet
+    distance = hellinger(share, fleet)
+
+    z_level = robust_z(level, MIN_SCALE)
+    z_shape = robust_z(distance, MIN_SHAPE)
+    counts = np.bincount(sensor, minlength=n)
+    return dict((s,(int(counts[i]), level[i], int(hours[i]), distance[i], z_level[i], z_shape[i]))
+                for i,s in enumerate(names))
+
+
+def findings(result, z_history, past):
+    ''' (KIND, SCORE, DETAIL) for one sensor's day '''
+    rows,level,hours,distance,z_level,z_shape = result
+    out = []
+    if np.isfinite(z_level) and abs(z_level) >= Z:
+        out.append(('level', abs(z_level), 'reads %.2fx the fleet over %d h'%(np.exp(level), hours)))
+    if np.isfinite(z_shape) and z_shape >= Z:
+        out.append(('shape', z_shape, 'bin distribution %.3f from the fleet'%distance))
+    if z_history is not None and abs(z_history) >= Z:
+        out.append(('history', abs(z_history), 'reads %.2fx its last %d days'%(np.exp(level - past), HISTORY)))
+    return out
+
+
+def finite(x):
+    return None if x is None or not np.isfinite(x) else float(x)
+
+
+class Anomaly(object):
+    '''
+    Daily fleet comparison for the days held by a partition.Partitions.
+    '''
+
+    def __init__(self, path, partitions, school=SCHOOL):
+        self.partitions = partitions
+        self.school = school
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS DRIFT (DAY INT, SERIAL TEXT, ROWS INT, LEVEL REAL, \
+                HOURS INT, SHAPE REAL, Z_LEVEL REAL, Z_SHAPE REAL, Z_HISTORY REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS DRIFT_SERIAL ON DRIFT (SERIAL, DAY)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS ALERTS (DAY INT, SERIAL TEXT, KIND TEXT, \
+                SCORE REAL, DETAIL TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS ALERTS_DAY ON ALERTS (DAY, SCORE)')
+        self.days = Days(self.conn, partitions, DAY)
+
+    def compute(self, day):
+        rows = list(self.partitions.query('SELECT SERIAL,TYPE,UNIXTIME,PM3,BINS FROM MEASUREMENTS \
+            WHERE UNIXTIME >= ? AND UNIXTIME < ?', (day,day+DAY), day, day+DAY))
+        return analyse(rows, self.school)
+
+    def history(self, day, serial, level):
+        ''' (z, median) of a level against the sensor's previous HISTORY days, (None, None) with too few '''
+        past = [l for l, in self.conn.execute('SELECT LEVEL FROM DRIFT WHERE SERIAL=? AND DAY < ? AND DAY >= ? \
+            AND LEVEL IS NOT NULL', (serial, day, day - HISTORY*DAY))]
+        if len(past) < MIN_HISTORY or not np.isfinite(level): return None, None
+        median = float(np.median(past))
+        return float(robust_z(past + [level], MIN_SCALE, median)[-1]), median
+
+    def update(self, start=None, end=None):
+        '''
+        Recompute the days in [start,end) whose partition changed since
+        they were analysed, and the HISTORY days after each, oldest first.
+        Returns the days recomputed.
+        '''
+        done = []
+        for day,source in self.days.stale(start, end, HISTORY):
+            self.store(day, self.compute(day), source)
+            done.append(day)
+        if done: log.info('Fleet compared for {} days'.format(len(done)))
+        return done
+
+    def store(self, day, result, source):
+        with self.conn:
+            self.conn.execute('DELETE FROM DRIFT WHERE DAY=?', (day,))
+            self.conn.execute('DELETE FROM ALERTS WHERE DAY=?', (day,))
+            for s,r in sorted(result.items()):
+                zh,past = self.history(day, s, r[1])
+                self.conn.execute('INSERT INTO DRIFT VALUES (?,?,?,?,?,?,?,?,?)', (day, s, r[0], finite(r[1]), r[2],
+                    finite(r[3]), finite(r[4]), finite(r[5]), finite(zh)))
+                self.conn.executemany('INSERT INTO ALERTS VALUES (?,?,?,?,?)',
+                    [(day, s, kind, float(score), detail) for kind,score,detail in findings(r, zh, past)])
+            self.days.done(day, source)
+
+    def alerts(self, start, end, limit=None):
+        ''' alerts in [start,end), highest score first, as dicts '''
+        sql = 'SELECT DAY,SERIAL,KIND,SCORE,DETAIL FROM ALERTS WHERE DAY >= ? AND DAY < ? ORDER BY SCORE DESC'
+        if limit: sql += ' LIMIT %d'%int(limit)
+        names = ('day','serial','kind','score','detail')
+        return [dict(zip(names,r)) for r in self.conn.execute(sql, (start,end))]
+
+
+if __name__ == '__main__':
+    from .SensorMod.db import __RDIR__
+    from .partition import Partitions
+    from .coverage import date_range
+    from datetime import datetime
+    args = sys.argv[1:]
+    as_json = '--json' in args
+    start,end = date_range([a for a in args if a != '--json'])
+
+    anomaly = Anomaly(os.path.join(__RDIR__,'anomaly.db'), Partitions(os.path.join(__RDIR__,'partitions')))
+    anomaly.update(start, end)
+    alerts = anomaly.alerts(start, end)
+    if as_json:
+        print(json.dumps(alerts, indent=1))
+    else:
+        for a in alerts:
+            print('%s %-20s %-8s %5.1f  %s'%(datetime.utcfromtimestamp(a['day']).strftime('%Y-%m-%d'),
+                                             a['serial'], a['kind'], a['score'], a['detail']))
@@ -0,0 +1,381 @@
+'''
+Read-only HTTP data API for the serverpi.
+
+Field staff on the RaspAP hotspot can see what every sensor in the room
+is doing without SSH and readsql.py:
+
+    GET /latest                                  newest row per SERIAL
+    GET /rollup?start=&end=&step=&field=&serial= per SERIAL: slot, count, mean, max
+    GET /coverage?start=&end=                    seconds recorded per day and SERIAL
+
+start and end are unix seconds or YYYY-MM-DD (rollup defaults to the last
+day in hours, field to PM3; serial may be repeated). Add ?format=bin, or
+send Accept: application/octet-stream, for packed little endian records
+instead of JSON (see RECORDS and unpack()).
+
+Queries only use read-only connections (mode=ro): pools of them for
+server.db and coverage.db, and Partitions.query for the partitions. With
+WAL they never take a lock the ingest writer waits on. Responses are
+cached in memory against a watermark: PRAGMA data_version of server.db and
+coverage.db, which changes whenever another connection (ingest, rollover)
+commits, and the number and newest mtime of the partition files. Every
+response carries an ETag derived from its query and the watermark, so a
+client polling with If-None-Match gets a 304 from a few stats and two
+pragmas until new rows are ingested.
+
+Usage:
+    python3 -m sensorpi.api serve [port]                 (on the bbserver)
+    python3 -m sensorpi.api bench [sensors] [clients] [seconds]
+'''
+
+import os,sys,json,time,shutil,struct,queue,sqlite3,hashlib,tempfile,threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse,parse_qs
+from http.server import HTTPServer,BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from .SensorMod.log_manager import getlog
+from .partition import Partitions
+from .coverage import Coverage, parse_date
+log = getlog(__name__)
+
+PORT = 8080
+POOL = 4         # read-only connections per database
+CACHE = 256      # responses kept
+RECENT = 7*86400 # s of partitions searched for /latest
+FIELDS = ('PM1','PM3','PM10','T','RH')
+
+# binary responses: a little endian uint32 count, then count records.
+# SERIAL is its length in bytes then up to SERIAL_BYTES of it, room for
+# the Pi's 16 hex digits and the -name of an additional OPC (see multiopc)
+SERIAL_BYTES = 32
+RECORDS = {
+    'latest':   struct.Struct('<B32sIB6f'), # SERIAL, UNIXTIME, TYPE, PM1, PM3, PM10, T, RH, SP
+    'rollup':   struct.Struct('<B32sIIff'), # SERIAL, slot start, count, mean, max
+    'coverage': struct.Struct('<B32sIf'),   # SERIAL, day, seconds
+}
+COUNT = struct.Struct('<I')
+
+
+class Pool(object):
+    ''' a fixed number of connections made by factory() on first use '''
+
+    def __init__(self, factory, size=POOL):
+        self.factory = factory
+        self.free = queue.LifoQueue()
+        self.made = 0
+        self.size = size
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.free.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                make = self.made < self.size
+                if make: self.made += 1
+            try:
+                conn = self.factory() if make else self.free.get()
+            except Exception:
+                with self.lock: self.made -= 1
+                raise
+        try:
+            yield conn
+        finally:
+            self.free.put(conn)
+
+
+def readonly(path):
+    return sqlite3.connect('file:%s?mode=ro'%path, uri=True, check_same_thread=False)
+
+
+def timestamp(text, default):
+    if text is None: return default
+    return int(text) if text.isdigit() else parse_date(text)
+
+
+class Api(object):
+
+    def __init__(self, rdir, pool=POOL, cache=CACHE):
+        self.dbfile = os.path.join(rdir,'server.db')
+        self.coverfile = os.path.join(rdir,'coverage.db')
+        self.partitions = Partitions(os.path.join(rdir,'partitions'))
+        self.server = Pool(lambda: readonly(self.dbfile), pool)
+        self.coverage = Pool(lambda: Coverage(self.coverfile, readonly=True), pool)
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.size = cache
+        self.hits = self.misses = self.unchanged = 0
+        self.latest_lock = threading.Lock()
+        self.newest,self.top,self.basis = {},0,None
+
+    ## watermark
+
+    def version(self, path):
+        ''' data_version from one long lived connection per file, None if it does not exist yet '''
+        if not os.path.exists(path): return None
+        conn = self.versions.get(path)
+        if conn is None:
+            conn = self.versions[path] = readonly(path)
+        return conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def watermark(self):
+        with self.lock:
+            versions = (self.version(self.dbfile), self.version(self.coverfile))
+        # not the directory mtime: every read only open makes and removes -shm files there
+        files = [self.partitions.path(k) for k in self.partitions.keys()]
+        return versions + (len(files), max([os.stat(f).st_mtime_ns for f in files] or [0]))
+
+    ## queries
+
+    @contextmanager
+    def connection(self):
+        ''' a pooled server.db connection, None before the first ingest '''
+        if not os.path.exists(self.dbfile):
+            yield None
+            return
+        with self.server.connection() as conn:
+            yield conn
+
+    def server_rows(self, sql, params=(), start=None, end=None):
+        ''' rows from server.db and the partitions overlapping [start,end) '''
+        with self.connection() as conn:
+            if conn:
+                for row in conn.execute(sql, params): yield row
+        for row in self.partitions.query(sql, params, start, end): yield row
+
+    def latest(self, query):
+        '''
+        Kept between requests and brought up to date from the rows of
+        server.db above the last rowid seen, so a miss after an ingest
+        reads only the new rows. Rebuilt when the partitions change
+        (rollover, expiry) or server.db was emptied.
+        '''
+        sql = 'SELECT SERIAL,max(UNIXTIME),TYPE,PM1,PM3,PM10,T,RH,SP FROM MEASUREMENTS%s GROUP BY SERIAL'
+        def merge(rows):
+            for row in rows:
+                if row[0] not in self.newest or row[1] > self.newest[row[0]][1]: self.newest[row[0]] = row
+
+        with self.latest_lock:
+            mark = self.watermark()[2:]
+            top = 0
+            with self.connection() as conn:
+                if conn: top = conn.execute('SELECT max(rowid) FROM MEASUREMENTS').fetchone()[0] or 0
+                if mark != self.basis or top < self.top:
+                    self.newest,self.top,self.basis = {},0,mark
+                    merge(self.partitions.query(sql%'', (), time.time() - RECENT))
+                if conn: merge(conn.execute(sql%' WHERE rowid > ?', (self.top,)))
+            self.top = top
+            return [self.newest[s] for s in sorted(self.newest)]
+
+    def rollup(self, query):
+        end = timestamp(query.get('end',[None])[0], int(time.time()))
+        start = timestamp(query.get('start',[None])[0], end - 86400)
+        step = int(query.get('step',['3600'])[0])
+        field = query.get('field',['PM3'])[0]
+        if field not in FIELDS or step <= 0: raise ValueError('field one of %s, step > 0'%','.join(FIELDS))
+        serials = query.get('serial',[])
+        sql = 'SELECT SERIAL,(UNIXTIME/?)*? AS SLOT,count({0}),sum({0}),max({0}) FROM MEASUREMENTS \
+WHERE UNIXTIME >= ? AND UNIXTIME < ?{1} GROUP BY SERIAL,SLOT'.format(field,
+            ' AND SERIAL IN (%s)'%','.join('?'*len(serials)) if serials else '')
+        slots = {}
+        for s,slot,n,total,peak in self.server_rows(sql, [step,step,start,end]+serials, start, end):
+            if not n: continue
+            old = slots.get((s,slot))
+            if old: n,total,peak = n+old[0], total+old[1], max(peak,old[2])
+            slots[(s,slot)] = (n,total,peak)
+        return [(s,slot,n,total/n,peak) for (s,slot),(n,total,peak) in sorted(slots.items())]
+
+    def covered(self, query):
+        end = timestamp(query.get('end',[None])[0], int(time.time()))
+        start = timestamp(query.get('start',[None])[0], end - 7*86400)
+        if not os.path.exists(self.coverfile): return []
+        with self.coverage.connection() as cov:
+            days = cov.uptime(start, end)
+        return [(s,day,seconds) for day in sorted(days) for s,seconds in sorted(days[day].items())]
+
+    ENDPOINTS = {'latest':latest, 'rollup':rollup, 'coverage':covered}
+
+    ## encoding
+
+    def encode(self, kind, rows, binary):
+        if binary:
+            record = RECORDS[kind]
+            serials = [r[0].encode('ascii','replace') for r in rows]
+            for s in serials:
+                if len(s) > SERIAL_BYTES: log.warning('SERIAL {!r} truncated to {} bytes'.format(s, SERIAL_BYTES))
+            return COUNT.pack(len(rows)) + b''.join(
+                record.pack(min(len(s),255), s, *[0 if v is None else v for v in r[1:]])
+                for s,r in zip(serials,rows)), 'application/octet-stream'
+        names = {'latest':('serial','unixtime','type')+FIELDS+('sp',),
+                 'rollup':('serial','start','count','mean','max'),
+                 'coverage':('serial','day','seconds')}[kind]
+        return json.dumps([dict(zip(names,r)) for r in rows]).encode('utf-8'), 'application/json'
+
+    def get(self, path, query, binary=False, etag=None):
+        '''
+        (status, body, content type, etag). body is empty for a 304.
+        '''
+        kind = path.strip('/')
+        if kind not in self.ENDPOINTS: return 404, b'{"error": "not found"}', 'application/json', None
+        key = (kind, tuple(sorted((k,tuple(v)) for k,v in query.items() if k != 'format')), binary)
+        mark = self.watermark()
+        tag = '"%s"'%hashlib.sha1(repr((key,mark)).encode('utf-8')).hexdigest()[:20]
+        if etag == tag:
+            self.unchanged += 1
+            return 304, b'', None, tag
+
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit and hit[0] == tag:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return 200, hit[1], hit[2], tag
+
+        self.misses += 1
+        try:
+            rows = self.ENDPOINTS[kind](self, query)
+        except ValueError as e:
+            return 400, json.dumps({'error':str(e)}).encode('utf-8'), 'application/json', None
+        body,ctype = self.encode(kind, rows, binary)
+        with self.lock:
+            self.cache[key] = (tag, body, ctype)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size: self.cache.popitem(last=False)
+        return 200, body, ctype, tag
+
+
+def unpack(kind, data):
+    '''
+    client side: records of a binary response as tuples, SERIAL decoded.
+    Raises ValueError if a SERIAL was too long to send whole.
+    '''
+    record = RECORDS[kind]
+    n, = COUNT.unpack_from(data)
+    out = []
+    for i in range(n):
+        r = record.unpack_from(data, COUNT.size + i*record.size)
+        if r[0] > SERIAL_BYTES: raise ValueError('SERIAL {!r}... truncated from {} bytes'.format(r[1], r[0]))
+        out.append((r[1][:r[0]].decode('ascii'),)+r[2:])
+    return out
+
+
+########################################################
+##  HTTP
+########################################################
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        binary = query.get('format',[''])[0] == 'bin' or 'application/octet-stream' in self.headers.get('Accept','')
+        try:
+            status,body,ctype,tag = self.server.api.get(url.path, query, binary, self.headers.get('If-None-Match'))
+        except Exception as e:
+            log.error('api {} failed - {}'.format(self.path, e))
+            status,body,ctype,tag = 500, json.dumps({'error':str(e)}).encode('utf-8'), 'application/json', None
+        self.send_response(status)
+        if tag: self.send_header('ETag', tag)
+        self.send_header('Cache-Control', 'no-cache')
+        if ctype: self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('api %s'%(format%args))
+
+
+class ApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, api, host='0.0.0.0', port=PORT):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.api = api
+
+
+########################################################
+##  Load test
+########################################################
+
+def bench(sensors=30, clients=8, seconds=5.):
+    '''
+    Serve a temporary server.db while a writer ingests a row per sensor
+    every second, and poll /latest from clients threads, first with
+    If-None-Match (as a dashboard would), then without.
+    Returns {mode: requests/s, p50 and p99 ms} and the cache counters.
+    '''
+    import http.client
+    from .ingest import fake_rows, percentile
+    from .SensorMod.db import builddb
+    from . import storage
+    tmp = tempfile.mkdtemp()
+    conn = sqlite3.connect(os.path.join(tmp,'server.db'), check_same_thread=False)
+    storage.tune(conn)
+    builddb.builddb(conn)
+    start = int(time.time()) - 3600
+    for i in range(sensors): storage.insert(conn, fake_rows('sensor%02d'%i, 3600, start))
+    api = Api(tmp)
+    httpd = ApiServer(api, '127.0.0.1', 0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    stop = threading.Event()
+    def writer():
+        t = start + 3600
+        while not stop.wait(1.):
+            storage.insert(conn, [r for i in range(sensors) for r in fake_rows('sensor%02d'%i, 1, t)])
+            t += 1
+
+    def poll(conditional, times):
+        c = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+        tag = None
+        until = time.time() + seconds
+        while time.time() < until:
+            t = time.time()
+            c.request('GET', '/latest', headers={'If-None-Match':tag} if tag else {})
+            r = c.getresponse()
+            r.read()
+            if conditional: tag = r.getheader('ETag')
+            times.append(time.time() - t)
+        c.close()
+
+    w = threading.Thread(target=writer, daemon=True)
+    w.start()
+    result = {}
+    for mode,conditional in (('conditional',True), ('full',False)):
+        times = []
+        threads = [threading.Thread(target=poll, args=(conditional, times)) for i in range(clients)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        result[mode] = {'requests_per_s':len(times)/seconds, 'p50_ms':percentile(times,50)*1e3,
+                        'p99_ms':percentile(times,99)*1e3}
+    stop.set(); w.join()
+    httpd.shutdown(); httpd.server_close()
+    conn.close()
+    result.update(hits=api.hits, misses=api.misses, unchanged=api.unchanged)
+    shutil.rmtree(tmp)
+    return result
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    command = args[0] if args else 'serve'
+    if command == 'serve':
+        from .SensorMod.db import __RDIR__
+        httpd = ApiServer(Api(__RDIR__), port=int(args[1]) if len(args) > 1 else PORT)
+        log.info('api on port {}'.format(httpd.server_address[1]))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif command == 'bench':
+        result = bench(*[int(a) for a in args[1:3]], *[float(a) for a in args[3:4]])
+        for mode in ('conditional','full'):
+            print('{:12s} {requests_per_s:7.0f} req/s  p50 {p50_ms:.1f} ms  p99 {p99_ms:.1f} ms'.format(mode, **result[mode]))
+        print('cache: {hits} hits, {misses} misses, {unchanged} not modified'.format(**result))
+    else:
+        print(__doc__)
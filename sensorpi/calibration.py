@@ -0,0 +1,287 @@
+'''
+Co-location calibration of OPC-R1 sensors.
+
+Put a bbsensor next to a bbstatic or a reference instrument (its data
+loaded as rows with its own SERIAL) for a while, then fit() averages both
+onto a common STEP grid and solves, per PM field, a least squares
+correction from the sensor's PM and RH (and optionally its bin counts)
+to the reference. Each fit is stored as a new version in the CALIBRATION
+table of calibration.db, valid from a given time until the sensor's next
+version, so old data keeps the coefficients that applied to it.
+
+Raw rows are never rewritten: apply() corrects arrays when they are read,
+choosing the version for each row's time, and corrected() streams a
+fleet's corrected PM out of the partitions, caching each partition's
+result until its data or the coefficients change.
+
+Models (FEATURES):
+    linear  ref = a + b*pm
+    rh      ref = a + b*pm + c*pm*g + d*g,  g = (RH/100)^2/(1-RH/100) (hygroscopic growth)
+    bins    rh plus the fine (bins 0-3) and coarse (bins 8-15) count rates
+
+Usage: python3 -m sensorpi.calibration fit SERIAL REFERENCE FROM TO [linear|rh|bins]
+       python3 -m sensorpi.calibration list [SERIAL]
+       python3 -m sensorpi.calibration export FROM TO OUT.csv    (FROM, TO as YYYY-MM-DD)
+'''
+
+import os,sys,json,time,pickle,sqlite3
+from collections import OrderedDict
+import numpy as np
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+STEP = 60      # s - averaging grid for co-located data
+FIELDS = ('PM1','PM3','PM10')
+RHMAX = 95.    # % - growth term capped here
+MIN_POINTS = 30
+CACHE = 64     # partitions kept corrected in memory
+FEATURES = ('linear','rh','bins')
+
+
+def growth(rh):
+    rh = np.asarray(rh, float)
+    h = np.clip(np.where(np.isfinite(rh), rh, 0.), 0, RHMAX)/100.
+    return h*h/(1.-h)
+
+
+def design(features, pm, rh, fine=None, coarse=None):
+    ''' the model matrix for one PM field '''
+    cols = [np.ones_like(pm), pm]
+    if features in ('rh','bins'):
+        g = growth(rh)
+        cols += [pm*g, g]
+    if features == 'bins':
+        cols += [fine, coarse]
+    return np.column_stack(cols)
+
+
+def bin_rates(bins, sp):
+    ''' fine and coarse count rates from pickled BINS and SP '''
+    counts = np.array([pickle.loads(b) if b else [0.]*16 for b in bins], float)
+    sp = np.where(np.asarray(sp,float) > 0, sp, np.nan)
+    return counts[:,:4].sum(axis=1)/sp, counts[:,8:].sum(axis=1)/sp
+
+
+def average(t, values, step=STEP):
+    '''
+    Mean of each column of values per step-second slot of t:
+    (slots, means) with slots sorted.
+    '''
+    slot = (np.asarray(t)//step).astype(np.int64)
+    slots,index = np.unique(slot, return_inverse=True)
+    count = np.bincount(index, minlength=len(slots)).astype(float)
+    means = np.column_stack([np.bincount(index, v, len(slots))/count for v in np.asarray(values,float).T])
+    return slots, means
+
+
+def align(a, b, step=STEP):
+    '''
+    Co-located rows of two sensors, each (t, values), averaged onto a
+    common grid: (slot times, a means, b means) for slots both covered.
+    '''
+    sa,ma = average(a[0], a[1], step)
+    sb,mb = average(b[0], b[1], step)
+    both,ia,ib = np.intersect1d(sa, sb, return_indices=True)
+    return both*step, ma[ia], mb[ib]
+
+
+class Calibration(object):
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS CALIBRATION (SERIAL TEXT, VERSION INT, FIELD TEXT, \
+                VALID_FROM INT, FITTED INT, REFERENCE TEXT, FEATURES TEXT, N INT, R2 REAL, RMSE REAL, COEFFS TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS CALIBRATION_SERIAL ON CALIBRATION (SERIAL, FIELD, VALID_FROM)')
+        self.models = {}
+        self.loaded = None # stamp() the models were read at
+        self.cache = OrderedDict()
+
+    def stamp(self):
+        ''' changes with every fit, by this or any other process; part of the cache key '''
+        return self.conn.execute('SELECT count(*),max(FITTED) FROM CALIBRATION').fetchone()
+
+    ## fitting
+
+    def fit(self, serial, sensor, reference, features='rh', valid_from=None, name='', step=STEP):
+        '''
+        Fit serial's correction from co-located data and store it as a new
+        version. sensor is (t, {PM1,PM3,PM10,RH[,fine,coarse]}) and reference
+        (t, {PM1,PM3,PM10}) of arrays. Returns {field: (coeffs, r2, rmse, n)}.
+        '''
+        if features not in FEATURES: raise ValueError('features must be one of %s'%(FEATURES,))
+        names = list(FIELDS) + ['RH'] + (['fine','coarse'] if features == 'bins' else [])
+        t,s,r = align((sensor[0], np.column_stack([sensor[1][k] for k in names])),
+                      (reference[0], np.column_stack([reference[1][k] for k in FIELDS])), step)
+        version, = self.conn.execute('SELECT coalesce(max(VERSION),0)+1 FROM CALIBRATION WHERE SERIAL=?',(serial,)).fetchone()
+        if valid_from is None: valid_from = int(t.min()) if len(t) else 0
+        extra = dict(zip(names, s.T))
+        out = {}
+        for f,field in enumerate(FIELDS):
+            ok = np.isfinite(s).all(axis=1) & np.isfinite(r[:,f])
+            if ok.sum() < MIN_POINTS:
+                raise ValueError('only %d co-located %d s slots for %s'%(ok.sum(), step, field))
+            X = design(features, s[ok,f], extra['RH'][ok], extra.get('fine',s[:,0])[ok], extra.get('coarse',s[:,0])[ok])
+            y = r[ok,f]
+            coeffs = np.linalg.lstsq(X, y, rcond=None)[0]
+            resid = y - X.dot(coeffs)
+            r2 = 1. - resid.dot(resid)/max(((y-y.mean())**2).sum(), 1e-12)
+            rmse = float(np.sqrt((resid**2).mean()))
+            out[field] = (coeffs.tolist(), float(r2), rmse, int(ok.sum()))
+        with self.conn:
+            for field,(coeffs,r2,rmse,n) in out.items():
+                self.conn.execute('INSERT INTO CALIBRATION VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                    (serial, version, field, int(valid_from), int(time.time()*1000), name, features, n, r2, rmse, json.dumps(coeffs)))
+        self.models.pop(serial, None)
+        log.info('Calibration v{} for {} against {}: R2 {}'.format(version, serial, name,
+            ', '.join('%s %.2f'%(f,out[f][1]) for f in FIELDS)))
+        return out
+
+    def fit_partitions(self, partitions, serial, reference, start, end, features='rh'):
+        ''' fit serial against reference from their rows in [start,end) '''
+        def rows(s):
+            got = list(partitions.query('SELECT UNIXTIME,PM1,PM3,PM10,RH,BINS,SP FROM MEASUREMENTS \
+                WHERE SERIAL=? AND UNIXTIME >= ? AND UNIXTIME < ?', (s,start,end), start, end))
+            if not got: raise ValueError('no rows for %s'%s)
+            t = np.array([g[0] for g in got], float)
+            d = dict((k,np.array([np.nan if g[i+1] is None else g[i+1] for g in got], float))
+                     for i,k in enumerate(FIELDS+('RH',)))
+            if features == 'bins':
+                d['fine'],d['coarse'] = bin_rates([g[5] for g in got], [g[6] for g in got])
+            return t,d
+        return self.fit(serial, rows(serial), rows(reference), features, start, reference)
+
+    ## applying
+
+    def model(self, serial):
+        '''
+        {field: (valid_from array, [coeffs per version], [features per version])},
+        cached until stamp() changes.
+        '''
+        stamp = self.stamp()
+        if stamp != self.loaded:
+            self.models.clear()
+            self.loaded = stamp
+        if serial not in self.models:
+            m = {}
+            for field,valid,coeffs,features in self.conn.execute('SELECT FIELD,VALID_FROM,COEFFS,FEATURES \
+                    FROM CALIBRATION WHERE SERIAL=? ORDER BY VALID_FROM,VERSION',(serial,)):
+                v = m.setdefault(field,([],[],[]))
+                v[0].append(valid); v[1].append(np.array(json.loads(coeffs))); v[2].append(features)
+            self.models[serial] = dict((f,(np.array(v[0]),v[1],v[2])) for f,v in m.items())
+        return self.models[serial]
+
+    def apply(self, serial, field, t, pm, rh, fine=None, coarse=None):
+        '''
+        Corrected copy of pm (rows at times t). Rows before the first
+        calibration of serial are returned as they are. Without fine and
+        coarse, rows under a 'bins' version get the latest earlier version
+        that does not need them, or stay raw if there is none (with a warning).
+        '''
+        pm = np.asarray(pm, float)
+        out = pm.copy()
+        m = self.model(serial).get(field)
+        if m is None: return out
+        valid,coeffs,features = m
+        version = np.searchsorted(valid, t, 'right') - 1
+        for v in np.unique(version):
+            if v < 0: continue
+            sel = version == v
+            u = v
+            while u >= 0 and features[u] == 'bins' and fine is None: u -= 1
+            if u != v:
+                log.warning('{} {} calibration from {} needs bin counts: {}'.format(serial, field, int(valid[v]),
+                    'left uncorrected' if u < 0 else 'using the one from {}'.format(int(valid[u]))))
+                if u < 0: continue
+            X = design(features[u], pm[sel], np.asarray(rh)[sel],
+                       None if fine is None else fine[sel], None if coarse is None else coarse[sel])
+            out[sel] = X.dot(coeffs[u])
+        return out
+
+    def needs_bins(self, serials):
+        return any(f == 'bins' for s in serials for m in self.model(s).values() for f in m[2])
+
+    def corrected(self, partitions, start, end, serials=None, field='PM3'):
+        '''
+        Yield (SERIAL, UNIXTIME, raw, corrected) arrays per sensor per
+        partition in [start,end). Each partition's result is cached until
+        its rows or the calibration table change.
+        '''
+        stamp = self.stamp()
+        for key in partitions.keys(start, end):
+            path = partitions.path(key)
+            conn = sqlite3.connect('file:%s?mode=ro'%path, uri=True)
+            sig = conn.execute('SELECT count(*),max(rowid) FROM MEASUREMENTS').fetchone()
+            conn.close()
+            ckey = (path, sig, stamp, field, tuple(serials) if serials else None)
+            if ckey in self.cache:
+                self.cache.move_to_end(ckey)
+                result = self.cache[ckey]
+            else:
+                result = self.correct_partition(path, serials, field)
+                self.cache[ckey] = result
+                while len(self.cache) > CACHE: self.cache.popitem(last=False)
+            for serial,t,raw,corr in result:
+                sel = (t >= (start if start is not None else -np.inf)) & (t < (end if end is not None else np.inf))
+                yield serial, t[sel], raw[sel], corr[sel]
+
+    def correct_partition(self, path, serials, field):
+        conn = sqlite3.connect('file:%s?mode=ro'%path, uri=True)
+        try:
+            sql = 'SELECT SERIAL,UNIXTIME,%s,RH,BINS,SP FROM MEASUREMENTS'%field
+            params = []
+            if serials:
+                sql += ' WHERE SERIAL IN (%s)'%','.join('?'*len(serials))
+                params = list(serials)
+            rows = conn.execute(sql+' ORDER BY SERIAL,UNIXTIME', params).fetchall()
+        finally:
+            conn.close()
+        out = []
+        if not rows: return out
+        serial = np.array([r[0] for r in rows])
+        cuts = np.flatnonzero(serial[1:] != serial[:-1]) + 1
+        t = np.array([r[1] for r in rows], float)
+        pm = np.array([np.nan if r[2] is None else r[2] for r in rows], float)
+        rh = np.array([np.nan if r[3] is None else r[3] for r in rows], float)
+        fine = coarse = None
+        if self.needs_bins(set(serial)):
+            fine,coarse = bin_rates([r[4] for r in rows], [r[5] for r in rows])
+        for a,b in zip(np.concatenate(([0],cuts)), np.concatenate((cuts,[len(rows)]))):
+            s = serial[a]
+            corr = self.apply(s, field, t[a:b], pm[a:b], rh[a:b],
+                              None if fine is None else fine[a:b], None if coarse is None else coarse[a:b])
+            out.append((s, t[a:b], pm[a:b], corr))
+        return out
+
+
+if __name__ == '__main__':
+    from .SensorMod.db import __RDIR__
+    from .partition import Partitions
+    from .coverage import parse_date
+    args = sys.argv[1:]
+    cal = Calibration(os.path.join(__RDIR__,'calibration.db'))
+    partitions = Partitions(os.path.join(__RDIR__,'partitions'))
+    if len(args) >= 5 and args[0] == 'fit':
+        out = cal.fit_partitions(partitions, args[1], args[2], parse_date(args[3]), parse_date(args[4]),
+                                 args[5] if len(args) > 5 else 'rh')
+        for field,(coeffs,r2,rmse,n) in sorted(out.items()):
+            print('%-5s n %6d R2 %.3f RMSE %.2f coeffs %s'%(field, n, r2, rmse, ' '.join('%.4g'%c for c in coeffs)))
+    elif args and args[0] == 'list':
+        sql = 'SELECT SERIAL,VERSION,FIELD,VALID_FROM,REFERENCE,FEATURES,N,R2,RMSE FROM CALIBRATION'
+        rows = cal.conn.execute(sql+(' WHERE SERIAL=?' if len(args) > 1 else '')+' ORDER BY SERIAL,VERSION,FIELD', args[1:2])
+        for r in rows:
+            print('%-20s v%-3d %-5s from %s vs %-20s %-6s n %6d R2 %.3f RMSE %.2f'%(r[:3]+
+                (time.strftime('%F %H:%M',time.gmtime(r[3])),)+r[4:]))
+    elif len(args) == 4 and args[0] == 'export':
+        start,end = parse_date(args[1]),parse_date(args[2])
+        began = time.time()
+        n = 0
+        with open(args[3],'w') as f:
+            f.write('SERIAL,UNIXTIME,PM3,PM3_CORRECTED\n')
+            for serial,t,raw,corr in cal.corrected(partitions, start, end):
+                for row in zip(t,raw,corr): f.write('%s,%d,%.2f,%.2f\n'%((serial,)+row))
+                n += len(t)
+        print('%d rows corrected in %.1f s'%(n, time.time()-began))
+    else:
+        print(__doc__)
@@ -0,0 +1,58 @@
+'''
+Clocks for the main loop.
+
+Everything in the run loop that reads the time or sleeps goes through a
+Clock, so the same code can be driven by a VirtualClock (see replay.py)
+that jumps forward instead of waiting.
+'''
+
+import time
+from datetime import datetime
+
+
+class Clock(object):
+    ''' the wall clock '''
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, seconds):
+        ''' sleep, returning early (True) if event is set '''
+        return event.wait(seconds)
+
+    def now(self):
+        return datetime.now()
+
+    def utcnow(self):
+        return datetime.utcnow()
+
+
+class VirtualClock(Clock):
+    '''
+    A clock that only moves when slept on. Local time is taken to be UTC.
+    '''
+
+    def __init__(self, start):
+        self.t = float(start)
+
+    def time(self):
+        return self.t
+
+    def sleep(self, seconds):
+        if seconds > 0: self.t += seconds
+
+    def wait(self, event, seconds):
+        self.sleep(seconds)
+        return event.is_set()
+
+    def now(self):
+        return datetime.utcfromtimestamp(self.t)
+
+    def utcnow(self):
+        return datetime.utcfromtimestamp(self.t)
+
+
+clock = Clock()
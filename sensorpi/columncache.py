@@ -0,0 +1,293 @@
+'''
+Memory mapped cache of decoded columns.
+
+Every analysis session reads MEASUREMENTS again, unpickles BINS and
+decrypts LOC row by row (decoded.chunks). The cache keeps the result on
+disk instead, one directory per SERIAL and day holding a flat binary file
+per column:
+
+    rowid UNIXTIME               int64
+    PM1 PM3 PM10 T RH SP         float64
+    lat lon alt age fix nsat     float64 (decrypted LOC)
+    BINS                         float64, 16 per row
+
+get() opens them as read only np.memmap arrays - no copy, no decoding -
+so a repeated query costs a few opens however many rows it covers.
+
+The cache follows the partitions by rowid watermark, as the spatial index
+does: update() decodes only the rows of each partition past the last
+rowid cached and appends them to their SERIAL/day files. With the
+watermark goes a fingerprint of the row at it, so a partition that was
+deleted and made again drops its entries even once it has grown past
+the old watermark, as does one that is gone. When the files
+grow past the disk budget the least recently used SERIAL/days are
+evicted; their rows are decoded again from the partition the next time
+they are asked for. Like the spatial index it holds plain coordinates, so
+it belongs on the analysis machine, not a Pi.
+
+    cache = ColumnCache('/data/bbsensor/columns', Partitions(...), private_key)
+    cache.update()
+    c = cache.get('0000000012345678', day)
+    c['PM3'], c['lat'], c['BINS'] ...
+
+Usage: python3 -m sensorpi.columncache update CACHEDIR [PRIVATE_KEY.pem] [BUDGET_GB]
+       python3 -m sensorpi.columncache list CACHEDIR
+'''
+
+import os,re,sys,time,shutil,sqlite3
+from datetime import datetime
+import numpy as np
+
+from .SensorMod.log_manager import getlog
+from .decoded import chunks, FLOATS, LOCFIELDS, NBINS
+from .spatial import fingerprint
+log = getlog(__name__)
+
+DAY = 86400
+BUDGET = 20*2**30  # bytes of column files kept
+# column: (dtype, values per row)
+DTYPES = dict([('rowid',(np.int64,1)), ('UNIXTIME',(np.int64,1))] +
+              [(name,(np.float64,1)) for name in FLOATS + LOCFIELDS] + [('BINS',(np.float64,NBINS))])
+ROWBYTES = sum(np.dtype(t).itemsize*n for t,n in DTYPES.values())
+
+
+def safe(serial):
+    ''' a directory name for a SERIAL (which may carry a trailing NUL) '''
+    return re.sub('[^A-Za-z0-9_.-]', '_', str(serial).strip().strip('\0')) or '_'
+
+
+class ColumnCache(object):
+    '''
+    Decoded columns per SERIAL and day for the days held by a
+    partition.Partitions, under directory.
+    '''
+
+    def __init__(self, directory, partitions, private_key=None, budget=BUDGET):
+        self.directory = directory
+        self.partitions = partitions
+        self.private_key = private_key
+        self.budget = budget
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(os.path.join(directory,'cache.db'))
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS SOURCES (SOURCE TEXT PRIMARY KEY, TOP INT, ROW TEXT)')
+            if 'ROW' not in [c[1] for c in self.conn.execute('PRAGMA table_info(SOURCES)')]:
+                self.conn.execute('ALTER TABLE SOURCES ADD COLUMN ROW TEXT') # an older cache: recached on the next update
+            # CACHED 0: evicted, the files are gone but the rows are still in SOURCE up to its TOP
+            self.conn.execute('CREATE TABLE IF NOT EXISTS ENTRIES (SERIAL TEXT, DAY INT, SOURCE TEXT, ROWS INT, \
+                USED REAL, CACHED INT, PRIMARY KEY (SERIAL, DAY))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS ENTRIES_USED ON ENTRIES (CACHED, USED)')
+        self.hits = self.misses = 0
+
+    ## files
+
+    def path(self, serial, day, column=None):
+        folder = os.path.join(self.directory, safe(serial), datetime.utcfromtimestamp(day).strftime('%Y%m%d'))
+        return folder if column is None else os.path.join(folder, column)
+
+    def append(self, serial, day, rows, c, index):
+        '''
+        Append rows index of column dict c to a SERIAL/day holding rows
+        rows, first cutting off anything written past them (an append
+        interrupted before its entry was committed).
+        '''
+        folder = self.path(serial, day)
+        if not os.path.exists(folder): os.makedirs(folder)
+        for column,(dtype,width) in DTYPES.items():
+            name = os.path.join(folder, column)
+            size = rows*width*np.dtype(dtype).itemsize
+            with open(name, 'ab') as f:
+                if f.tell() != size: f.truncate(size)
+                f.write(np.ascontiguousarray(c[column][index], dtype).tobytes())
+
+    def remove(self, serial, day):
+        shutil.rmtree(self.path(serial, day), ignore_errors=True)
+
+    def open(self, serial, day, rows):
+        ''' read only views of a SERIAL/day's column files '''
+        out = {}
+        for column,(dtype,width) in DTYPES.items():
+            shape = (rows,) if width == 1 else (rows,width)
+            out[column] = np.memmap(self.path(serial, day, column), dtype, 'r', shape=shape)
+        return out
+
+    ## filling
+
+    def add(self, source, c, row=None):
+        '''
+        Append a chunk of decoded columns from source to their SERIAL/days.
+        Days that were evicted are skipped: they are read whole from the
+        source when next asked for. row is the fingerprint of the last row.
+        '''
+        n = len(c['rowid'])
+        if not n: return 0
+        names,serial = np.unique(c['SERIAL'], return_inverse=True)
+        day = c['UNIXTIME']//DAY*DAY
+        groups,group = np.unique(serial.astype(np.int64)*2**32 + day//DAY, return_inverse=True)
+        order = np.argsort(group, kind='stable')
+        bounds = np.searchsorted(group[order], np.arange(len(groups)+1))
+        added = 0
+        with self.conn:
+            for g in range(len(groups)):
+                index = order[bounds[g]:bounds[g+1]]
+                s,d = str(names[serial[index[0]]]), int(day[index[0]])
+                entry = self.conn.execute('SELECT ROWS,CACHED FROM ENTRIES WHERE SERIAL=? AND DAY=?', (s,d)).fetchone()
+                rows,cached = entry if entry else (0,1)
+                if not cached: continue
+                self.append(s, d, rows, c, index)
+                self.conn.execute('INSERT OR REPLACE INTO ENTRIES VALUES (?,?,?,?,?,1)', (s, d, source, rows+len(index),
+                    time.time()))
+                added += len(index)
+            self.conn.execute('INSERT OR REPLACE INTO SOURCES VALUES (?,?,?)', (source, int(c['rowid'].max()), row))
+        return added
+
+    def top(self, source):
+        return self.mark(source)[0]
+
+    def mark(self, source):
+        ''' (top, fingerprint of the source row at top) '''
+        row = self.conn.execute('SELECT TOP,ROW FROM SOURCES WHERE SOURCE=?', (source,)).fetchone()
+        return row or (0, None)
+
+    def drop(self, source):
+        ''' forget everything cached from source '''
+        with self.conn:
+            for s,d in self.conn.execute('SELECT SERIAL,DAY FROM ENTRIES WHERE SOURCE=?', (source,)).fetchall():
+                self.remove(s, d)
+            self.conn.execute('DELETE FROM ENTRIES WHERE SOURCE=?', (source,))
+            self.conn.execute('DELETE FROM SOURCES WHERE SOURCE=?', (source,))
+
+    def extend(self, source):
+        '''
+        Decode and cache the rows of source added since the last call.
+        Returns the number of rows cached.
+        '''
+        src = sqlite3.connect('file:%s?mode=ro'%source, uri=True)
+        try:
+            top,row = self.mark(source)
+            if top and fingerprint(src, top) != row:
+                # the partition was deleted and made again
+                log.info('Recaching {}'.format(source))
+                self.drop(source)
+                top = 0
+            added = 0
+            for c in chunks(src, self.private_key, where='WHERE rowid > ? ORDER BY rowid', params=(top,), bins=True):
+                added += self.add(source, c, fingerprint(src, int(c['rowid'].max())))
+        finally:
+            src.close()
+        return added
+
+    def update(self, start=None, end=None):
+        '''
+        Bring the cache up to date with the partitions overlapping
+        [start,end), then evict down to the budget. Returns rows cached.
+        '''
+        sources = set(self.partitions.path(key) for key in self.partitions.keys())
+        for source, in self.conn.execute('SELECT SOURCE FROM SOURCES').fetchall():
+            if source not in sources: self.drop(source) # expired
+        added = sum(self.extend(self.partitions.path(key)) for key in self.partitions.keys(start, end))
+        self.evict()
+        if added: log.info('Cached {} rows'.format(added))
+        return added
+
+    def refill(self, serial, day, source):
+        ''' decode an evicted SERIAL/day again, up to the rows its source has been cached to '''
+        self.remove(serial, day)
+        src = sqlite3.connect('file:%s?mode=ro'%source, uri=True)
+        rows = 0
+        try:
+            # NumPy drops the trailing NUL some SERIALs are stored with
+            for c in chunks(src, self.private_key, where='WHERE SERIAL IN (?,?) AND UNIXTIME >= ? AND UNIXTIME < ? \
+                AND rowid <= ? ORDER BY rowid', params=(serial, serial+'\0', day, day+DAY, self.top(source)), bins=True):
+                self.append(serial, day, rows, c, np.arange(len(c['rowid'])))
+                rows += len(c['rowid'])
+        finally:
+            src.close()
+        with self.conn:
+            self.conn.execute('UPDATE ENTRIES SET ROWS=?,CACHED=1 WHERE SERIAL=? AND DAY=?', (rows, serial, day))
+        return rows
+
+    ## reading
+
+    def get(self, serial, day):
+        '''
+        Read only column arrays for SERIAL on the day starting at day, or
+        None if nothing is cached for it.
+        '''
+        entry = self.conn.execute('SELECT SOURCE,ROWS,CACHED FROM ENTRIES WHERE SERIAL=? AND DAY=?',
+                                  (serial, day)).fetchone()
+        if entry is None: return None
+        source,rows,cached = entry
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+            rows = self.refill(serial, day, source)
+        with self.conn:
+            self.conn.execute('UPDATE ENTRIES SET USED=? WHERE SERIAL=? AND DAY=?', (time.time(), serial, day))
+        if not cached: self.evict(keep=(serial, day))
+        return self.open(serial, day, rows) if rows else None
+
+    def days(self, serial, start=None, end=None):
+        ''' (day, columns) for each day of SERIAL in [start,end) '''
+        sql = 'SELECT DAY FROM ENTRIES WHERE SERIAL=? AND DAY+? > ? AND DAY < ? ORDER BY DAY'
+        for day, in self.conn.execute(sql, (serial, DAY, -2**62 if start is None else start,
+                                            2**62 if end is None else end)).fetchall():
+            c = self.get(serial, day)
+            if c is not None: yield day, c
+
+    def serials(self):
+        return [s for s, in self.conn.execute('SELECT DISTINCT SERIAL FROM ENTRIES ORDER BY SERIAL')]
+
+    ## budget
+
+    def size(self):
+        ''' bytes of column files held '''
+        rows, = self.conn.execute('SELECT sum(ROWS) FROM ENTRIES WHERE CACHED=1').fetchone()
+        return (rows or 0)*ROWBYTES
+
+    def evict(self, budget=None, keep=None):
+        '''
+        Delete the least recently used SERIAL/days until the files fit in
+        budget (default the cache's). Returns the number evicted.
+        '''
+        budget = self.budget if budget is None else budget
+        excess = self.size() - budget
+        evicted = 0
+        if excess <= 0: return 0
+        with self.conn:
+            for s,d,rows in self.conn.execute('SELECT SERIAL,DAY,ROWS FROM ENTRIES WHERE CACHED=1 \
+                ORDER BY USED').fetchall():
+                if excess <= 0: break
+                if (s,d) == keep: continue
+                self.remove(s, d)
+                self.conn.execute('UPDATE ENTRIES SET CACHED=0 WHERE SERIAL=? AND DAY=?', (s,d))
+                excess -= rows*ROWBYTES
+                evicted += 1
+        log.info('Evicted {} days from the column cache'.format(evicted))
+        return evicted
+
+
+if __name__ == '__main__':
+    from .SensorMod.db import __RDIR__
+    from .partition import Partitions
+    args = sys.argv[1:]
+    partitions = Partitions(os.path.join(__RDIR__,'partitions'))
+    if len(args) >= 2 and args[0] == 'update':
+        key = None
+        if len(args) > 2:
+            from .crypt import load_private
+            key = load_private(args[2])
+        budget = float(args[3])*2**30 if len(args) > 3 else BUDGET
+        cache = ColumnCache(args[1], partitions, key, budget)
+        t = time.time()
+        added = cache.update()
+        print('%d rows cached in %.1f s, %.1f GB held'%(added, time.time()-t, cache.size()/2.**30))
+    elif len(args) == 2 and args[0] == 'list':
+        cache = ColumnCache(args[1], partitions)
+        for s,d,rows,cached in cache.conn.execute('SELECT SERIAL,DAY,ROWS,CACHED FROM ENTRIES ORDER BY SERIAL,DAY'):
+            print('%-20s %s %8d%s'%(s.strip('\0'), datetime.utcfromtimestamp(d).strftime('%Y-%m-%d'), rows,
+                                    '' if cached else '  (evicted)'))
+    else:
+        print(__doc__)
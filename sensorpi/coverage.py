@@ -0,0 +1,245 @@
+'''
+Coverage index: when each sensor was recording.
+
+For every SERIAL the index holds a set of disjoint [START,END] intervals of
+sample times; samples closer than JOIN seconds belong to the same interval.
+It lives in its own small file (__RDIR__/coverage.db) so it outlasts the
+landing database and the partitions, and is kept up to date as rows arrive
+(ingest.py, and write() on the serverpi) and by scan() of server.db before
+each rollover. Adding the same samples twice changes nothing, so the
+update paths can overlap.
+
+Queries read a handful of intervals through the (SERIAL,START) index
+instead of scanning MEASUREMENTS:
+
+    cov = Coverage(path)
+    cov.gaps(serial, start, end, longer=3600)   # [(start,end), ...]
+    cov.uptime(start, end)                      # {day: {serial: seconds}}
+
+Usage: python3 -m sensorpi.coverage [--json] sensors
+                                    [--json] gaps SERIAL SECONDS [FROM [TO]]
+                                    [--json] uptime [FROM [TO]]
+                                    rebuild          (from server.db and the partitions)
+FROM and TO are YYYY-MM-DD (UTC).
+'''
+
+import os,sys,json,sqlite3
+from datetime import datetime
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+JOIN = 60    # s - samples closer than this are one interval
+DAY = 86400
+CHUNK = 10000 # rows read at a time by scan
+
+
+def runs(times, join=JOIN):
+    ''' sorted (start,end) runs of a sequence of unix times '''
+    out = []
+    for t in sorted(times):
+        t = int(t)
+        if out and t - out[-1][1] <= join:
+            if t > out[-1][1]: out[-1][1] = t
+        else:
+            out.append([t,t])
+    return out
+
+
+class Coverage(object):
+
+    def __init__(self, path, join=JOIN, readonly=False):
+        self.path = path
+        self.join = join
+        if readonly: # queries only, e.g. from api.py alongside the ingest writer
+            self.conn = sqlite3.connect('file:%s?mode=ro'%path, uri=True, check_same_thread=False)
+            return
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS COVERAGE (SERIAL TEXT, START INT, END INT)')
+            self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS COVERAGE_START ON COVERAGE (SERIAL, START)')
+
+    def close(self):
+        self.conn.close()
+
+    ## updating
+
+    def add(self, serial, times):
+        '''
+        Merge sample times of one sensor into the index. Returns the number
+        of intervals written.
+        '''
+        new = runs(times, self.join)
+        if not new: return 0
+        c = self.conn
+        with c:
+            for lo,hi in new:
+                # intervals are disjoint, so walking back by START also walks back by END
+                merge = []
+                for rowid,start,end in c.execute('SELECT rowid,START,END FROM COVERAGE \
+                        WHERE SERIAL=? AND START<=? ORDER BY START DESC',(serial,hi+self.join)):
+                    if end < lo-self.join: break
+                    merge.append(rowid)
+                    lo,hi = min(lo,start),max(hi,end)
+                if merge:
+                    c.execute('DELETE FROM COVERAGE WHERE rowid IN (%s)'%','.join('?'*len(merge)),merge)
+                c.execute('INSERT INTO COVERAGE (SERIAL,START,END) VALUES (?,?,?)',(serial,lo,hi))
+        return len(new)
+
+    def add_rows(self, rows):
+        ''' add MEASUREMENTS rows (SERIAL first, UNIXTIME last) '''
+        groups = {}
+        for row in rows:
+            if row[-1] is not None: groups.setdefault(row[0],[]).append(row[-1])
+        for serial,times in groups.items():
+            self.add(serial,times)
+
+    def scan(self, conn, where='', params=()):
+        '''
+        Add every row of a MEASUREMENTS table (server.db or a partition).
+        '''
+        cursor = conn.execute('SELECT SERIAL,UNIXTIME FROM MEASUREMENTS %s'%where, params)
+        count = 0
+        while True:
+            rows = cursor.fetchmany(CHUNK)
+            if not rows: break
+            self.add_rows(rows)
+            count += len(rows)
+        return count
+
+    ## queries
+
+    def sensors(self):
+        ''' {serial: (first, last, intervals, seconds covered)} '''
+        return dict((s,(a,b,n,t)) for s,a,b,n,t in self.conn.execute(
+            'SELECT SERIAL,min(START),max(END),count(*),sum(END-START) FROM COVERAGE GROUP BY SERIAL'))
+
+    def intervals(self, serial, start=None, end=None):
+        '''
+        Intervals of serial overlapping [start,end), clipped to it.
+        '''
+        c = self.conn
+        lo = -2**62 if start is None else int(start)
+        hi = 2**62 if end is None else int(end)
+        out = []
+        first = c.execute('SELECT START,END FROM COVERAGE WHERE SERIAL=? AND START<? \
+            ORDER BY START DESC LIMIT 1',(serial,lo)).fetchone()
+        if first and first[1] >= lo: out.append((lo,min(first[1],hi)))
+        for a,b in c.execute('SELECT START,END FROM COVERAGE WHERE SERIAL=? AND START>=? AND START<? \
+                ORDER BY START',(serial,lo,hi)):
+            out.append((a,min(b,hi)))
+        return out
+
+    def gaps(self, serial, start, end, longer=0):
+        '''
+        Spans of [start,end) longer than longer seconds where serial recorded nothing.
+        '''
+        out = []
+        last = int(start)
+        for a,b in self.intervals(serial, start, end):
+            if a - last > longer: out.append((last,a))
+            last = max(last,b)
+        if int(end) - last > longer: out.append((last,int(end)))
+        return out
+
+    def uptime(self, start, end, serials=None):
+        '''
+        Seconds covered per UTC day and sensor in [start,end):
+        {day start: {serial: seconds}}
+        '''
+        if serials is None:
+            serials = [s for s, in self.conn.execute('SELECT DISTINCT SERIAL FROM COVERAGE')]
+        days = {}
+        for day in range(int(start)//DAY*DAY, int(end), DAY):
+            days[day] = {}
+        for serial in serials:
+            for a,b in self.intervals(serial, start, end):
+                while True: # split at midnights
+                    day = a//DAY*DAY
+                    upto = min(b, day+DAY)
+                    days[day][serial] = days[day].get(serial,0) + upto - a
+                    if upto >= b: break
+                    a = upto
+        return days
+
+
+########################################################
+##  Command line
+########################################################
+
+def parse_date(text):
+    return int((datetime.strptime(text,'%Y-%m-%d') - datetime(1970,1,1)).total_seconds())
+
+
+def date_range(args, days=7):
+    ''' [start,end) from [FROM [TO]] (YYYY-MM-DD), by default the last days days and today '''
+    today = parse_date(datetime.utcnow().strftime('%Y-%m-%d'))
+    start = parse_date(args[0]) if args else today - days*DAY
+    end = parse_date(args[1]) if len(args) > 1 else today + DAY
+    return start, end
+
+
+def iso(t):
+    return datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def main(args):
+    from .SensorMod.db import __RDIR__
+    as_json = '--json' in args
+    args = [a for a in args if a != '--json']
+    cov = Coverage(os.path.join(__RDIR__,'coverage.db'))
+    command = args[0] if args else 'sensors'
+
+    if command == 'rebuild':
+        from .partition import Partitions
+        parts = Partitions(os.path.join(__RDIR__,'partitions'))
+        count = 0
+        for key in parts.keys():
+            conn = sqlite3.connect('file:%s?mode=ro'%parts.path(key), uri=True)
+            count += cov.scan(conn)
+            conn.close()
+        server = os.path.join(__RDIR__,'server.db')
+        if os.path.exists(server):
+            conn = sqlite3.connect(server)
+            count += cov.scan(conn)
+            conn.close()
+        result = {'rows':count, 'sensors':len(cov.sensors())}
+        text = ['indexed %(rows)d rows from %(sensors)d sensors'%result]
+
+    elif command == 'sensors':
+        result = dict((s,{'first':iso(a),'last':iso(b),'intervals':n,'hours':t/3600.})
+                      for s,(a,b,n,t) in cov.sensors().items())
+        text = ['%-20s %s - %s %6d intervals %9.1f h'%(s,r['first'],r['last'],r['intervals'],r['hours'])
+                for s,r in sorted(result.items())]
+
+    elif command == 'gaps':
+        serial,longer = args[1],int(args[2])
+        first,last = cov.sensors().get(serial,(0,0,0,0))[:2]
+        start = parse_date(args[3]) if len(args) > 3 else first
+        end = parse_date(args[4]) if len(args) > 4 else last
+        gaps = cov.gaps(serial, start, end, longer)
+        result = [{'start':iso(a),'end':iso(b),'hours':(b-a)/3600.} for a,b in gaps]
+        text = ['%s - %s %8.1f h'%(g['start'],g['end'],g['hours']) for g in result]
+
+    elif command == 'uptime':
+        start,end = date_range(args[1:])
+        days = cov.uptime(start, end)
+        result = {}
+        text = []
+        for day,sensors in sorted(days.items()):
+            hours = sum(sensors.values())/3600.
+            d = datetime.utcfromtimestamp(day).strftime('%Y-%m-%d')
+            result[d] = {'sensors':len(sensors), 'hours':hours,
+                         'per_sensor':dict((s,t/3600.) for s,t in sensors.items())}
+            text.append('%s %4d sensors %8.1f sensor hours'%(d,len(sensors),hours))
+    else:
+        print(__doc__)
+        return
+
+    cov.close()
+    print(json.dumps(result, indent=1, sort_keys=True) if as_json else '\n'.join(text))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -21,3 +21,22 @@ def scramble(data):
         ))
 
 	return encrypted
+
+
+######### Private key holder (analysis) only ##########
+def load_private(path, password=None):
+	with open(path, "rb") as key_file:
+		return serialization.load_pem_private_key(
+            key_file.read(),
+            password=password,
+            backend=default_backend()
+        )
+
+def unscramble(data, private_key):
+	return private_key.decrypt(
+        bytes(data),
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        ))
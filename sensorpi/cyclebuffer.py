@@ -0,0 +1,120 @@
+'''
+Columnar buffer for one sampling cycle.
+
+Replaces the list of 13 element lists runcycle used to return. SERIAL and
+TYPE are stored once for the cycle, numbers go into typed arrays, TIME and
+the encrypted LOC into fixed width byte arrays and the 16 bins into a
+flat float matrix. The arrays are allocated once and reused each cycle
+(reset()), doubling only if a cycle is longer than any before it.
+
+rows() yields db ready tuples (BINS pickled as before) straight from the
+arrays, for executemany or any other sink.
+
+What it saves is objects rather than bytes. An hour's cycle (720 rows with
+a 256 byte LOC) holds about 340 kB in under 30 blocks, against about 580 kB
+in some 6,400 objects as lists. A later cycle in the same buffer allocates
+nothing that outlives it. Per sample, measurement() still builds a row
+list and a bins list, which are freed once appended, and rows() pickles
+each row's bins on the way to the db.
+
+Test: python3 -m sensorpi.tests cyclebuffer
+'''
+
+import pickle
+from array import array
+
+NBINS = 16
+FLOATS = ('PM1','PM3','PM10','T','RH','SP')
+
+
+class CycleBuffer(object):
+
+    def __init__(self, capacity=64):
+        self.capacity = 0
+        self.header = None
+        self.count = 0
+        self.timewidth = 6
+        self.locwidth = None
+        self.time = bytearray()
+        self.loc = bytearray()
+        self.floats = dict((k,array('d')) for k in FLOATS)
+        self.bins = array('d')
+        self.rc = array('l')
+        self.unixtime = array('q')
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        extra = capacity - self.capacity
+        if extra <= 0: return
+        self.time.extend(bytes(extra*self.timewidth))
+        if self.locwidth: self.loc.extend(bytes(extra*self.locwidth))
+        for a in self.floats.values(): a.frombytes(bytes(extra*a.itemsize))
+        self.bins.frombytes(bytes(extra*NBINS*self.bins.itemsize))
+        self.rc.frombytes(bytes(extra*self.rc.itemsize))
+        self.unixtime.frombytes(bytes(extra*self.unixtime.itemsize))
+        self.capacity = capacity
+
+    def reset(self):
+        ''' empty the buffer, keeping its storage '''
+        self.count = 0
+        self.header = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        '''
+        Store a measurement row: SERIAL,TYPE,TIME,LOC,PM1,PM3,PM10,T,RH,BINS,SP,RC,UNIXTIME
+        with BINS as a sequence of 16 numbers. SERIAL and TYPE are taken from
+        the first row of the cycle.
+        '''
+        i = self.count
+        if self.header is None: self.header = (row[0],row[1])
+        loc = row[3]
+        if self.locwidth is None:
+            self.locwidth = len(loc)
+            self.loc.extend(bytes(self.capacity*self.locwidth))
+        elif len(loc) != self.locwidth:
+            raise ValueError('LOC is %d bytes, expected %d'%(len(loc),self.locwidth))
+        if i == self.capacity: self.grow(2*self.capacity)
+
+        w = self.timewidth
+        self.time[i*w:(i+1)*w] = row[2].encode('ascii')[:w].ljust(w)
+        self.loc[i*self.locwidth:(i+1)*self.locwidth] = loc
+        f = self.floats
+        f['PM1'][i],f['PM3'][i],f['PM10'][i],f['T'][i],f['RH'][i] = row[4:9]
+        bins,base = self.bins,i*NBINS
+        for j,b in enumerate(row[9]): bins[base+j] = b
+        f['SP'][i] = row[10]
+        self.rc[i] = row[11]
+        self.unixtime[i] = row[12]
+        self.count = i+1
+
+    def column(self, name):
+        ''' zero copy view of a numeric column for this cycle (release before the next append) '''
+        if name in self.floats: return memoryview(self.floats[name])[:self.count]
+        if name == 'RC': return memoryview(self.rc)[:self.count]
+        if name == 'UNIXTIME': return memoryview(self.unixtime)[:self.count]
+        if name == 'BINS': return memoryview(self.bins)[:self.count*NBINS]
+        raise KeyError(name)
+
+    def rows(self, copy=False):
+        '''
+        Yield db rows. LOC is a memoryview into the buffer unless copy is
+        set; do not keep those rows past the next append().
+        '''
+        SERIAL,TYPE = self.header or (None,None)
+        w,lw = self.timewidth,self.locwidth
+        f = self.floats
+        PM1,PM3,PM10,T,RH,SP = [f[k] for k in FLOATS]
+        loc = memoryview(self.loc)
+        try:
+            for i in range(self.count):
+                yield (SERIAL, TYPE,
+                       self.time[i*w:(i+1)*w].decode('ascii').strip(),
+                       loc[i*lw:(i+1)*lw].tobytes() if copy else loc[i*lw:(i+1)*lw],
+                       PM1[i], PM3[i], PM10[i], T[i], RH[i],
+                       pickle.dumps(self.bins[i*NBINS:(i+1)*NBINS].tolist()),
+                       SP[i], self.rc[i], self.unixtime[i])
+        finally:
+            loc.release()
@@ -0,0 +1,86 @@
+'''
+Decrypted measurements for analysis.
+
+LOC is RSA encrypted on the sensor (crypt.scramble) and can only be read
+with the private key, which never goes on a Pi. chunks() reads a
+MEASUREMENTS table in fixed size blocks, decrypts and parses each LOC and
+yields NumPy columns, so any amount of data can be streamed through the
+analysis modules in bounded memory. Rows without a fix get NaN
+coordinates, as do all rows when no key is given. With bins=True the
+pickled BINS are unpacked into an (n,16) 'BINS' matrix.
+
+    key = crypt.load_private('bbsensor_private.pem')
+    for c in chunks(conn, key):
+        c['lat'], c['lon'], c['PM3'], c['UNIXTIME'] ...
+'''
+
+import pickle
+import numpy as np
+
+CHUNK = 100000  # rows per block
+FLOATS = ('PM1','PM3','PM10','T','RH','SP')
+LOCFIELDS = ('lat','lon','alt','age','fix','nsat')
+NBINS = 16
+
+
+def parse_loc(text):
+    '''
+    (lat, lon, alt, age, fix, nsat) floats from a decrypted LOC string
+    (lat_lon_alt_age_fix_nsat); NaN for empty fields.
+    '''
+    if isinstance(text, bytes): text = text.decode('utf-8')
+    out = []
+    for field in text.split('_')[:6]:
+        try: out.append(float(field))
+        except ValueError: out.append(float('nan'))
+    return tuple(out + [float('nan')]*(6-len(out)))
+
+
+def decrypt(locs, private_key):
+    ''' a (n,6) float array from encrypted LOC blobs, all NaN without a key '''
+    out = np.empty((len(locs),6))
+    if private_key is None:
+        out[:] = np.nan
+        return out
+    from .crypt import unscramble
+    for i,loc in enumerate(locs):
+        try: out[i] = parse_loc(unscramble(loc, private_key))
+        except ValueError: out[i] = np.nan
+    return out
+
+
+def unpack_bins(blobs):
+    ''' an (n,16) float array from pickled BINS, NaN where missing '''
+    out = np.empty((len(blobs),NBINS))
+    for i,b in enumerate(blobs):
+        out[i] = pickle.loads(b) if b else np.nan
+    return out
+
+
+def columns(rows, private_key, bins=False):
+    '''
+    Column arrays for rows of (rowid, SERIAL, UNIXTIME, LOC, PM1, PM3, PM10, T, RH, SP[, BINS]).
+    '''
+    c = {'rowid': np.fromiter((r[0] for r in rows), np.int64, len(rows)),
+         'SERIAL': np.array([r[1] for r in rows]),
+         'UNIXTIME': np.fromiter((r[2] or 0 for r in rows), np.int64, len(rows))}
+    loc = decrypt([r[3] for r in rows], private_key)
+    for i,name in enumerate(LOCFIELDS): c[name] = loc[:,i]
+    for i,name in enumerate(FLOATS):
+        c[name] = np.fromiter((np.nan if r[4+i] is None else r[4+i] for r in rows), np.float64, len(rows))
+    if bins: c['BINS'] = unpack_bins([r[10] for r in rows])
+    return c
+
+
+def chunks(conn, private_key, size=CHUNK, where='', params=(), bins=False):
+    '''
+    Yield dicts of column arrays, size rows at a time, from the
+    MEASUREMENTS table of server.db or a partition file. where is an SQL
+    clause with ? params, e.g. 'WHERE rowid > ?'.
+    '''
+    cursor = conn.execute('SELECT rowid,SERIAL,UNIXTIME,LOC,%s%s FROM MEASUREMENTS %s'%(
+        ','.join(FLOATS), ',BINS' if bins else '', where), params)
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows: break
+        yield columns(rows, private_key, bins)
@@ -0,0 +1,92 @@
+'''
+Warm standby for the OPC between sampling cycles.
+
+Without it every cycle powers the OPC on, waits a second, throws the first
+histogram away, and at the end powers it off and waits another second,
+and the fan and laser spin up again each time. DutyCycle wraps the OPC
+(alpha) so that off() at the end of a cycle leaves it running; the next
+cycle starts warm, skips the waits and keeps its first histogram, whose
+sampling period covers the time between the cycles - unless that was
+longer than MAXPERIOD. After an upload or a slow write the period spans
+minutes the loop was not sampling for, and the OPC's 16 bit bin counts can
+saturate over it, so such a histogram is not valid either. The OPC is only
+powered down by standby(), which the main loop calls before a long idle
+window (SCHOOL or NIGHT) or on exit.
+
+Each histogram is checked against the time the OPC was last powered on:
+valid is False while its sampling period began within WARMUP seconds of
+power on, or is longer than MAXPERIOD, and loop.runcycle drops those rows.
+metrics() counts warm and cold starts, dropped warm-up and overlong
+samples, and the seconds covered by valid samples against the seconds the
+OPC was powered.
+
+Compare with the old behaviour: python3 -m sensorpi.replay 7 bbsensor warm
+'''
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+WARMUP = 3.     # s after power on before readings are trusted (fan and laser spin-up)
+MAXPERIOD = 45. # s - longest sampling period kept, three of the slowest SAMPLING_DELAY
+
+
+class DutyCycle(object):
+
+    def __init__(self, alpha, clock, warmup=WARMUP, maxperiod=MAXPERIOD):
+        self.alpha = alpha
+        self.clock = clock
+        self.warmup = warmup
+        self.maxperiod = maxperiod
+        self.warm = False   # powered and sampling since an earlier cycle
+        self.since = None   # last power on
+        self.valid = True   # the last histogram was read after the warm-up
+        self.cold = 0
+        self.warm_starts = 0
+        self.samples = 0
+        self.warming = 0
+        self.overlong = 0
+        self.covered = 0.
+        self.powered = 0.
+
+    def on(self):
+        if self.warm:
+            self.warm_starts += 1
+            return True
+        self.cold += 1
+        self.since = self.clock.time()
+        return self.alpha.on()
+
+    def off(self):
+        ''' end of a cycle: stays on, see standby() '''
+        self.warm = self.since is not None
+        return True
+
+    def standby(self):
+        ''' power down for a long idle window '''
+        if self.since is None: return
+        self.powered += self.clock.time() - self.since
+        self.warm,self.since = False,None
+        self.alpha.off()
+        self.clock.sleep(1) # let the rpi turn off the fan
+
+    def pm(self):
+        return self.histogram()
+
+    def histogram(self):
+        pm = self.alpha.histogram()
+        period = float(pm['Sampling Period'])
+        self.valid = self.since is not None and self.clock.time() - period >= self.since + self.warmup
+        self.samples += 1
+        if not self.valid: self.warming += 1
+        elif period > self.maxperiod:
+            log.debug('Dropped a histogram over {:.0f} s'.format(period))
+            self.valid = False
+            self.overlong += 1
+        else: self.covered += period
+        return pm
+
+    def metrics(self):
+        powered = self.powered + (self.clock.time() - self.since if self.since is not None else 0)
+        return dict(cold=self.cold, warm=self.warm_starts, samples=self.samples, warming=self.warming,
+                    overlong=self.overlong, covered=self.covered, powered=powered,
+                    coverage=self.covered/powered if powered else None)
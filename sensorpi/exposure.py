@@ -0,0 +1,172 @@
+'''
+Daily exposure per sensor and microenvironment.
+
+Each row stands for the SP seconds its histogram integrated over,
+starting at UNIXTIME, cut short where the sensor's next row starts (and
+at MAXSP, so a sample after a gap does not stretch over it). Time not
+covered by any row is a gap and counts towards nothing. Rows are
+labelled with a microenvironment from TYPE, TYPE 4 being split into
+school and home by the SCHOOL hours of the schedule.
+
+For every SERIAL, day, microenvironment and PM field this gives the
+time covered, dose (ug/m3 h), time weighted mean, peak and the time spent
+above each of THRESHOLDS, all computed with NumPy over the day's rows at
+once. Results are cached in exposure.db with the row count and last
+rowid of the partition they came from (partition.Days), so only new or
+changed days are recomputed.
+
+Usage: python3 -m sensorpi.exposure [--json] [FROM [TO]]    (YYYY-MM-DD, default the last week)
+'''
+
+import os,sys,json,sqlite3
+import numpy as np
+
+from .SensorMod.log_manager import getlog
+from .partition import Days
+log = getlog(__name__)
+
+DAY = 86400
+MAXSP = 60.  # s - longest a single row may stand for
+SCHOOL = [9,15] # as in __main__
+ENVIRONMENTS = {1:'static', 2:'commute', 3:'server'}
+FIELDS = ('PM1','PM3','PM10')
+# ug/m3 - WHO 2021 24 h guideline, EU limit, high
+THRESHOLDS = {'PM1':(10,25,50), 'PM3':(15,25,50), 'PM10':(45,50,100)}
+
+
+def environment(TYPE, unixtime, school=SCHOOL):
+    ''' array of microenvironment names '''
+    hour = (unixtime % DAY)//3600
+    env = np.array([ENVIRONMENTS.get(int(t),'home') for t in TYPE], dtype=object)
+    env[(TYPE == 4) & (hour > school[0]) & (hour < school[1])] = 'school'
+    return env
+
+
+def durations(serial, unixtime, sp, end, maxsp=MAXSP):
+    '''
+    Seconds each row stands for. Rows must be sorted by serial then time.
+    '''
+    dt = np.clip(np.nan_to_num(sp), 0, maxsp)
+    following = np.empty(len(unixtime))
+    following[:-1] = unixtime[1:]
+    following[-1] = end
+    last = np.ones(len(unixtime), bool) # last row of each sensor
+    last[:-1] = serial[1:] != serial[:-1]
+    following[last] = end
+    return np.maximum(np.minimum(dt, following - unixtime), 0)
+
+
+def aggregate(rows, day, school=SCHOOL):
+    '''
+    Exposure records from one day's rows (SERIAL, TYPE, UNIXTIME, SP, PM1, PM3, PM10),
+    sorted by SERIAL and UNIXTIME: a list of
+    (SERIAL, ENV, FIELD, seconds, dose, mean, peak, {threshold: seconds above}).
+    '''
+    if not rows: return []
+    serial = np.array([r[0] for r in rows])
+    TYPE = np.array([r[1] or 0 for r in rows])
+    t = np.array([r[2] for r in rows], float)
+    sp = np.array([np.nan if r[3] is None else r[3] for r in rows], float)
+    pm = np.array([[np.nan if v is None else v for v in r[4:7]] for r in rows], float)
+
+    dt = durations(serial, t, sp, day+DAY)
+    env = environment(TYPE, t.astype(np.int64), school)
+
+    keys = np.char.add(np.char.add(serial.astype(str), '\t'), env.astype(str))
+    names,group = np.unique(keys, return_inverse=True)
+    n = len(names)
+    out = []
+    for f,field in enumerate(FIELDS):
+        v = pm[:,f]
+        ok = np.isfinite(v) & (dt > 0)
+        w = np.where(ok, dt, 0.)
+        v0 = np.where(ok, v, 0.)
+        seconds = np.bincount(group, w, n)
+        dose = np.bincount(group, v0*w, n)
+        peak = np.full(n, -np.inf)
+        np.maximum.at(peak, group[ok], v[ok])
+        above = [np.bincount(group, np.where(v0 > thr, w, 0.), n) for thr in THRESHOLDS[field]]
+        for g in range(n):
+            if seconds[g] <= 0: continue
+            s,e = names[g].split('\t')
+            out.append((s, e, field, float(seconds[g]), float(dose[g])/3600., float(dose[g]/seconds[g]),
+                        float(peak[g]), dict((thr,float(a[g])) for thr,a in zip(THRESHOLDS[field],above))))
+    return out
+
+
+class Exposure(object):
+    '''
+    Cached daily exposure for the days held by a partition.Partitions.
+    '''
+
+    def __init__(self, path, partitions, school=SCHOOL):
+        self.partitions = partitions
+        self.school = school
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS EXPOSURE (DAY INT, SERIAL TEXT, ENV TEXT, FIELD TEXT, \
+                SECONDS REAL, DOSE REAL, MEAN REAL, PEAK REAL, ABOVE TEXT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS EXPOSURE_DAY ON EXPOSURE (DAY, SERIAL)')
+        self.days = Days(self.conn, partitions, DAY)
+
+    def compute(self, day):
+        rows = []
+        for r in self.partitions.query('SELECT SERIAL,TYPE,UNIXTIME,SP,PM1,PM3,PM10 FROM MEASUREMENTS \
+                WHERE UNIXTIME >= ? AND UNIXTIME < ? ORDER BY SERIAL,UNIXTIME', (day,day+DAY), day, day+DAY):
+            rows.append(r)
+        return aggregate(rows, day, self.school)
+
+    def update(self, start=None, end=None):
+        '''
+        Recompute the days in [start,end) whose partition changed since
+        they were cached. Returns the days recomputed.
+        '''
+        done = []
+        for day,source in self.days.stale(start, end):
+            records = self.compute(day)
+            with self.conn:
+                self.conn.execute('DELETE FROM EXPOSURE WHERE DAY=?',(day,))
+                self.conn.executemany('INSERT INTO EXPOSURE VALUES (?,?,?,?,?,?,?,?,?)',
+                    [(day,s,e,f,sec,dose,mean,peak,json.dumps(above)) for s,e,f,sec,dose,mean,peak,above in records])
+                self.days.done(day, source)
+            done.append(day)
+        if done: log.info('Exposure computed for {} days'.format(len(done)))
+        return done
+
+    def get(self, start, end, serials=None, field='PM3'):
+        '''
+        Cached records in [start,end) as dicts.
+        '''
+        sql = 'SELECT DAY,SERIAL,ENV,SECONDS,DOSE,MEAN,PEAK,ABOVE FROM EXPOSURE WHERE DAY >= ? AND DAY < ? AND FIELD = ?'
+        params = [start,end,field]
+        if serials:
+            sql += ' AND SERIAL IN (%s)'%','.join('?'*len(serials))
+            params += list(serials)
+        names = ('day','serial','env','seconds','dose','mean','peak','above')
+        out = []
+        for r in self.conn.execute(sql+' ORDER BY DAY,SERIAL,ENV', params):
+            d = dict(zip(names,r))
+            d['above'] = json.loads(d['above'])
+            out.append(d)
+        return out
+
+
+if __name__ == '__main__':
+    from .SensorMod.db import __RDIR__
+    from .partition import Partitions
+    from .coverage import date_range
+    from datetime import datetime
+    args = sys.argv[1:]
+    as_json = '--json' in args
+    start,end = date_range([a for a in args if a != '--json'])
+
+    exposure = Exposure(os.path.join(__RDIR__,'exposure.db'), Partitions(os.path.join(__RDIR__,'partitions')))
+    exposure.update(start, end)
+    records = exposure.get(start, end)
+    if as_json:
+        print(json.dumps(records, indent=1))
+    else:
+        for r in records:
+            print('%s %-20s %-8s %6.2f h  mean %6.1f  peak %6.1f  dose %7.1f ug/m3 h  >%s: %.2f h'%(
+                datetime.utcfromtimestamp(r['day']).strftime('%Y-%m-%d'), r['serial'], r['env'], r['seconds']/3600.,
+                r['mean'], r['peak'], r['dose'], THRESHOLDS['PM3'][0], r['above'][str(THRESHOLDS['PM3'][0])]/3600.))
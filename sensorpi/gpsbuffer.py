@@ -0,0 +1,171 @@
+'''
+Time indexed ring buffer of GPS fixes.
+
+A follower thread copies each new fix from gps.last into the buffer. Each
+histogram is then given the position interpolated at the middle of its
+sampling period, with the age of the nearest real fix and its quality
+(fix type, satellites), instead of whatever fix happened to be latest.
+
+The buffer has one writer. It fills a slot before bumping the count, so
+readers only take the count and bisect without locking.
+
+Test: python3 -m sensorpi.tests gpsbuffer
+'''
+
+import time,threading
+from datetime import datetime
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+SIZE = 1200 # 10 minutes of fixes at 2 Hz
+
+# names the fix type and satellite count may have in gps.last
+FIX_KEYS = ('fix','fixtype','qual','quality')
+NSAT_KEYS = ('nsat','sats','satellites','numsats')
+
+NOFIX = {'gpstime':'000000','lat':'','lon':'','alt':'','age':'','fix':'','nsat':''}
+
+
+def fixtime(gpstime, now=None):
+    '''
+    Unix time of a HHMMSS gps time stamp, taking the date from now (utc).
+    Stamps more than 12 h ahead of now are from the previous day.
+    '''
+    if now is None: now = time.time()
+    day = int(now)//86400*86400
+    t = day + int(gpstime[0:2])*3600 + int(gpstime[2:4])*60 + float(gpstime[4:] or 0)
+    if t - now > 43200: t -= 86400
+    return t
+
+
+def first(fix, keys):
+    for k in keys:
+        if k in fix: return fix[k]
+    return ''
+
+
+class FixBuffer(object):
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        self.times = [0.]*size
+        self.fixes = [None]*size
+        self.count = 0
+
+    def append(self, t, fix):
+        '''
+        Add a fix at unix time t. Fixes must arrive in time order.
+        '''
+        n = self.count
+        if n and t <= self.times[(n-1)%self.size]: return False
+        i = n % self.size
+        self.times[i] = t
+        self.fixes[i] = fix
+        self.count = n+1
+        return True
+
+    def latest(self):
+        n = self.count
+        if not n: return None
+        i = (n-1)%self.size
+        return self.times[i],self.fixes[i]
+
+    def _bisect(self, t, lo, hi):
+        ''' first logical index in [lo,hi) with time > t '''
+        times,size = self.times,self.size
+        while lo < hi:
+            mid = (lo+hi)//2
+            if times[mid%size] > t: hi = mid
+            else: lo = mid+1
+        return lo
+
+    def at(self, t):
+        '''
+        Position at unix time t, interpolated between the fixes either side.
+        Outside the buffered span the nearest fix is returned unchanged.
+        age is the time in seconds to the nearest real fix.
+        '''
+        n = self.count
+        if not n: return dict(NOFIX)
+        lo = max(0, n-self.size)
+        k = self._bisect(t, lo, n)
+        size = self.size
+
+        if k == lo or k == n:
+            i = (lo if k == lo else n-1) % size
+            ta,fa = self.times[i],self.fixes[i]
+            loc = dict(fa)
+            age = abs(t-ta)
+        else:
+            ta,fa = self.times[(k-1)%size],self.fixes[(k-1)%size]
+            tb,fb = self.times[k%size],self.fixes[k%size]
+            w = (t-ta)/(tb-ta)
+            loc = dict(fa if w < .5 else fb)
+            for c in ('lat','lon','alt'):
+                try: loc[c] = round(float(fa[c]) + w*(float(fb[c])-float(fa[c])), 7)
+                except (KeyError,ValueError,TypeError): pass
+            age = min(t-ta, tb-t)
+
+        loc['gpstime'] = datetime.utcfromtimestamp(t).strftime('%H%M%S')
+        loc['age'] = round(age,1)
+        loc['fix'] = first(loc,FIX_KEYS)
+        loc['nsat'] = first(loc,NSAT_KEYS)
+        return loc
+
+
+def follow(buffer, gps, interval=.5):
+    '''
+    Start a daemon thread copying new fixes from gps.last into buffer.
+    Looks gps.last up on every poll so a restarted gps daemon is picked up.
+    '''
+    def run():
+        last = None
+        while True:
+            time.sleep(interval)
+            fix = getattr(gps,'last',None) or {}
+            stamp = fix.get('gpstime','')
+            if stamp == last or not fix.get('lat') or len(stamp) < 6: continue
+            last = stamp
+            try:
+                buffer.append(fixtime(stamp), fix.copy())
+            except ValueError as e:
+                log.debug('bad gps fix {} - {}'.format(stamp,e))
+
+    t = threading.Thread(target=run, name='gpsbuffer')
+    t.daemon = True
+    t.start()
+    return t
+
+
+class Receiver(object):
+    '''
+    The SensorMod gps daemon thread, stopped and started around journeys,
+    with a watchdog stage armed while it runs. reinit() is the stage's
+    recover function: a new daemon, and the stage armed again so the probe
+    sees its fixes.
+    '''
+
+    def __init__(self, gps, stage='gps'):
+        self.gps = gps
+        self.stage = stage
+        self.watchdog = None
+        self.daemon = gps.init(wait=False)
+
+    def start(self):
+        if self.daemon: log.debug('GPS alive = {}'.format(self.daemon.is_alive()))
+        if self.daemon and not self.daemon.is_alive():
+            self.daemon = self.gps.init(wait=False)
+        if self.daemon and self.watchdog: self.watchdog.arm(self.stage)
+
+    def stop(self):
+        if self.watchdog: self.watchdog.idle(self.stage)
+        if self.daemon and self.daemon.is_alive(): self.gps.stop_event.set()
+
+    def reinit(self):
+        self.stop()
+        if self.daemon:
+            self.daemon.join(5)
+            if self.daemon.is_alive(): log.warning('GPS daemon did not stop, starting another')
+        self.daemon = self.gps.init(wait=False)
+        if self.daemon and self.watchdog: self.watchdog.arm(self.stage)
@@ -0,0 +1,233 @@
+'''
+PM maps: decrypted samples binned onto a lat/lon grid.
+
+A Grid accumulates, per cell and time of day slice, the sample count, the
+sum and sum of squares of PM (for mean and std) and a fixed log spaced
+histogram of PM as a percentile sketch. All of these are plain sums, so
+grids built from different sensors, days or partitions add together
+exactly (merge()); a map is updated by gridding only the rows added to the
+partitions since it last saw them and merging them in. Points are added in
+NumPy chunks with bincount, so memory is the size of the grid whatever the
+number of points.
+
+The grid is saved as a compressed .npz: the accumulator arrays, its
+geometry, the list of sources (partition names) merged in and, for each,
+the (count, max rowid) of the partition when it was last gridded.
+
+Usage:
+    python3 -m sensorpi.gridding update MAP.npz PRIVATE_KEY.pem   (grid any new rows into MAP)
+    python3 -m sensorpi.gridding show MAP.npz [percentile]
+'''
+
+import os,sys,sqlite3
+import numpy as np
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+# Bradford
+BOUNDS = (53.70, 53.90, -1.90, -1.60) # lat0, lat1, lon0, lon1
+CELL = 100.                           # m
+SLICES = (0, 7, 9, 15, 18, 24)        # hour of day (UTC) edges: night, school run, day, school run, evening
+SKETCH = (0.1, 1000., 48)             # ug/m3 - percentile sketch range and bins (about 21% wide)
+FIELD = 'PM3'                         # PM2.5 column
+
+
+class Grid(object):
+
+    def __init__(self, bounds=BOUNDS, cell=CELL, slices=SLICES, sketch=SKETCH):
+        self.bounds = tuple(float(b) for b in bounds)
+        self.cell = float(cell)
+        self.slices = np.asarray(slices, dtype=np.float64)
+        self.sketch = tuple(sketch)
+        lat0,lat1,lon0,lon1 = self.bounds
+        self.dlat = self.cell/111320.
+        self.dlon = self.cell/(111320.*np.cos(np.radians((lat0+lat1)/2.)))
+        self.shape = (len(self.slices)-1,
+                      int(np.ceil((lat1-lat0)/self.dlat)),
+                      int(np.ceil((lon1-lon0)/self.dlon)))
+        lo,hi,n = self.sketch
+        # bin 0 and n+1 catch values below and above the range
+        self.edges = np.logspace(np.log10(lo), np.log10(hi), int(n)+1)
+        self.count = np.zeros(self.shape, np.uint32)
+        self.sum = np.zeros(self.shape)
+        self.sumsq = np.zeros(self.shape)
+        self.hist = np.zeros(self.shape+(int(n)+2,), np.uint32)
+        self.sources = []
+        self.marks = {} # source: (count, max rowid) gridded
+
+    @property
+    def cells(self):
+        return int(np.prod(self.shape))
+
+    def geometry(self):
+        return (self.bounds, self.cell, tuple(self.slices), self.sketch)
+
+    ## accumulating
+
+    def add(self, lat, lon, pm, unixtime):
+        '''
+        Add arrays of points. Points off the grid, without a fix or without
+        a PM value are skipped. Returns the number added.
+        '''
+        lat,lon,pm = np.asarray(lat,float),np.asarray(lon,float),np.asarray(pm,float)
+        hour = (np.asarray(unixtime) % 86400)/3600.
+        lat0,lat1,lon0,lon1 = self.bounds
+        i = np.floor((lat-lat0)/self.dlat)
+        j = np.floor((lon-lon0)/self.dlon)
+        ok = np.isfinite(pm) & (i >= 0) & (i < self.shape[1]) & (j >= 0) & (j < self.shape[2])
+        if not ok.any(): return 0
+        s = np.searchsorted(self.slices, hour[ok], 'right') - 1
+        flat = (s*self.shape[1] + i[ok].astype(np.int64))*self.shape[2] + j[ok].astype(np.int64)
+        v = pm[ok]
+        n = self.cells
+        self.count += np.bincount(flat, minlength=n).reshape(self.shape).astype(np.uint32)
+        self.sum += np.bincount(flat, v, minlength=n).reshape(self.shape)
+        self.sumsq += np.bincount(flat, v*v, minlength=n).reshape(self.shape)
+        # the sketch is too big for a dense bincount per chunk, so count the occupied bins only
+        nb = self.hist.shape[-1]
+        cells,counts = np.unique(flat*nb + np.searchsorted(self.edges, v, 'right'), return_counts=True)
+        self.hist.reshape(-1)[cells] += counts.astype(np.uint32)
+        return int(ok.sum())
+
+    def add_chunks(self, chunks, field=FIELD):
+        ''' add decoded.chunks() output '''
+        total = 0
+        for c in chunks:
+            total += self.add(c['lat'], c['lon'], c[field], c['UNIXTIME'])
+        return total
+
+    def merge(self, other):
+        if other.geometry() != self.geometry():
+            raise ValueError('grids have different geometry')
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.hist += other.hist
+        self.sources += [s for s in other.sources if s not in self.sources]
+        self.marks.update(other.marks)
+        return self
+
+    ## maps - each (slices, rows, cols), NaN where there is no data; axis=0 for all day
+
+    def _total(self, a, axis):
+        return a if axis is None else a.sum(axis=axis)
+
+    def mean(self, axis=None):
+        count = self._total(self.count, axis).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, self._total(self.sum, axis)/count, np.nan)
+
+    def std(self, axis=None):
+        count = self._total(self.count, axis).astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            m = self._total(self.sum, axis)/count
+            var = self._total(self.sumsq, axis)/count - m*m
+            return np.where(count > 0, np.sqrt(np.maximum(var,0)), np.nan)
+
+    def percentile(self, q, axis=None):
+        '''
+        q-th percentile from the sketch, to within one sketch bin (the
+        geometric middle of the bin it falls in).
+        '''
+        hist = self._total(self.hist, axis)
+        cum = np.cumsum(hist, axis=-1)
+        total = cum[...,-1]
+        rank = np.ceil(q/100.*total)
+        b = (cum < rank[...,None]).sum(axis=-1)
+        e = self.edges
+        mids = np.concatenate(([e[0]], np.sqrt(e[:-1]*e[1:]), [e[-1]]))
+        return np.where(total > 0, mids[np.minimum(b,len(mids)-1)], np.nan)
+
+    def centres(self):
+        ''' lat and lon of the cell centres '''
+        lat0,lat1,lon0,lon1 = self.bounds
+        return (lat0 + (np.arange(self.shape[1])+.5)*self.dlat,
+                lon0 + (np.arange(self.shape[2])+.5)*self.dlon)
+
+    ## files
+
+    def save(self, path):
+        np.savez_compressed(path, count=self.count, sum=self.sum, sumsq=self.sumsq, hist=self.hist,
+                            bounds=self.bounds, cell=self.cell, slices=self.slices,
+                            sketch=np.asarray(self.sketch,float), sources=np.asarray(self.sources,dtype=str),
+                            marks=np.asarray([self.marks.get(s,(-1,-1)) for s in self.sources],np.int64).reshape(-1,2))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            lo,hi,n = f['sketch']
+            g = cls(tuple(f['bounds']), float(f['cell']), tuple(f['slices']), (lo,hi,int(n)))
+            g.count,g.sum,g.sumsq,g.hist = f['count'],f['sum'],f['sumsq'],f['hist']
+            g.sources = [str(s) for s in f['sources']]
+            if 'marks' in f:
+                g.marks = dict((s,(int(c),int(t))) for s,(c,t) in zip(g.sources,f['marks']) if c >= 0)
+        return g
+
+
+def grow(grid, partitions, private_key):
+    '''
+    Merge into grid the rows added to each partition since its mark.
+    Rollover only appends, so new rows are those above the marked max
+    rowid; False (grid part updated) if rows below it have gone.
+    '''
+    from .decoded import chunks
+    for key in partitions.keys():
+        name = os.path.basename(partitions.path(key))
+        conn = sqlite3.connect('file:%s?mode=ro'%partitions.path(key), uri=True)
+        try:
+            count,top = conn.execute('SELECT count(*),max(rowid) FROM MEASUREMENTS').fetchone()
+            top = top or 0
+            if name in grid.sources and name not in grid.marks:
+                grid.marks[name] = (count,top) # map saved before marks: taken as complete
+            gridded,since = grid.marks.get(name,(0,0))
+            if (gridded,since) == (count,top): continue
+            new, = conn.execute('SELECT count(*) FROM MEASUREMENTS WHERE rowid > ? AND rowid <= ?',
+                                (since,top)).fetchone()
+            if count - new != gridded: return False
+            part = Grid(*grid.geometry())
+            added = part.add_chunks(chunks(conn, private_key, where='WHERE rowid > ? AND rowid <= ?',
+                                           params=(since,top)))
+        finally:
+            conn.close()
+        part.sources = [name]
+        part.marks = {name:(count,top)}
+        grid.merge(part)
+        log.info('Gridded {} points of {} new rows in {}'.format(added, new, name))
+    return True
+
+
+def update(path, partitions, private_key, **geometry):
+    '''
+    Grid the rows added to the partitions since the map at path was last
+    updated and merge them in, including rows rolled late into an old
+    partition. If rows were removed from a partition the map is rebuilt.
+    '''
+    grid = Grid.load(path) if os.path.exists(path) else Grid(**geometry)
+    if not grow(grid, partitions, private_key):
+        log.warning('Rows gone from a partition since it was gridded - gridding them all again')
+        grid = Grid(*grid.geometry())
+        grow(grid, partitions, private_key)
+    grid.save(path)
+    return grid
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) >= 3 and args[0] == 'update':
+        from .SensorMod.db import __RDIR__
+        from .partition import Partitions
+        from .crypt import load_private
+        grid = update(args[1], Partitions(os.path.join(__RDIR__,'partitions')), load_private(args[2]))
+        print('%d points in %d partitions'%(grid.count.sum(), len(grid.sources)))
+    elif len(args) >= 2 and args[0] == 'show':
+        grid = Grid.load(args[1])
+        q = float(args[2]) if len(args) > 2 else 50.
+        print('%d x %d cells of %g m, %d points from %d sources'%(grid.shape[1],grid.shape[2],grid.cell,grid.count.sum(),len(grid.sources)))
+        p = grid.percentile(q)
+        for s in range(grid.shape[0]):
+            covered = grid.count[s] > 0
+            print('%02d-%02d h: %6d cells with data, median of cell p%g %.1f ug/m3'%(grid.slices[s],grid.slices[s+1],
+                covered.sum(), q, np.nanmedian(p[s]) if covered.any() else float('nan')))
+    else:
+        print(__doc__)
@@ -0,0 +1,452 @@
+'''
+Concurrent ingest service for the serverpi.
+
+Every bbsensor in the building syncs during the SCHOOL window, at much the
+same time. This asyncio server takes all of those connections at once:
+each is read without blocking, its batches queued for a single writer task
+that group commits whatever has arrived into server.db (one transaction
+for many sensors' batches) and the coverage index, and each batch is
+acknowledged once it is on disk. A sensor may have at most WINDOW batches
+waiting to be committed; past that the server stops reading its socket, so
+a fast sensor cannot crowd the others out of the queue.
+
+Wire format, both ways: a 4 byte big endian length then that many bytes
+of JSON. A sensor sends {"serial":..., "rows":[[13 MEASUREMENTS columns], ...]}
+with LOC and BINS base64 encoded, and gets {"ok": rows} (or {"error": ...})
+back per batch. A zero length frame ends the sync and is answered with the
+total.
+
+Batches are committed as they arrive, so a sync that drops partway leaves
+its first batches on disk. To make the retry safe push() also sends the
+rowids of each batch's rows and a generation for the device db (a hash of
+its first row, which changes when rebuilddb empties it). The server keeps
+the (SERIAL, GENERATION, FIRST, LAST) rowid range of every batch it commits
+in a SYNCS table, written in the same transaction as the rows, and leaves
+out rows of a range it already has: a resent batch is acknowledged without
+being stored twice.
+
+Profiling reports (profiling.py) ride along: after its rows push() sends
+each report file as {"serial":..., "report": name, "text": ...}, which the
+server writes to <reportdir>/<serial>/<name> and acknowledges with {"ok": 0}.
+The sensor deletes the files once the whole sync has been acknowledged.
+With upload.sync instead of INGEST the reports stay on the sensor.
+
+Usage:
+    python3 -m sensorpi.ingest serve [port]              (on the bbserver)
+    python3 -m sensorpi.ingest bench [sensors] [rows]    (load test on a temporary db)
+
+On a sensor, set INGEST in __main__ to (host, port) to sync through this
+instead of upload.sync.
+'''
+
+import os,re,sys,json,time,struct,base64,hashlib,sqlite3,asyncio,tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .SensorMod.log_manager import getlog
+from . import storage
+from .partition import COLUMNS
+log = getlog(__name__)
+
+PORT = 8765
+BATCH = 500      # rows per batch sent by a sensor
+WINDOW = 4       # batches a sensor may have waiting for commit
+GROUP = 5000     # rows per group commit
+QUEUE = 256      # batches queued for the writer across all sensors
+MAXFRAME = 16*1024*1024
+TIMEOUT = 60.    # seconds a sensor may stay silent mid sync
+KEEP_SYNCS = 30*86400 # seconds batch ranges are kept for recognising a resend
+
+HEADER = struct.Struct('>I')
+BLOBS = (3,9)    # LOC, BINS
+REPORT = re.compile(r'^profile_\d+\.txt$') # names of profiling report files
+
+
+def encode(row):
+    row = list(row)
+    for i in BLOBS: row[i] = base64.b64encode(bytes(row[i])).decode('ascii')
+    return row
+
+
+def decode(row):
+    if len(row) != 13: raise ValueError('expected 13 columns, got %d'%len(row))
+    for i in BLOBS: row[i] = base64.b64decode(row[i])
+    return row
+
+
+def frame(obj):
+    data = json.dumps(obj).encode('utf-8')
+    return HEADER.pack(len(data)) + data
+
+
+async def receive(reader):
+    ''' next message, or None at the end of a sync '''
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if not size: return None
+    if size > MAXFRAME: raise ValueError('frame of %d bytes'%size)
+    return json.loads((await reader.readexactly(size)).decode('utf-8'))
+
+
+########################################################
+##  Server
+########################################################
+
+class Batch(object):
+    __slots__ = ('serial','rows','done','generation','rowids')
+
+    def __init__(self, serial, rows, done, generation=None, rowids=None):
+        self.serial = serial
+        self.rows = rows
+        self.done = done
+        self.generation = generation
+        self.rowids = rowids
+
+
+class IngestServer(object):
+    '''
+    start() inside a running event loop; stop() drains the queue and closes.
+    '''
+
+    def __init__(self, dbfile, host='0.0.0.0', port=PORT, profile='sd', coverfile=None, reportdir=None):
+        self.dbfile = dbfile
+        self.coverfile = coverfile
+        self.reportdir = reportdir
+        self.coverage = None
+        self.host = host
+        self.port = port
+        self.profile = profile
+        self.executor = ThreadPoolExecutor(1) # the only thread using the db
+        self.conn = None
+        self.queue = None
+        self.clients = 0
+        self.rows = 0
+        self.commits = 0
+        self.skipped = 0 # rows of resent batches already on disk
+        self.reports = 0 # profiling reports received
+        self.syncs = []  # (serial, rows, seconds) of completed syncs
+
+    async def start(self):
+        self.queue = asyncio.Queue(QUEUE)
+        await asyncio.get_event_loop().run_in_executor(self.executor, self.open)
+        self.writing = asyncio.ensure_future(self.writer())
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info('Ingest listening on {}:{}'.format(self.host, self.port))
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.queue.put(None)
+        await self.writing
+        await asyncio.get_event_loop().run_in_executor(self.executor, self.close)
+        self.executor.shutdown()
+
+    ## writer - executor thread
+
+    def open(self):
+        from .SensorMod.db import builddb
+        self.conn = sqlite3.connect(self.dbfile, timeout=30)
+        storage.tune(self.conn, self.profile)
+        builddb.builddb(self.conn)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS SYNCS (SERIAL TEXT, GENERATION TEXT, \
+                FIRST INT, LAST INT, TIME INT)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS SYNCS_KEY ON SYNCS (SERIAL, GENERATION, LAST)')
+            self.conn.execute('DELETE FROM SYNCS WHERE TIME < ?', (int(time.time()) - KEEP_SYNCS,))
+        if self.coverfile:
+            from .coverage import Coverage
+            self.coverage = Coverage(self.coverfile)
+
+    def close(self):
+        self.conn.close()
+        if self.coverage: self.coverage.close()
+
+    def unseen(self, batch):
+        ''' the rows of a batch not in a range already committed for its sync '''
+        if batch.generation is None: return batch.rows
+        first, last = min(batch.rowids), max(batch.rowids)
+        ranges = self.conn.execute('SELECT FIRST,LAST FROM SYNCS WHERE SERIAL=? AND GENERATION=? \
+            AND LAST >= ? AND FIRST <= ?', (batch.serial, batch.generation, first, last)).fetchall()
+        self.conn.execute('INSERT INTO SYNCS VALUES (?,?,?,?,?)',
+            (batch.serial, batch.generation, first, last, int(time.time())))
+        if not ranges: return batch.rows
+        return [row for i,row in zip(batch.rowids, batch.rows) if not any(a <= i <= b for a,b in ranges)]
+
+    def commit(self, group):
+        ''' one transaction for a group of batches; returns the rows left out as resent '''
+        rows = []
+        with self.conn:
+            for batch in group: rows.extend(self.unseen(batch))
+            self.conn.executemany(storage.INSERT, rows)
+        if self.coverage: self.coverage.add_rows(rows)
+        return sum(len(b.rows) for b in group) - len(rows)
+
+    ## writer - event loop
+
+    async def writer(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.queue.get()
+            if batch is None: break
+            group = [batch]
+            count = len(batch.rows)
+            # everything that queued while the last commit ran goes in this one
+            while count < GROUP and not self.queue.empty():
+                batch = self.queue.get_nowait()
+                if batch is None:
+                    self.queue.put_nowait(None)
+                    break
+                group.append(batch)
+                count += len(batch.rows)
+            try:
+                skipped = await loop.run_in_executor(self.executor, self.commit, group)
+            except Exception as e:
+                log.error('Group commit of {} rows failed - {}'.format(count, e))
+                for b in group:
+                    if not b.done.cancelled(): b.done.set_exception(e)
+                continue
+            if skipped: log.info('{} resent rows already committed'.format(skipped))
+            self.rows += count - skipped
+            self.skipped += skipped
+            self.commits += 1
+            for b in group: # cancelled when the sensor dropped before its ack
+                if not b.done.cancelled(): b.done.set_result(len(b.rows))
+
+    ## profiling reports
+
+    def report(self, serial, name, text):
+        ''' keep a sensor's profiling report; returns a done future for the ack '''
+        done = asyncio.get_event_loop().create_future()
+        if not REPORT.match(name): raise ValueError('bad report name {!r}'.format(name))
+        if self.reportdir:
+            directory = os.path.join(self.reportdir, re.sub(r'[^\w.-]', '', serial) or 'unknown')
+            if not os.path.exists(directory): os.makedirs(directory)
+            with open(os.path.join(directory, name),'w') as f: f.write(text)
+            self.reports += 1
+            log.info('Profiling report {} from {}'.format(name, serial))
+        done.set_result(0)
+        return done
+
+    ## one connection per sensor
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        started = time.time()
+        self.clients += 1
+        window = asyncio.Semaphore(WINDOW)
+        pending = asyncio.Queue()
+        acks = asyncio.ensure_future(self.acknowledge(writer, pending, window))
+        serial = None
+        try:
+            while True:
+                await window.acquire() # flow control: stop reading at WINDOW uncommitted batches
+                message = await asyncio.wait_for(receive(reader), TIMEOUT)
+                if message is None: break
+                serial = message['serial']
+                if 'report' in message:
+                    await pending.put(Batch(serial, [], self.report(serial, message['report'], message['text'])))
+                    continue
+                rows = [decode(row) for row in message['rows']]
+                generation, rowids = message.get('generation'), message.get('rowids')
+                if generation is not None and (not rows or len(rowids) != len(rows)):
+                    raise ValueError('{} rowids for {} rows'.format(len(rowids or ()), len(rows)))
+                batch = Batch(serial, rows, asyncio.get_event_loop().create_future(), generation, rowids)
+                await self.queue.put(batch)
+                await pending.put(batch)
+            await pending.put(None)
+            total = await acks
+            self.syncs.append((serial, total, time.time()-started))
+            log.info('Sync from {} {}: {} rows in {:.2f} s'.format(serial, peer, total, time.time()-started))
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError) as e:
+            log.warning('Sync from {} {} dropped - {!r}'.format(serial, peer, e))
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning('Bad batch from {} {} - {}'.format(serial, peer, e))
+            writer.write(frame({'error':str(e)}))
+        finally:
+            acks.cancel()
+            self.clients -= 1
+            writer.close()
+
+    async def acknowledge(self, writer, pending, window):
+        ''' ack batches in order as they commit; the final ack carries the total '''
+        total = 0
+        while True:
+            batch = await pending.get()
+            if batch is None:
+                writer.write(frame({'ok':total}))
+                await writer.drain()
+                return total
+            try:
+                n = await batch.done
+                total += n
+                writer.write(frame({'ok':n}))
+            except Exception as e:
+                writer.write(frame({'error':str(e)}))
+            await writer.drain()
+            window.release()
+
+
+########################################################
+##  Client
+########################################################
+
+async def sync(host, port, serial, rows, batch=BATCH, window=WINDOW, generation=None, reports=()):
+    '''
+    Send rows (MEASUREMENTS tuples) to an ingest server, keeping up to window
+    batches in flight. Returns the number of rows the server committed;
+    raises IOError if it refused a batch. With a generation each row is
+    (rowid,) + the MEASUREMENTS tuple, and resent rows are not stored twice.
+    reports are (name, text) pairs sent after the rows.
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        inflight = 0
+
+        async def ack():
+            reply = await receive(reader)
+            if reply is None or 'error' in reply:
+                raise IOError('ingest refused a batch: {}'.format(reply and reply['error']))
+            return reply['ok']
+
+        def message(chunk):
+            if generation is None: return frame({'serial':serial, 'rows':[encode(row) for row in chunk]})
+            return frame({'serial':serial, 'rows':[encode(row[1:]) for row in chunk],
+                          'generation':generation, 'rowids':[row[0] for row in chunk]})
+
+        async def send(data):
+            nonlocal inflight
+            if inflight == window:
+                await ack()
+                inflight -= 1
+            writer.write(data)
+            await writer.drain()
+            inflight += 1
+
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) < batch: continue
+            await send(message(chunk))
+            chunk = []
+        if chunk: await send(message(chunk))
+        for name,text in reports:
+            await send(frame({'serial':serial, 'report':name, 'text':text}))
+        writer.write(HEADER.pack(0))
+        await writer.drain()
+        for i in range(inflight): await ack()
+        return await ack()
+    finally:
+        writer.close()
+
+
+def generation(conn):
+    ''' names the device db's MEASUREMENTS until a rebuild: a hash of its first row '''
+    row = conn.execute('SELECT * FROM MEASUREMENTS ORDER BY rowid LIMIT 1').fetchone()
+    return hashlib.sha256(repr(row).encode('utf-8')).hexdigest()[:16]
+
+
+def push(SERIAL, conn, host, port=PORT, reportdir=None):
+    '''
+    Drop in for upload.sync: send every MEASUREMENTS row of the device db,
+    and the profiling reports in reportdir. True if the server committed
+    all of them; the sent reports are then removed. Safe to repeat after a
+    failure: rows already committed are not stored again.
+    '''
+    count, = conn.execute('SELECT count(*) FROM MEASUREMENTS').fetchone()
+    cursor = conn.execute('SELECT rowid,%s FROM MEASUREMENTS ORDER BY rowid'%COLUMNS)
+    names = sorted(f for f in os.listdir(reportdir) if REPORT.match(f)) \
+        if reportdir and os.path.exists(reportdir) else []
+    reports = []
+    for name in names:
+        with open(os.path.join(reportdir,name),'r') as f: reports.append((name, f.read()))
+    loop = asyncio.new_event_loop()
+    try:
+        sent = loop.run_until_complete(sync(host, port, SERIAL, cursor,
+                                            generation=generation(conn), reports=reports))
+    finally:
+        loop.close()
+    log.info('Synced {} of {} rows and {} reports to {}:{}'.format(sent, count, len(reports), host, port))
+    if sent != count: return False
+    for name in names: os.remove(os.path.join(reportdir,name))
+    return True
+
+
+########################################################
+##  Load generator
+########################################################
+
+def fake_rows(serial, n, start=1.6e9):
+    import pickle
+    bins = pickle.dumps([float(i) for i in range(16)])
+    loc = os.urandom(64)
+    return [(serial, 2, '120000', loc, 1., 2., 3., 20., 50., bins, 1., i, int(start+i)) for i in range(n)]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(p/100.*len(values)))]
+
+
+async def bench(sensors=30, rows=2000, dbfile=None):
+    '''
+    Start a server on a temporary db and sync sensors simulated sensors at
+    once. Returns a dict of rows/s, p50/p99 sync seconds and commits.
+    '''
+    tmp = None
+    if dbfile is None:
+        tmp = tempfile.mkdtemp()
+        dbfile = os.path.join(tmp,'server.db')
+    server = IngestServer(dbfile, '127.0.0.1', 0)
+    await server.start()
+    data = [fake_rows('sensor%02d'%i, rows) for i in range(sensors)]
+    times = []
+
+    async def one(i):
+        t = time.time()
+        sent = await sync('127.0.0.1', server.port, 'sensor%02d'%i, data[i])
+        times.append(time.time()-t)
+        return sent
+
+    began = time.time()
+    sent = await asyncio.gather(*[one(i) for i in range(sensors)])
+    elapsed = time.time()-began
+    await server.stop()
+
+    conn = sqlite3.connect(dbfile)
+    stored, = conn.execute('SELECT count(*) FROM MEASUREMENTS').fetchone()
+    conn.close()
+    if tmp:
+        for f in os.listdir(tmp): os.remove(os.path.join(tmp,f))
+        os.rmdir(tmp)
+    return {'sensors':sensors, 'rows':sum(sent), 'stored':stored, 'seconds':elapsed,
+            'rows_per_s':sum(sent)/elapsed, 'p50':percentile(times,50), 'p99':percentile(times,99),
+            'commits':server.commits}
+
+
+def serve(port=PORT):
+    from .SensorMod.db import __RDIR__
+    loop = asyncio.new_event_loop()
+    server = IngestServer(os.path.join(__RDIR__,'server.db'), port=port,
+                          coverfile=os.path.join(__RDIR__,'coverage.db'),
+                          reportdir=os.path.join(__RDIR__,'profiles'))
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
+        loop.close()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == 'serve':
+        serve(int(args[1]) if len(args) > 1 else PORT)
+    elif args and args[0] == 'bench':
+        sensors = int(args[1]) if len(args) > 1 else 30
+        rows = int(args[2]) if len(args) > 2 else 2000
+        r = asyncio.new_event_loop().run_until_complete(bench(sensors, rows))
+        print('{sensors} sensors, {rows} rows in {seconds:.2f} s: {rows_per_s:.0f} rows/s, '
+              'sync p50 {p50:.2f} s p99 {p99:.2f} s, {commits} group commits'.format(**r))
+    else:
+        print(__doc__)
@@ -0,0 +1,140 @@
+'''
+The sampling cycle and the day schedule state machine.
+
+run() switches between en route (fast sampling), SCHOOL (slow sampling and
+uploads) and NIGHT (asleep), or runs continuously on static sensors and
+the serverpi. It is driven by a node holding the running parameters and
+actions - the sensorpi.__main__ module itself when deployed, or
+replay.SimNode with a VirtualClock for testing - and a clock, so no call
+in here touches the hardware or the wall clock directly.
+
+A node provides:
+    SAMPLE_LENGTH, SAMPLE_LENGTH_fast, SAMPLE_LENGTH_slow, NIGHT, SCHOOL,
+    TYPE, CSV, CONTINUOUS, STOP, hour
+    cycle(SAMPLE_LENGTH), idle(), standby(), checkpoint(), mode(name),
+    gps_stop(), gps_start(), upload_to_server(DATE), update(DATE),
+    stagedata(DATE), upload_to_external(DATE)
+'''
+
+
+def runcycle(alpha, SAMPLE_LENGTH, SAMPLING_DELAY, measurement, clock, stopped=lambda:False, show=None, results=None, rate=None):
+    '''
+    Power the OPC and read a histogram every SAMPLING_DELAY seconds for
+    SAMPLE_LENGTH seconds. measurement(pm, now) turns each into a row
+    (None to discard), appended to results (a list, or a CycleBuffer).
+    With an adaptive.RateController as rate, the delay comes from it instead.
+    A dutycycle.DutyCycle as alpha may still be running from the last cycle
+    (warm), and marks histograms read during its warm-up as not valid.
+    Returns results.
+    '''
+    if results is None: results = []
+
+    warm = getattr(alpha, 'warm', False)
+    alpha.on()
+    if not warm:
+        clock.sleep(1)
+    start = clock.time()
+    if not warm:
+        alpha.pm() # remove first value
+    while clock.time()-start < SAMPLE_LENGTH:
+        now = clock.utcnow()
+
+        # sampling delay
+        clock.sleep(rate.delay if rate else SAMPLING_DELAY) # keep as 1
+
+        pm = alpha.histogram()
+        if rate: rate.update(pm, clock.time())
+        row = measurement(pm, now) if getattr(alpha, 'valid', True) else None
+        if row is not None:  #if there are results.
+            results.append(row)
+            if show: show(row)
+
+        if stopped():
+            break
+
+    alpha.off()
+    if not getattr(alpha, 'warm', False):
+        clock.sleep(1)# Let the rpi turn off the fan
+    return results
+
+
+def run(node, clock):
+    '''
+    Main loop. Returns when node.STOP is set.
+    '''
+    while True:
+
+        if node.SAMPLE_LENGTH>0:
+            node.cycle(node.SAMPLE_LENGTH)
+
+        if node.STOP:
+            node.idle()
+            break
+
+        now = clock.now()
+        node.hour = hour = now.hour
+        DATE = now.strftime("%d/%m/%Y")
+
+        if node.CSV:
+            node.mode('CSV')
+
+        elif node.CONTINUOUS:
+
+            node.idle()
+
+            if (hour > node.SCHOOL[0]) and (hour < node.SCHOOL[1]):
+                ''' at school - try upload'''
+                node.mode('SCHOOL')
+                node.checkpoint() # idle window
+
+                if node.TYPE == 3:
+                    node.stagedata(DATE)
+                else:
+                    node.upload_to_server(DATE)
+                    node.update(DATE)
+
+            else:
+                node.mode('CONTINUOUS')
+
+                if node.TYPE == 3:
+                    node.upload_to_external(DATE)
+                    node.update(DATE)
+
+        else:
+
+            node.idle()
+
+            if (hour > node.NIGHT[0]) or (hour < node.NIGHT[1]): #>18 | <7
+                ''' hometime - SLEEP '''
+                node.mode('NIGHT')
+                node.gps_stop()
+                node.SAMPLE_LENGTH = -1 # Dont run !  SAMPLE_LENGTH_slow
+                node.standby()
+                node.checkpoint() # idle window
+                clock.sleep(30*60) # sleep 0.5h
+                node.TYPE = 4
+
+            elif (hour > node.SCHOOL[0]) and (hour < node.SCHOOL[1]): # >7 <9 & >15 <18 utc (9-15)
+                ''' at school - try upload'''
+                node.mode('SCHOOL')
+                node.checkpoint() # idle window
+                node.gps_stop()
+
+                node.upload_to_server(DATE)
+                node.update(DATE)
+
+                node.SAMPLE_LENGTH = node.SAMPLE_LENGTH_slow
+
+                node.standby()
+                # check if we are trying to stop the device every minute
+                for i in range(14):
+                    clock.sleep(60)
+                    if node.STOP:break
+
+                node.TYPE = 4
+
+            else:
+                node.mode('ENROUTE')
+                node.gps_start()
+                node.SAMPLE_LENGTH = node.SAMPLE_LENGTH_fast
+                node.TYPE = 2
@@ -0,0 +1,222 @@
+'''
+Concurrent acquisition from several OPCs on one Pi.
+
+Each registered instrument gets its own thread and schedule (a histogram
+every SAMPLING_DELAY seconds, drift free). Rows are handed to a single
+writer in the calling thread, which batches them into the db, so the
+sqlite connection never leaves the main thread.
+
+A read that never returns cannot hold up the cycle: HANG seconds after
+the cycle should have ended run() stops waiting, flags the instrument as
+hung and leaves its thread behind. A hung instrument is left out of the
+next cycles (it is not switched on or off either) until its read returns.
+
+Given a watchdog, each instrument heartbeats its own stage (its stage
+attribute, sampler-<name>) after every read, so one hung OPC is not
+masked by the others, and is left armed once abandoned so that only that
+OPC is re-initialised.
+
+The first OPC's rows keep the Pi's SERIAL, so a Pi that gains a second
+OPC is still the same sensor to coverage, uploads and analysis. Every
+further OPC is a sensor of its own, with the id serial(pi serial, name):
+the Pi's 16 hex digits, '-' and the instrument name (e.g.
+00000000abcdef01-b), which is what its rows carry in SERIAL.
+
+Usage from __main__:
+    instruments = [Instrument('a', R1.alpha), Instrument('b', spi_opc(0,1), serial(SERIAL,'b'))]
+    rows = run(instruments, SAMPLE_LENGTH, SAMPLING_DELAY, measurement, write, clock=clock)
+
+Test: python3 -m sensorpi.tests multiopc
+'''
+
+import threading
+from datetime import datetime
+
+try: import queue
+except ImportError: import Queue as queue
+
+from .cyclebuffer import CycleBuffer
+from .clock import clock as wallclock
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+BATCH = 64       # rows per insert
+FLUSH = 10.      # seconds before a part batch is written
+HANG = 30.       # seconds past the end of a cycle before a read still running is abandoned
+
+
+def spi_opc(bus, device, speed=500000):
+    '''
+    Open an additional OPC-R1 on /dev/spidev<bus>.<device> (a second chip
+    select or a USB-SPI bridge exposed as spidev).
+    '''
+    import spidev, opc
+    spi = spidev.SpiDev()
+    spi.open(bus, device)
+    spi.mode = 1
+    spi.max_speed_hz = speed
+    return opc.OPCR1(spi)
+
+
+def serial(pi, name):
+    ''' the SERIAL of an additional OPC called name on the Pi with SERIAL pi '''
+    return '%s-%s'%(pi.strip().strip('\0'), name)
+
+
+class Instrument(object):
+    '''
+    One OPC and its timing metrics. serial replaces the SERIAL of its rows
+    (None for the Pi's own OPC, whose rows are left as measurement() made them).
+    '''
+
+    def __init__(self, name, alpha, serial=None):
+        self.name = name
+        self.alpha = alpha
+        self.serial = serial
+        self.clock = wallclock # run() sets its own
+        self.stage = 'sampler-'+name
+        self.watchdog = None
+        self.publish = None
+        self.batch = CycleBuffer(BATCH)
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        self.reads = 0
+        self.rows = 0
+        self.errors = 0
+        self.latency = 0.
+        self.max_latency = 0.
+        self.late = 0      # schedule slots missed because a read overran
+        self.started = self.clock.time()
+
+    def hung(self):
+        ''' still in a read abandoned by an earlier cycle '''
+        return self.thread is not None and self.thread.is_alive()
+
+    def metrics(self):
+        elapsed = max(self.clock.time()-self.started, 1e-9)
+        return {'name':self.name, 'reads':self.reads, 'rows':self.rows, 'errors':self.errors,
+                'late':self.late, 'hung':self.hung(), 'rows_per_s':self.rows/elapsed,
+                'mean_latency':self.latency/max(self.reads,1), 'max_latency':self.max_latency}
+
+    def acquire(self, SAMPLE_LENGTH, SAMPLING_DELAY, measurement, out, stop):
+        '''
+        Thread body: read a histogram every SAMPLING_DELAY s until the cycle ends.
+        '''
+        try:
+            self.sample(SAMPLE_LENGTH, SAMPLING_DELAY, measurement, out, stop)
+        finally:
+            if self.watchdog: self.watchdog.idle(self.stage)
+
+    def sample(self, SAMPLE_LENGTH, SAMPLING_DELAY, measurement, out, stop):
+        clock = self.clock
+        start = clock.time()
+        slot = 1
+        while not stop.is_set():
+            wait = start + slot*SAMPLING_DELAY - clock.time()
+            if wait > 0:
+                if clock.wait(stop, wait): break
+            else:
+                missed = int(-wait//SAMPLING_DELAY)
+                self.late += missed
+                slot += missed
+            slot += 1
+            if clock.time() - start >= SAMPLE_LENGTH: break
+
+            now = clock.time()
+            try:
+                pm = self.alpha.histogram()
+            except Exception as e:
+                self.errors += 1
+                log.error('{} read failed - {}'.format(self.name,e))
+                continue
+            took = clock.time() - now
+            if self.watchdog: self.watchdog.beat(self.stage)
+            self.reads += 1
+            self.latency += took
+            self.max_latency = max(self.max_latency,took)
+
+            row = measurement(pm, datetime.utcfromtimestamp(now))
+            if row is None: continue
+            if self.serial: row[0] = self.serial
+            if self.publish: self.publish(row)
+            self.rows += 1
+            out.put((self.name,row))
+
+
+def flush(batches, write):
+    n = 0
+    for batch in batches.values():
+        if not len(batch): continue
+        write(batch)
+        n += len(batch)
+        batch.reset()
+    return n
+
+
+def run(instruments, SAMPLE_LENGTH, SAMPLING_DELAY, measurement, write, stopped=lambda:False, clock=wallclock,
+        watchdog=None, publish=None):
+    '''
+    Run one sampling cycle on every instrument at once.
+
+    measurement(pm, now) builds a db row (or None to skip) from a histogram;
+    write(batch) stores a CycleBuffer, whose header carries the instrument's
+    SERIAL. stopped() is polled so the GPIO stop still works. watchdog
+    (see watchdog.py) gets a heartbeat on each instrument's stage, and
+    publish(row) each row once it carries its instrument's SERIAL.
+    Returns the number of rows written.
+    '''
+    rows = queue.Queue()
+    stop = threading.Event()
+
+    for inst in instruments:
+        if inst.hung(): log.error('{} is still in a read from an earlier cycle - left out'.format(inst.name))
+    instruments = [inst for inst in instruments if not inst.hung()]
+    for inst in instruments:
+        inst.alpha.on()
+    clock.sleep(1)
+    for inst in instruments:
+        inst.alpha.pm() # remove first value
+        inst.clock = clock
+        inst.watchdog = watchdog
+        inst.publish = publish
+        if watchdog: watchdog.beat(inst.stage)
+        inst.reset()
+        inst.thread = threading.Thread(target=inst.acquire, name='opc-'+inst.name,
+                                       args=(SAMPLE_LENGTH,SAMPLING_DELAY,measurement,rows,stop))
+        inst.thread.daemon = True
+        inst.thread.start()
+    deadline = clock.time() + SAMPLE_LENGTH + HANG
+
+    # one buffer per instrument, as its SERIAL is the buffer header
+    batches = dict((inst.name,inst.batch) for inst in instruments)
+    written = 0
+    pending = 0
+    flushed = clock.time()
+    running = instruments
+    while running or not rows.empty():
+        try:
+            name,row = rows.get(timeout=.5)
+            batches[name].append(row)
+            pending += 1
+        except queue.Empty:
+            pass
+        if stopped(): stop.set()
+        running = [inst for inst in running if inst.thread.is_alive()]
+        if running and clock.time() > deadline:
+            stop.set()
+            for inst in running:
+                log.error('{} read has not returned {:.0f} s after the cycle ended - abandoned'.format(inst.name, HANG))
+            running = []
+        if pending >= BATCH or (pending and clock.time()-flushed > FLUSH):
+            written += flush(batches, write)
+            pending = 0
+            flushed = clock.time()
+    written += flush(batches, write)
+
+    for inst in instruments:
+        if not inst.hung(): inst.alpha.off()
+        log.info('{name}: {rows} rows {rows_per_s:.2f}/s, read {mean_latency:.3f}s mean {max_latency:.3f}s max, {late} late, {errors} errors, hung {hung}'.format(**inst.metrics()))
+    clock.sleep(1)# Let the rpi turn off the fan
+    return written
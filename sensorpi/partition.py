@@ -0,0 +1,291 @@
+'''
+Time partitioned measurement storage for the serverpi.
+
+Rows are kept in one SQLite file per day (or week) under __RDIR__/partitions,
+so retention and offload are a file delete or move instead of a DROP TABLE
+that rewrites the whole of server.db. server.db stays as the landing
+database: rebuilddb rolls its rows over into the partitions once they have
+been staged.
+
+Query a time range as a single MEASUREMENTS table with
+
+    conn = Partitions(directory).view(start,end)
+    conn.execute('SELECT SERIAL,count(*) FROM MEASUREMENTS GROUP BY SERIAL')
+
+which attaches only the partitions overlapping [start,end). Days keeps
+track of which days a derived database (exposure.db, anomaly.db) has
+computed, and from which version of their partition.
+
+Usage: python3 -m sensorpi.partition [keep]   (lists partitions, expires uploaded ones older than keep periods)
+'''
+
+import os,glob,time,hashlib,sqlite3,shutil
+from datetime import datetime
+
+from .SensorMod.log_manager import getlog
+from .SensorMod.db import builddb
+from . import storage
+log = getlog(__name__)
+
+PERIODS = {'day':86400, 'week':7*86400}
+# 1970-01-01 was a Thursday; shift so weeks start on a Monday
+OFFSETS = {'day':0, 'week':3*86400}
+
+COLUMNS = 'SERIAL,TYPE,TIME,LOC,PM1,PM3,PM10,T,RH,BINS,SP,RC,UNIXTIME'
+
+
+def fingerprint(conn, rowid):
+    ''' hash of a landing row, None if there is no such row '''
+    row = conn.execute('SELECT rowid,%s FROM main.MEASUREMENTS WHERE rowid = ?'%COLUMNS,(rowid,)).fetchone()
+    return None if row is None else hashlib.sha256(repr(row).encode('utf-8')).hexdigest()
+
+
+class Partitions(object):
+    '''
+    A directory of measurements_<YYYYMMDD>.db files, one per period.
+    '''
+
+    def __init__(self, directory, period='day', profile='sd'):
+        self.directory = directory
+        self.period = PERIODS[period]
+        self.offset = OFFSETS[period]
+        self.profile = profile
+        self.watermark = os.path.join(directory,'.uploaded')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    ## naming
+
+    def key(self, unixtime):
+        ''' start of the period containing unixtime '''
+        return (int(unixtime) + self.offset)//self.period*self.period - self.offset
+
+    def path(self, key):
+        return os.path.join(self.directory,'measurements_%s.db'%datetime.utcfromtimestamp(key).strftime('%Y%m%d'))
+
+    def keys(self, start=None, end=None):
+        '''
+        Sorted keys of existing partitions overlapping [start,end).
+        '''
+        found = []
+        for f in glob.glob(os.path.join(self.directory,'measurements_*.db')):
+            stamp = os.path.basename(f)[13:21]
+            key = int((datetime.strptime(stamp,'%Y%m%d') - datetime(1970,1,1)).total_seconds())
+            if start is not None and key + self.period <= start: continue
+            if end is not None and key >= end: continue
+            found.append(key)
+        return sorted(found)
+
+    ## writing
+
+    def connect(self, key):
+        '''
+        Open (creating if needed) the partition for key.
+        '''
+        path = self.path(key)
+        new = not os.path.exists(path)
+        conn = sqlite3.connect(path)
+        if new:
+            storage.tune(conn,self.profile)
+            builddb.builddb(conn)
+            log.info('New partition {}'.format(path))
+        return conn
+
+    def insert(self, rows):
+        '''
+        Route rows to their partitions by UNIXTIME (last column).
+        '''
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.key(row[-1]),[]).append(row)
+        for key,group in groups.items():
+            conn = self.connect(key)
+            storage.insert(conn,group)
+            conn.close()
+        return sum(len(g) for g in groups.values())
+
+    def rollover(self, conn):
+        '''
+        Move every row from the landing database into the partitions and
+        clear it. Each partition is filled with one INSERT ... SELECT on an
+        attached file and the landing rows are deleted in the same
+        transaction, but with the landing db in WAL mode that transaction
+        is only atomic per file: a power cut can keep the partition's
+        commit and lose the landing DELETE. So each partition also records
+        in ROLLOVERS the highest landing rowid it took and a fingerprint of
+        that row. If the row is still in the landing db the DELETE was
+        lost, and the rows up to it are deleted without being copied
+        again. (Rowids only go above the current maximum, so rows below a
+        surviving row cannot be new ones.)
+        '''
+        top, = conn.execute('SELECT max(rowid) FROM MEASUREMENTS').fetchone()
+        if top is None: return 0
+        keys = conn.execute('SELECT DISTINCT (CAST(UNIXTIME AS INTEGER) + ?)/?*? - ? FROM MEASUREMENTS \
+            WHERE rowid <= ? AND UNIXTIME IS NOT NULL',(self.offset,self.period,self.period,self.offset,top)).fetchall()
+
+        moved = 0
+        for key, in keys:
+            self.connect(key).close()
+            conn.commit()
+            conn.execute('ATTACH DATABASE ? AS part',(self.path(key),))
+            try:
+                with conn:
+                    conn.execute('CREATE TABLE IF NOT EXISTS part.ROLLOVERS (TOP INT, ROW TEXT, TIME INT)')
+                    last = conn.execute('SELECT TOP,ROW FROM part.ROLLOVERS ORDER BY rowid DESC LIMIT 1').fetchone()
+                    done = last[0] if last and fingerprint(conn, last[0]) == last[1] else 0
+                    if done: log.warning('Rows up to {} already in {}: not copied again'.format(done, self.path(key)))
+                    ktop, = conn.execute('SELECT max(rowid) FROM main.MEASUREMENTS \
+                        WHERE rowid <= ? AND UNIXTIME >= ? AND UNIXTIME < ?',(top,key,key+self.period)).fetchone()
+                    moved += conn.execute('INSERT INTO part.MEASUREMENTS (%s) SELECT %s FROM main.MEASUREMENTS \
+                        WHERE rowid <= ? AND rowid > ? AND UNIXTIME >= ? AND UNIXTIME < ?'%(COLUMNS,COLUMNS),
+                        (top,done,key,key+self.period)).rowcount
+                    conn.execute('INSERT INTO part.ROLLOVERS VALUES (?,?,?)',
+                        (ktop, fingerprint(conn, ktop), int(time.time())))
+                    conn.execute('DELETE FROM main.MEASUREMENTS WHERE rowid <= ? AND UNIXTIME >= ? AND UNIXTIME < ?',
+                        (top,key,key+self.period))
+            finally:
+                conn.execute('DETACH DATABASE part')
+
+        log.info('Rolled {} rows into partitions'.format(moved))
+        return moved
+
+    ## reading
+
+    def signature(self, key):
+        ''' changes whenever rows are added to or removed from the partition '''
+        conn = sqlite3.connect('file:%s?mode=ro'%self.path(key), uri=True)
+        try:
+            return '%s:%s'%conn.execute('SELECT count(*),max(rowid) FROM MEASUREMENTS').fetchone()
+        finally:
+            conn.close()
+
+    def view(self, start=None, end=None):
+        '''
+        A connection where MEASUREMENTS is the union of the partitions
+        overlapping [start,end). Up to sqlite's ATTACH limit (10) it is a
+        view over the attached files; a longer range is copied through
+        query() into a temporary table on disk, which costs a pass over the
+        rows but answers the same SQL.
+        '''
+        keys = self.keys(start,end)
+        conn = sqlite3.connect(':memory:', uri=True)
+        limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(conn,'getlimit') else 10
+        if len(keys) > limit:
+            conn.close()
+            log.info('{} partitions in range, more than {} can be attached: copying'.format(len(keys),limit))
+            conn = sqlite3.connect('') # a private temporary file
+            builddb.builddb(conn)
+            with conn:
+                conn.executemany('INSERT INTO MEASUREMENTS (%s) VALUES (%s)'%(COLUMNS,','.join('?'*len(COLUMNS.split(',')))),
+                                 self.query('SELECT %s FROM MEASUREMENTS'%COLUMNS, (), start, end))
+            return conn
+
+        selects = []
+        for i,key in enumerate(keys):
+            conn.execute('ATTACH DATABASE ? AS p%d'%i,('file:%s?mode=ro'%self.path(key),))
+            selects.append('SELECT %s FROM p%d.MEASUREMENTS'%(COLUMNS,i))
+        if not selects:
+            selects.append('SELECT %s WHERE 0'%','.join('NULL AS %s'%c for c in COLUMNS.split(',')))
+        conn.execute('CREATE TEMP VIEW MEASUREMENTS AS %s'%' UNION ALL '.join(selects))
+        return conn
+
+    def query(self, sql, params=(), start=None, end=None):
+        '''
+        Run sql against each partition overlapping [start,end) in turn,
+        yielding rows. Memory and open files stay constant for any range.
+        '''
+        for key in self.keys(start,end):
+            conn = sqlite3.connect('file:%s?mode=ro'%self.path(key), uri=True)
+            try:
+                for row in conn.execute(sql,params):
+                    yield row
+            finally:
+                conn.close()
+
+    ## retention
+
+    def mark_uploaded(self, unixtime=None):
+        '''
+        Record that every complete period before unixtime has been uploaded.
+        '''
+        if unixtime is None: unixtime = time.time()
+        with open(self.watermark,'w') as f:
+            f.write('%d\n'%self.key(unixtime))
+
+    def uploaded(self):
+        if not os.path.exists(self.watermark): return None
+        with open(self.watermark,'r') as f:
+            return int(f.read().strip())
+
+    def expire(self, keep, dest=None):
+        '''
+        Delete (or move to dest) uploaded partitions more than keep periods old.
+        Partitions that have not been uploaded are never touched.
+        '''
+        mark = self.uploaded()
+        if mark is None: return []
+        cutoff = min(mark, self.key(time.time()) - keep*self.period)
+        removed = []
+        for key in self.keys(end=cutoff):
+            if key + self.period > cutoff: continue
+            path = self.path(key)
+            if dest: shutil.move(path, dest)
+            else: os.remove(path)
+            for extra in ('-wal','-shm'):
+                if os.path.exists(path+extra): os.remove(path+extra)
+            removed.append(path)
+            log.info('Expired partition {}'.format(path))
+        return removed
+
+
+class Days(object):
+    '''
+    The DAYS table of a derived database: for each day computed, the
+    signature() of its partition at the time, so only days whose partition
+    has changed since are computed again.
+    '''
+
+    def __init__(self, conn, partitions, day=86400):
+        self.conn = conn
+        self.partitions = partitions
+        self.day = day
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS DAYS (DAY INT PRIMARY KEY, SOURCE TEXT, COMPUTED INT)')
+
+    def stale(self, start=None, end=None, after=0):
+        '''
+        (day, signature) of the days in [start,end) to compute, oldest first:
+        those whose partition changed, and the after days following each,
+        for results that depend on earlier days. Following days past end
+        are forgotten, so the next stale() that covers them returns them.
+        '''
+        cached = dict(self.conn.execute('SELECT DAY,SOURCE FROM DAYS'))
+        horizon = None if end is None else end + after*self.day
+        days = {}
+        for key in self.partitions.keys(start, horizon):
+            source = self.partitions.signature(key)
+            for day in range(key, key+self.partitions.period, self.day):
+                if start is not None and day + self.day <= start: continue
+                if horizon is not None and day >= horizon: continue
+                days[day] = source
+        changed = set(day for day,source in days.items() if (end is None or day < end) and cached.get(day) != source)
+        for day in list(changed):
+            changed.update(d for d in range(day+self.day, day+(after+1)*self.day, self.day) if d in days)
+        later = [(day,) for day in changed if end is not None and day >= end]
+        if later:
+            with self.conn: self.conn.executemany('DELETE FROM DAYS WHERE DAY=?', later)
+        return [(day, days[day]) for day in sorted(changed) if end is None or day < end]
+
+    def done(self, day, source):
+        ''' record day as computed from source, inside the caller's transaction '''
+        self.conn.execute('INSERT OR REPLACE INTO DAYS VALUES (?,?,?)', (day, source, int(time.time())))
+
+
+if __name__ == '__main__':
+    import sys
+    from .SensorMod.db import __RDIR__
+    parts = Partitions(os.path.join(__RDIR__,'partitions'))
+    for key in parts.keys():
+        print('%s %10d bytes'%(parts.path(key),os.path.getsize(parts.path(key))))
+    if len(sys.argv) > 1:
+        print('expired:',parts.expire(int(sys.argv[1])))
@@ -0,0 +1,116 @@
+'''
+On demand profiling of the sampling cycle.
+
+Start it on a running sensor with either
+
+    sudo pkill -USR1 -fx ".*python3 -m sensorpi"   (or kill -USR1 the supervisor,
+                                                    which passes it on)
+    echo 3 > /root/.profile        (number of cycles, checked once per cycle)
+
+The next N cycles run under cProfile with tracemalloc tracing; the report
+(top functions by cumulative time and the top allocation growth by line)
+is summarised in the log and written in full to
+__RDIR__/profiles/profile_<unixtime>.txt, where the last KEEP are kept.
+With INGEST set they go to the serverpi with the next sync (ingest.push)
+and are removed once it succeeds; upload.sync only sends MEASUREMENTS,
+so without INGEST fetch them over ssh.
+
+When nothing has been requested the cost is a flag check and a stat per
+cycle. cProfile only sees the main thread (not the multiopc threads).
+'''
+
+import os,io,time,signal,cProfile,pstats,tracemalloc
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+CYCLES = 3  # cycles profiled per request
+TOP = 25    # lines kept of each report
+FRAMES = 1  # tracemalloc frames per allocation
+KEEP = 10   # reports kept on the sensor
+
+
+class Profiler(object):
+
+    def __init__(self, flagfile, cycles=CYCLES, top=TOP):
+        self.flagfile = flagfile
+        self.cycles = cycles
+        self.top = top
+        self.requested = 0
+        self.remaining = 0
+        self.profile = None
+        try:
+            signal.signal(signal.SIGUSR1, self.signalled)
+        except ValueError: # not the main thread
+            log.warning('SIGUSR1 profiling trigger not installed')
+
+    def signalled(self, signum, frame):
+        self.requested = self.cycles
+
+    def poll(self):
+        if not os.path.exists(self.flagfile): return
+        try:
+            with open(self.flagfile,'r') as f:
+                self.requested = int(f.read().strip() or self.cycles)
+        except ValueError:
+            self.requested = self.cycles
+        os.remove(self.flagfile)
+
+    def begin(self):
+        ''' call before each cycle '''
+        if not self.remaining:
+            self.poll()
+            if not self.requested: return
+            self.remaining,self.requested = self.requested,0
+            self.done = 0
+            self.started = time.time()
+            log.info('Profiling the next {} cycles'.format(self.remaining))
+            self.profile = cProfile.Profile()
+            tracemalloc.start(FRAMES)
+            self.snapshot = tracemalloc.take_snapshot()
+        self.profile.enable()
+
+    def end(self):
+        '''
+        call after each cycle. Returns the report text after the last
+        profiled cycle, otherwise None.
+        '''
+        if not self.remaining: return None
+        self.profile.disable()
+        self.done += 1
+        self.remaining -= 1
+        if self.remaining: return None
+
+        out = io.StringIO()
+        out.write('%d cycles profiled from %s over %.0f s\n\n'%(self.done,
+            time.strftime('%F %X',time.gmtime(self.started)), time.time()-self.started))
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(self.top)
+
+        after = tracemalloc.take_snapshot()
+        current,peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        out.write('tracemalloc: %d bytes traced, peak %d\n'%(current,peak))
+        for stat in after.compare_to(self.snapshot,'lineno')[:self.top]:
+            out.write('%s\n'%stat)
+
+        self.profile = self.snapshot = None
+        report = out.getvalue()
+        log.info('Profile complete:\n{}'.format('\n'.join(report.splitlines()[:12])))
+        return report
+
+
+def store(directory, SERIAL, report, keep=KEEP):
+    '''
+    Write a report to directory, removing all but the newest keep.
+    Returns its path.
+    '''
+    if not os.path.exists(directory): os.makedirs(directory)
+    path = os.path.join(directory,'profile_%d.txt'%time.time())
+    with open(path,'w') as f:
+        f.write('%s\n%s'%(SERIAL.strip().strip('\0'), report))
+    old = sorted((f for f in os.listdir(directory) if f.startswith('profile_')),
+                 key=lambda f: int(f[8:-4]))[:-keep]
+    for f in old: os.remove(os.path.join(directory,f))
+    log.info('Profile written to {}'.format(path))
+    return path
@@ -0,0 +1,154 @@
+'''
+Checksum verified histogram reads for the OPC-R1.
+
+Wraps the py-opc-R1 object (R1.alpha) and reads the 64 byte histogram frame
+itself: the command byte is polled until the OPC answers ready (0xF3), then
+the whole frame is clocked out in one spidev ioctl (xfer sends one byte per
+transfer with the 10 us gap the R1 needs, all in a single message) into a
+preallocated buffer. The trailing CRC-16 (MODBUS polynomial, as in the
+Checksum column of tests/opc_testing.txt) is checked and the read retried on
+a mismatch, so corrupted frames never become data.
+
+Frames decode into a Histogram with fixed slots; pm['PM2.5'] style access
+still works for code written against the py-opc dictionaries.
+
+Test and benchmark: python3 -m sensorpi.tests r1frame
+'''
+
+import time,struct
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+CMD_HISTOGRAM = 0x30
+READY = 0xF3
+FRAME = 64
+BYTE_DELAY = 10  # us between bytes
+RETRIES = 3
+POLLS = 20       # ready polls before giving up on a read
+
+# 16 bins, 4 MToF, SFR, T, RH, sampling period, 2 reject counts, PM A/B/C, checksum
+LAYOUT = struct.Struct('<16H4BfHHfBBfffH')
+assert LAYOUT.size == FRAME
+
+
+def _entry(b):
+    for _ in range(8):
+        if b & 1: b = (b >> 1) ^ 0xA001
+        else: b >>= 1
+    return b
+CRC_TABLE = tuple(_entry(b) for b in range(256))
+
+
+def crc16(data, n=FRAME-2):
+    ''' CRC-16/MODBUS of the first n bytes '''
+    crc,table = 0xFFFF,CRC_TABLE
+    for i in range(n):
+        crc = (crc >> 8) ^ table[(crc ^ data[i]) & 0xFF]
+    return crc
+
+
+class Histogram(object):
+    '''
+    One decoded histogram frame.
+    '''
+    __slots__ = ('bins','mtof','sfr','temperature','humidity','period',
+                 'reject_glitch','reject_long','pm1','pm25','pm10','checksum','latency')
+
+    # py-opc dictionary names
+    KEYS = {'PM1':'pm1','PM2.5':'pm25','PM10':'pm10','Temperature':'temperature',
+            'Humidity':'humidity','Sampling Period':'period','SFR':'sfr',
+            'Reject count glitch':'reject_glitch','Reject count long':'reject_long',
+            'Checksum':'checksum'}
+
+    @classmethod
+    def decode(cls, buf, latency=0.):
+        v = LAYOUT.unpack_from(buf)
+        h = cls.__new__(cls)
+        h.bins = v[0:16]
+        h.mtof = tuple(m/3. for m in v[16:20]) # us
+        h.sfr = v[20]
+        h.temperature = -45. + 175.*v[21]/65535.
+        h.humidity = 100.*v[22]/65535.
+        h.period = v[23]
+        h.reject_glitch,h.reject_long = v[24],v[25]
+        h.pm1,h.pm25,h.pm10 = v[26],v[27],v[28]
+        h.checksum = v[29]
+        h.latency = latency
+        return h
+
+    @classmethod
+    def empty(cls):
+        h = cls.__new__(cls)
+        h.bins = (0,)*16
+        h.mtof = (0.,)*4
+        for k in ('sfr','temperature','humidity','period','pm1','pm25','pm10','latency'):
+            setattr(h,k,0.)
+        h.reject_glitch = h.reject_long = h.checksum = 0
+        return h
+
+    def __getitem__(self, key):
+        if key.startswith('Bin '): return self.bins[int(key[4:])]
+        return getattr(self, self.KEYS[key])
+
+
+class R1Frame(object):
+    '''
+    Drop in for R1.alpha in runcycle: on(), off(), pm(), histogram().
+    '''
+
+    def __init__(self, alpha, retries=RETRIES):
+        self.alpha = alpha
+        self.cnxn = alpha.cnxn
+        self.retries = retries
+        self.cmd = [CMD_HISTOGRAM]*FRAME
+        self.buf = bytearray(FRAME)
+        self.reads = self.crc_errors = self.not_ready = self.failures = 0
+        self.latency = self.max_latency = 0.
+
+    def on(self): return self.alpha.on()
+
+    def off(self): return self.alpha.off()
+
+    def pm(self): return self.histogram()
+
+    def ready(self):
+        for i in range(POLLS):
+            if self.cnxn.xfer([CMD_HISTOGRAM])[0] == READY:
+                return True
+            time.sleep(.01)
+        self.not_ready += 1
+        return False
+
+    def read(self):
+        ''' one attempt: True if a frame with a good checksum is in self.buf '''
+        if not self.ready(): return False
+        time.sleep(1e-5)
+        self.buf[:] = self.cnxn.xfer(self.cmd, 0, BYTE_DELAY)
+        if crc16(self.buf) != self.buf[62] | self.buf[63] << 8:
+            self.crc_errors += 1
+            return False
+        return True
+
+    def histogram(self):
+        '''
+        A verified Histogram, or an empty one (which runcycle discards) if
+        every retry failed.
+        '''
+        start = time.time()
+        for attempt in range(self.retries):
+            if self.read():
+                took = time.time()-start
+                self.reads += 1
+                self.latency += took
+                self.max_latency = max(self.max_latency,took)
+                return Histogram.decode(self.buf, took)
+            time.sleep(.01)
+        self.failures += 1
+        log.warning('No valid histogram after {} attempts ({} checksum errors so far)'.format(self.retries,self.crc_errors))
+        return Histogram.empty()
+
+    def metrics(self):
+        return {'reads':self.reads, 'crc_errors':self.crc_errors, 'not_ready':self.not_ready,
+                'failures':self.failures, 'mean_latency':self.latency/max(self.reads,1),
+                'max_latency':self.max_latency}
@@ -0,0 +1,183 @@
+'''
+Fast-forward the main loop on a virtual clock.
+
+loop.run is driven by a SimNode: a SimOPC, a simulated GPS and upload
+backend, and a VirtualClock that jumps over every sleep. A simulated week
+takes seconds. The report gives a timeline per day of samples taken, gaps,
+uploads and the time spent in each mode.
+
+With warm the OPC is kept running between cycles (dutycycle.DutyCycle),
+and the report ends with the sampling coverage either way.
+
+Usage: python3 -m sensorpi.replay [days] [bbsensor|bbstatic|bbserver] [start YYYY-MM-DD] [warm]
+'''
+
+import sys,time,random
+from datetime import datetime
+
+from .clock import VirtualClock
+from .simulate import SimOPC
+from .dutycycle import DutyCycle
+from . import loop
+
+GAP = 60 # seconds between samples that count as a gap
+
+
+class SimNode(object):
+    '''
+    The attributes and actions loop.run expects, with the same running
+    parameters as sensorpi/__main__.py and simulated backends.
+    '''
+
+    SAMPLING_DELAY = 5
+    NIGHT = [18,7]
+    SCHOOL = [9,15]
+    SAMPLE_LENGTH_slow = 60*5
+    SAMPLE_LENGTH_fast = 60*1
+    CSV = False
+
+    def __init__(self, clock, end, hostname='bbsensor', seed=0, upload_ok=.9, upload_seconds=20, warm=False):
+        self.clock = clock
+        self.end = end
+        self.random = random.Random(seed)
+        self.upload_ok = upload_ok
+        self.upload_seconds = upload_seconds
+        self.alpha = SimOPC(seed=seed, latency=.02, clock=clock)
+        if warm: self.alpha = DutyCycle(self.alpha, clock)
+
+        self.CONTINUOUS = 'bbsensor' not in hostname
+        self.TYPE = 1 if 'bbstatic' in hostname else 3 if 'bbserver' in hostname else 2
+        self.SAMPLE_LENGTH = 300
+        self.hour = None
+        self.gps = True
+        self.LAST_SAVE = self.LAST_UPDATE = self.LAST_UPLOAD = None
+
+        self.samples = []   # unix time of each stored row
+        self.covered = 0.   # seconds covered by the stored rows' sampling periods
+        self.events = []    # (unix time, what)
+        self.modes = {}     # seconds spent per mode
+        self.current = None
+        self.since = clock.time()
+
+    @property
+    def STOP(self):
+        return self.clock.time() >= self.end
+
+    def event(self, what):
+        self.events.append((self.clock.time(), what))
+
+    ## actions
+
+    def measurement(self, pm, now):
+        if float(pm['PM1'])+float(pm['PM10']) <= 0: return None
+        self.covered += float(pm['Sampling Period'])
+        return self.clock.time()
+
+    def cycle(self, SAMPLE_LENGTH):
+        rows = loop.runcycle(self.alpha, SAMPLE_LENGTH, self.SAMPLING_DELAY, self.measurement, self.clock, lambda: self.STOP)
+        self.samples.extend(rows)
+
+    def idle(self):
+        self.alpha.off()
+        if not getattr(self.alpha,'warm',False): self.clock.sleep(1)
+
+    def standby(self):
+        if hasattr(self.alpha,'standby'): self.alpha.standby()
+
+    def checkpoint(self): pass
+
+    def mode(self, name):
+        now = self.clock.time()
+        if self.current:
+            self.modes[self.current] = self.modes.get(self.current,0) + now - self.since
+        self.current,self.since = name,now
+
+    def gps_stop(self):
+        if self.gps: self.event('gps off')
+        self.gps = False
+
+    def gps_start(self):
+        if not self.gps: self.event('gps on')
+        self.gps = True
+
+    def transfer(self, what):
+        self.clock.sleep(self.upload_seconds)
+        ok = self.random.random() < self.upload_ok
+        self.event('%s %s'%(what,'ok' if ok else 'FAILED'))
+        return ok
+
+    def upload_to_server(self, DATE):
+        if DATE != self.LAST_SAVE and self.transfer('sync to serverpi'):
+            self.LAST_SAVE = DATE
+
+    def stagedata(self, DATE):
+        if DATE != self.LAST_SAVE and self.transfer('stage'):
+            self.LAST_SAVE = DATE
+
+    def upload_to_external(self, DATE):
+        if DATE != self.LAST_UPLOAD and self.transfer('upload to external'):
+            self.LAST_UPLOAD = DATE
+
+    def update(self, DATE):
+        if DATE != self.LAST_UPDATE:
+            self.event('update')
+            self.LAST_UPDATE = DATE
+
+
+def report(node, start, end):
+    '''
+    Timeline lines per day followed by the time spent in each mode.
+    '''
+    node.mode(None)
+    lines = []
+    day = start
+    while day < end:
+        nxt = day + 86400
+        samples = [t for t in node.samples if day <= t < nxt]
+        gaps = [(a,b) for a,b in zip([day]+samples, samples+[min(nxt,end)]) if b-a > GAP]
+        lines.append('%s  %6d samples  %3d gaps  %5.1f h without data'%(
+            datetime.utcfromtimestamp(day).strftime('%a %Y-%m-%d'), len(samples), len(gaps),
+            sum(b-a for a,b in gaps)/3600.))
+        for a,b in gaps:
+            lines.append('      gap  %s - %s'%(datetime.utcfromtimestamp(a).strftime('%H:%M:%S'),
+                                              datetime.utcfromtimestamp(b).strftime('%H:%M:%S')))
+        for t,what in node.events:
+            if day <= t < nxt:
+                lines.append('      %s  %s'%(datetime.utcfromtimestamp(t).strftime('%H:%M:%S'),what))
+        day = nxt
+
+    total = sum(node.modes.values()) or 1
+    for name,seconds in sorted(node.modes.items(), key=lambda x:-x[1]):
+        lines.append('%-10s %6.1f h  %5.1f%%'%(name, seconds/3600., 100.*seconds/total))
+    sampling = total - node.modes.get('NIGHT',0)
+    lines.append('sampled %.1f h, %.1f%% of the time out of NIGHT'%(node.covered/3600., 100.*node.covered/sampling))
+    return lines
+
+
+def replay(days=7, hostname='bbsensor', start=None, **kw):
+    '''
+    Run the main loop for days on a virtual clock. Returns (node, report lines).
+    '''
+    if start is None:
+        start = time.time()//86400*86400
+    clock = VirtualClock(start)
+    end = start + days*86400
+    node = SimNode(clock, end, hostname, **kw)
+    loop.run(node, clock)
+    return node, report(node, start, end)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    warm = 'warm' in args
+    args = [a for a in args if a != 'warm']
+    days = int(args[0]) if args else 7
+    hostname = args[1] if len(args) > 1 else 'bbsensor'
+    start = None
+    if len(args) > 2:
+        start = (datetime.strptime(args[2],'%Y-%m-%d') - datetime(1970,1,1)).total_seconds()
+
+    began = time.time()
+    node, lines = replay(days, hostname, start, warm=warm)
+    print('\n'.join(lines))
+    print('%d days of %s replayed in %.1f s'%(days, hostname, time.time()-began))
@@ -0,0 +1,171 @@
+'''
+Fleet data on a common time grid.
+
+Every sensor samples on its own drifting cadence with gaps. Resampler
+maps any set of SERIALs over a time range onto one grid of STEP seconds
+and yields it a chunk at a time as dense arrays:
+
+    values  (times, sensors, variables) float32, NaN where missing
+    cover   (times, sensors, variables) seconds of each slot covered by
+            samples with a value for that variable
+    mask    (times, sensors, variables) True where cover >= MIN_COVER of the slot
+
+Each row stands for [UNIXTIME, UNIXTIME+SP) (SP capped at MAXSP) and is
+spread over the slots it overlaps in proportion to the overlap, so a slot
+value is the sample period weighted mean. A NULL is left out of its
+variable's mean and cover only, so a sensor whose T is missing on half its
+rows still has its PM slots, and its T slots average the rows that have T.
+Rows are read from the partitions one chunk of time at a time; memory is
+proportional to the chunk, not the range.
+
+UNIXTIME is the Pi's clock. With clock='gps' each sensor's times in a
+chunk are shifted by the median difference between its GPS TIME stamps
+and UNIXTIME (up to MAXSHIFT), which takes out RTC drift where there is
+a fix.
+
+Usage: python3 -m sensorpi.resample OUT FROM TO [STEP] [SERIAL ...]
+       (writes OUT.npy values, OUT_mask.npy and OUT_serials.txt)
+'''
+
+import os,sys
+from collections import namedtuple
+import numpy as np
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+STEP = 10          # s
+CHUNK = 360        # slots per chunk (an hour at 10 s)
+MAXSP = 60.        # s - longest a single row may stand for
+MIN_COVER = .5     # fraction of a slot that must be covered
+VARIABLES = ('PM1','PM3','PM10','T','RH')
+MIN_FIXES = 5      # GPS stamps needed to correct a sensor's clock
+MAXSHIFT = 600     # s - largest clock correction applied
+
+Chunk = namedtuple('Chunk', 'times values cover mask')
+
+
+def gps_offset(unixtime, gpstime):
+    '''
+    Median of GPS time - UNIXTIME over the valid HHMMSS stamps, or 0.
+    '''
+    d = []
+    for t,g in zip(unixtime, gpstime):
+        if not g or len(g) < 6 or g[:6] == '000000' or not g[:6].isdigit(): continue
+        day = int(t)//86400*86400
+        s = day + int(g[0:2])*3600 + int(g[2:4])*60 + int(g[4:6])
+        diff = (s - t + 43200) % 86400 - 43200 # nearest day
+        d.append(diff)
+    return float(np.median(d)) if len(d) >= MIN_FIXES else 0.
+
+
+class Resampler(object):
+
+    def __init__(self, partitions, serials, step=STEP, variables=VARIABLES, chunk=CHUNK,
+                 clock='pi', min_cover=MIN_COVER, maxsp=MAXSP):
+        self.partitions = partitions
+        self.serials = list(serials)
+        self.index = dict((s,i) for i,s in enumerate(self.serials))
+        self.step = int(step)
+        self.variables = tuple(variables)
+        self.chunk = int(chunk)
+        self.clock = clock
+        self.min_cover = min_cover
+        self.maxsp = maxsp
+
+    def rows(self, start, end):
+        ''' rows that may overlap [start,end) '''
+        sql = 'SELECT SERIAL,UNIXTIME,TIME,SP,%s FROM MEASUREMENTS WHERE UNIXTIME >= ? AND UNIXTIME < ? \
+AND SERIAL IN (%s)'%(','.join(self.variables), ','.join('?'*len(self.serials)))
+        shift = MAXSHIFT if self.clock == 'gps' else 0
+        params = [start - self.maxsp - shift, end + shift] + self.serials
+        return list(self.partitions.query(sql, params, params[0], params[1]))
+
+    def grid(self, rows, t0, n):
+        '''
+        Resample rows onto n slots from t0: (values, cover).
+        '''
+        S,V,step = len(self.serials),len(self.variables),self.step
+        cover = np.zeros((V, n*S))
+        sums = np.zeros((V, n*S))
+        if rows:
+            sensor = np.array([self.index[r[0]] for r in rows])
+            a = np.array([r[1] for r in rows], float)
+            if self.clock == 'gps':
+                for s in np.unique(sensor):
+                    sel = np.flatnonzero(sensor == s)
+                    a[sel] += np.clip(gps_offset(a[sel], [rows[i][2] for i in sel]), -MAXSHIFT, MAXSHIFT)
+            sp = np.array([np.nan if r[3] is None else r[3] for r in rows], float)
+            b = a + np.clip(np.where(np.isfinite(sp), sp, 0.), 0, self.maxsp)
+            v = np.array([[np.nan if x is None else x for x in r[4:]] for r in rows], float).T
+            first = np.floor((a - t0)/step).astype(np.int64)
+            for j in range(int(np.ceil(self.maxsp/step)) + 1):
+                slot = first + j
+                lo = t0 + slot*step
+                w = np.minimum(b, lo+step) - np.maximum(a, lo)
+                ok = (w > 0) & (slot >= 0) & (slot < n)
+                if not ok.any(): continue
+                flat = slot[ok]*S + sensor[ok]
+                for k in range(V):
+                    good = np.isfinite(v[k][ok])
+                    cover[k] += np.bincount(flat[good], w[ok][good], n*S)
+                    sums[k] += np.bincount(flat[good], (w[ok]*v[k][ok])[good], n*S)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = (sums/cover).T.reshape(n, S, V).astype(np.float32)
+        cover = cover.T.reshape(n, S, V)
+        values[cover == 0] = np.nan
+        return values, cover
+
+    def chunks(self, start, end):
+        '''
+        Yield Chunks covering [start,end) (start rounded down to the grid).
+        '''
+        step = self.step
+        t = int(start)//step*step
+        while t < end:
+            n = min(self.chunk, int(np.ceil((end - t)/float(step))))
+            values,cover = self.grid(self.rows(t, t + n*step), t, n)
+            mask = cover >= self.min_cover*step
+            values[~mask] = np.nan
+            yield Chunk(t + np.arange(n)*step, values, cover, mask)
+            t += n*step
+
+    def save(self, path, start, end):
+        '''
+        Write the whole range to path.npy (values) and path_mask.npy through
+        memory maps, a chunk at a time.
+        '''
+        step = self.step
+        t0 = int(start)//step*step
+        total = int(np.ceil((end - t0)/float(step)))
+        shape = (total, len(self.serials), len(self.variables))
+        values = np.lib.format.open_memmap(path+'.npy', 'w+', np.float32, shape)
+        mask = np.lib.format.open_memmap(path+'_mask.npy', 'w+', np.bool_, shape)
+        i = 0
+        for c in self.chunks(start, end):
+            values[i:i+len(c.times)] = c.values
+            mask[i:i+len(c.times)] = c.mask
+            i += len(c.times)
+        values.flush(); mask.flush()
+        with open(path+'_serials.txt','w') as f:
+            f.write('# start %d step %d variables %s\n'%(t0, step, ','.join(self.variables)))
+            f.write('\n'.join(self.serials)+'\n')
+        return shape
+
+
+if __name__ == '__main__':
+    from .SensorMod.db import __RDIR__
+    from .partition import Partitions
+    from .coverage import parse_date
+    args = sys.argv[1:]
+    if len(args) < 3:
+        print(__doc__)
+        sys.exit(1)
+    partitions = Partitions(os.path.join(__RDIR__,'partitions'))
+    start,end = parse_date(args[1]),parse_date(args[2])
+    step = int(args[3]) if len(args) > 3 else STEP
+    serials = args[4:]
+    if not serials:
+        serials = sorted(set(s for s, in partitions.query('SELECT DISTINCT SERIAL FROM MEASUREMENTS', (), start, end)))
+    shape = Resampler(partitions, serials, step).save(args[0], start, end)
+    print('%d slots x %d sensors x %d variables written to %s.npy'%(shape+(args[0],)))
@@ -0,0 +1,121 @@
+'''
+Simulated instruments for running the sampling code without hardware.
+
+SimOPC has the same methods as the py-opc-R1 object (R1.alpha) used by
+runcycle and returns histograms with the same keys. MockSPI is a spidev
+stand-in that answers the R1 histogram command with encoded frames, for
+r1frame.R1Frame.
+
+Usage: python3 -m sensorpi.simulate   (prints a few simulated histograms)
+'''
+
+import time,random,struct
+
+
+class SimOPC(object):
+    '''
+    Stand-in for an OPC-R1. latency is the time one histogram read takes
+    (a real read is roughly 10-20 ms of SPI traffic). clock is anything with
+    time() and sleep(), e.g. a clock.VirtualClock.
+    '''
+
+    def __init__(self, seed=None, latency=0.01, level=10., clock=time):
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.level = level
+        self.powered = False
+        self.last = None
+
+    def on(self):
+        self.powered = True
+        self.last = self.clock.time()
+        return True
+
+    def off(self):
+        self.powered = False
+        return True
+
+    def pm(self):
+        return self.histogram()
+
+    def histogram(self):
+        if self.latency: self.clock.sleep(self.latency)
+        if not self.powered:
+            return dict([('Bin %s'%i,0) for i in range(16)],
+                        **{'PM1':0.,'PM2.5':0.,'PM10':0.,'Temperature':0.,'Humidity':0.,
+                           'Sampling Period':0.,'Reject count glitch':0})
+
+        now = self.clock.time()
+        period = max(now - self.last, 1e-3)
+        self.last = now
+
+        r = self.random
+        level = self.level * r.lognormvariate(0,.3)
+        # counts fall off with size, like the fixture in tests/opc_testing.txt
+        bins = [int(r.expovariate(1./(level*period*.6**i))) if level*period*.6**i > 1e-3 else 0 for i in range(16)]
+        pm1 = level*.3*r.uniform(.8,1.2)
+        pm25 = pm1 + level*.4*r.uniform(.8,1.2)
+        pm10 = pm25 + level*.6*r.uniform(.8,1.2)
+
+        d = dict(('Bin %s'%i,b) for i,b in enumerate(bins))
+        d.update({'PM1':pm1, 'PM2.5':pm25, 'PM10':pm10,
+                  'Temperature':20. + r.gauss(0,.5), 'Humidity':50. + r.gauss(0,2),
+                  'Sampling Period':period, 'Reject count glitch':int(r.expovariate(2))})
+        return d
+
+
+class MockSPI(object):
+    '''
+    spidev.SpiDev stand-in serving SimOPC histograms as 64 byte R1 frames.
+    busy is the number of 0x31 (busy) answers before each ready, corrupt
+    the fraction of frames with a flipped bit, xfer_time the time spent per
+    byte clocked.
+    '''
+
+    def __init__(self, opc=None, seed=None, busy=0, corrupt=0., xfer_time=0.):
+        self.opc = opc or SimOPC(seed=seed, latency=0)
+        self.opc.on()
+        self.random = random.Random(seed)
+        self.busy = busy
+        self.corrupt = corrupt
+        self.xfer_time = xfer_time
+        self.waiting = busy
+        self.ioctls = 0
+        self.frames = 0
+        self.sent = None  # the last histogram framed
+
+    def frame(self):
+        from .r1frame import LAYOUT, crc16
+        h = self.sent = self.opc.histogram()
+        raw = LAYOUT.pack(*([min(h['Bin %s'%i],65535) for i in range(16)] + [30,40,50,60,
+            5., int((h['Temperature']+45)*65535/175.), int(h['Humidity']*65535/100.),
+            h['Sampling Period'], h['Reject count glitch'], 0,
+            h['PM1'], h['PM2.5'], h['PM10'], 0]))
+        data = bytearray(raw)
+        struct.pack_into('<H', data, 62, crc16(data))
+        if self.random.random() < self.corrupt:
+            data[self.random.randrange(62)] ^= 1 << self.random.randrange(8)
+        return data
+
+    def xfer(self, data, speed_hz=0, delay_usecs=0):
+        self.ioctls += 1
+        if self.xfer_time: time.sleep(self.xfer_time*len(data))
+        if len(data) == 1:
+            if self.waiting:
+                self.waiting -= 1
+                return [0x31]
+            self.waiting = self.busy
+            return [0xF3]
+        self.frames += 1
+        return list(self.frame()[:len(data)])
+
+
+if __name__ == '__main__':
+    alpha = SimOPC(seed=1)
+    alpha.on()
+    alpha.pm()
+    for i in range(3):
+        time.sleep(1)
+        print(alpha.histogram())
+    alpha.off()
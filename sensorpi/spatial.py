@@ -0,0 +1,218 @@
+'''
+R-tree index of decrypted sample locations.
+
+Answering "everything within 200 m of school X between these dates"
+from LOC means decrypting and scanning every row. Instead, each source
+database (a partition, or server.db) gets an index file in an analysis
+directory - kept off the Pi, since it holds plain coordinates - with an
+SQLite R-tree over (lat, lon, time) keyed by the source's MEASUREMENTS
+rowid. build() decrypts only rows past the last rowid indexed, so the
+index grows with the data. With that rowid the index keeps a hash of its
+row: rollover empties server.db and SQLite then hands out the same rowids
+again, so if the row is gone or different the index is rebuilt rather than
+joined to rows it never saw.
+
+A query attaches the source read only and joins the R-tree to
+MEASUREMENTS by rowid: the box and time range are answered by the R-tree,
+SERIAL and the exact time and distance are checked on the few rows it
+returns.
+
+    index = SpatialIndex('/data/bbsensor/spatial')
+    index.build(partition_path, private_key)
+    rows = index.near(partitions, lat, lon, 200, start, end, serials=['0000000012345678'], landing=server_db)
+
+Usage: python3 -m sensorpi.spatial build PRIVATE_KEY.pem INDEXDIR
+       python3 -m sensorpi.spatial near INDEXDIR LAT LON METRES [FROM [TO]]
+       (both cover the partitions and server.db)
+'''
+
+import os,sys,math,hashlib,sqlite3
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+COLUMNS = ('rowid','SERIAL','UNIXTIME','lat','lon','PM1','PM3','PM10')
+EARTH = 6371000.
+
+
+def box(lat, lon, metres):
+    ''' (lat0, lat1, lon0, lon1) containing the circle '''
+    dlat = math.degrees(metres/EARTH)
+    dlon = dlat/math.cos(math.radians(lat))
+    return (lat-dlat, lat+dlat, lon-dlon, lon+dlon)
+
+
+def fingerprint(conn, rowid):
+    ''' hash of a source row, None if there is no such row '''
+    row = conn.execute('SELECT SERIAL,UNIXTIME,LOC FROM MEASUREMENTS WHERE rowid = ?',(rowid,)).fetchone()
+    return None if row is None else hashlib.sha256(repr(row).encode('utf-8')).hexdigest()
+
+
+def distance(lat0, lon0, lat1, lon1):
+    ''' metres, equirectangular (fine at the scale of a town) '''
+    x = math.radians(lon1-lon0)*math.cos(math.radians((lat0+lat1)/2.))
+    y = math.radians(lat1-lat0)
+    return EARTH*math.hypot(x,y)
+
+
+class SpatialIndex(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, source):
+        return os.path.join(self.directory, os.path.basename(source)+'.rtree')
+
+    def connect(self, source):
+        conn = sqlite3.connect(self.path(source))
+        with conn:
+            # +lat,+lon keep the exact coordinates; the R-tree boxes are float32
+            conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS LOCATIONS USING rtree \
+                (id, minlat, maxlat, minlon, maxlon, mint, maxt, +lat REAL, +lon REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS INDEXED (top INT, row TEXT)')
+            if 'row' not in [c[1] for c in conn.execute('PRAGMA table_info(INDEXED)')]:
+                conn.execute('ALTER TABLE INDEXED ADD COLUMN row TEXT') # an older index: rebuilt on the next build
+        return conn
+
+    def top(self, conn):
+        row = conn.execute('SELECT max(top) FROM INDEXED').fetchone()
+        return row[0] or 0
+
+    def mark(self, conn):
+        ''' (top, fingerprint of the source row at top) '''
+        row = conn.execute('SELECT top,row FROM INDEXED ORDER BY top DESC LIMIT 1').fetchone()
+        return row or (0, None)
+
+    ## building
+
+    def add(self, conn, c, row=None):
+        '''
+        Index a decoded.chunks() block. Rows without a fix are only counted
+        towards the watermark; row is the fingerprint of the last one.
+        '''
+        ok = [i for i in range(len(c['rowid'])) if c['lat'][i] == c['lat'][i] and c['lon'][i] == c['lon'][i]]
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO LOCATIONS VALUES (?,?,?,?,?,?,?,?,?)',
+                [(int(c['rowid'][i]), c['lat'][i], c['lat'][i], c['lon'][i], c['lon'][i],
+                  int(c['UNIXTIME'][i]), int(c['UNIXTIME'][i]), c['lat'][i], c['lon'][i]) for i in ok])
+            if len(c['rowid']):
+                conn.execute('INSERT INTO INDEXED (top,row) VALUES (?,?)',(int(c['rowid'].max()),row))
+        return len(ok)
+
+    def build(self, source, private_key):
+        '''
+        Decrypt and index the rows of source added since the last build.
+        Returns the number of rows indexed.
+        '''
+        from .decoded import chunks
+        conn = self.connect(source)
+        src = sqlite3.connect('file:%s?mode=ro'%source, uri=True)
+        try:
+            top,row = self.mark(conn)
+            if top and fingerprint(src, top) != row:
+                # the source was emptied and refilled (server.db after a rollover)
+                log.info('Reindexing {}'.format(source))
+                with conn:
+                    conn.execute('DELETE FROM LOCATIONS')
+                    conn.execute('DELETE FROM INDEXED')
+                top = 0
+            added = 0
+            for c in chunks(src, private_key, where='WHERE rowid > ? ORDER BY rowid', params=(top,)):
+                added += self.add(conn, c, fingerprint(src, int(c['rowid'].max())))
+        finally:
+            src.close()
+            conn.close()
+        log.info('Indexed {} locations from {}'.format(added, source))
+        return added
+
+    ## queries
+
+    def query(self, source, area, start=None, end=None, serials=None):
+        '''
+        Rows (COLUMNS) of source inside area (lat0, lat1, lon0, lon1) with
+        start <= UNIXTIME < end and SERIAL in serials, each optional.
+        '''
+        if not os.path.exists(self.path(source)): return []
+        lat0,lat1,lon0,lon1 = area
+        sql = ['SELECT m.rowid,m.SERIAL,m.UNIXTIME,l.lat,l.lon,m.PM1,m.PM3,m.PM10 \
+FROM LOCATIONS l JOIN src.MEASUREMENTS m ON m.rowid = l.id \
+WHERE l.maxlat >= ? AND l.minlat <= ? AND l.maxlon >= ? AND l.minlon <= ?']
+        params = [lat0,lat1,lon0,lon1]
+        if start is not None:
+            sql.append('AND l.maxt >= ? AND m.UNIXTIME >= ?')
+            params += [start,start]
+        if end is not None:
+            sql.append('AND l.mint < ? AND m.UNIXTIME < ?')
+            params += [end,end]
+        if serials:
+            sql.append('AND m.SERIAL IN (%s)'%','.join('?'*len(serials)))
+            params += list(serials)
+
+        conn = sqlite3.connect(self.path(source))
+        try:
+            conn.execute('ATTACH DATABASE ? AS src',('file:%s?mode=ro'%source,))
+            return [r for r in conn.execute(' '.join(sql), params)
+                    if lat0 <= r[3] <= lat1 and lon0 <= r[4] <= lon1]
+        finally:
+            conn.close()
+
+    def near(self, partitions, lat, lon, metres, start=None, end=None, serials=None, landing=None):
+        '''
+        Rows within metres of (lat, lon) from every partition overlapping
+        [start,end), and from the landing db (server.db) if given, with
+        their distance appended.
+        '''
+        area = box(lat, lon, metres)
+        sources = [partitions.path(key) for key in partitions.keys(start, end)]
+        if landing: sources.append(landing)
+        out = []
+        for source in sources:
+            for r in self.query(source, area, start, end, serials):
+                d = distance(lat, lon, r[3], r[4])
+                if d <= metres: out.append(r + (d,))
+        return out
+
+
+def scan(conn, private_key, lat, lon, metres, start=None, end=None, serials=None):
+    '''
+    The same as SpatialIndex.near on one database by decrypting every row:
+    the brute force the index replaces, for comparison.
+    '''
+    from .decoded import chunks
+    out = []
+    for c in chunks(conn, private_key):
+        for i in range(len(c['rowid'])):
+            t = c['UNIXTIME'][i]
+            if start is not None and t < start: continue
+            if end is not None and t >= end: continue
+            if serials and c['SERIAL'][i] not in serials: continue
+            if not c['lat'][i] == c['lat'][i]: continue
+            d = distance(lat, lon, c['lat'][i], c['lon'][i])
+            if d <= metres: out.append((int(c['rowid'][i]), d))
+    return out
+
+
+if __name__ == '__main__':
+    from .SensorMod.db import __RDIR__
+    from .partition import Partitions
+    from .coverage import parse_date
+    args = sys.argv[1:]
+    partitions = Partitions(os.path.join(__RDIR__,'partitions'))
+    landing = os.path.join(__RDIR__,'server.db')
+    if len(args) == 3 and args[0] == 'build':
+        from .crypt import load_private
+        key = load_private(args[1])
+        index = SpatialIndex(args[2])
+        for k in partitions.keys():
+            index.build(partitions.path(k), key)
+        index.build(landing, key)
+    elif len(args) >= 5 and args[0] == 'near':
+        index = SpatialIndex(args[1])
+        start = parse_date(args[5]) if len(args) > 5 else None
+        end = parse_date(args[6]) if len(args) > 6 else None
+        for r in index.near(partitions, float(args[2]), float(args[3]), float(args[4]), start, end, landing=landing):
+            print('%s %d %.6f %.6f PM1 %.1f PM2.5 %.1f PM10 %.1f %5.0f m'%r[1:])
+    else:
+        print(__doc__)
@@ -0,0 +1,219 @@
+'''
+SQLite storage profile for the device database.
+
+The default sqlite settings (rollback journal, synchronous=FULL) cost several
+fsyncs and full page rewrites per commit, which is what wears out SD cards.
+The 'sd' profile uses WAL journaling, a page size matching the card's
+allocation unit and synchronous=NORMAL, and leaves checkpointing to the main
+loop, which calls checkpoint() while the OPC is off.
+
+Bytes written to the block device are read from /sys and divided by the rows
+committed, per profile and TYPE, so profiles can be compared and card
+lifetime predicted.
+
+Usage: python3 -m sensorpi.storage   (prints the accumulated statistics)
+'''
+
+import os,json,time
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+########################################################
+##  Profiles
+########################################################
+
+PROFILES = {
+    'default': {},
+    'sd': {
+        'page_size': 4096,          # ext4 block / SD card page
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',    # fsync on checkpoint only
+        'wal_autocheckpoint': 4096, # backstop if no idle window comes (16MB)
+        'journal_size_limit': 4*1024*1024,
+        'temp_store': 'MEMORY',
+    },
+}
+
+# the INSERT every writer shares (sqlite3 already caches prepared statements
+# per connection by their text; this only keeps the text identical)
+INSERT = "INSERT INTO MEASUREMENTS (SERIAL,TYPE,TIME,LOC,PM1,PM3,PM10,T,RH,BINS,SP,RC,UNIXTIME) \
+VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)"
+
+SECTOR = 512 # /sys/block/*/stat always counts 512 byte sectors
+PE_CYCLES = 3000 # program/erase cycles assumed for an MLC SD card
+
+
+def page_size(conn, size, rebuild=False):
+    '''
+    Set the page size. SQLite only changes it on a database with no pages
+    yet, or by a VACUUM outside WAL mode: a new db gets it straight away, an
+    existing one only when rebuild is True (rebuilddb, when the db has just
+    been emptied and the VACUUM is cheap). Returns the page size in use.
+    '''
+    current = conn.execute('PRAGMA page_size').fetchone()[0]
+    if current == size: return current
+    empty = conn.execute('PRAGMA page_count').fetchone()[0] == 0
+    if not (empty or rebuild):
+        log.info('page_size stays {} until the db is rebuilt'.format(current))
+        return current
+    if conn.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal':
+        conn.execute('PRAGMA journal_mode = DELETE')
+    conn.execute('PRAGMA page_size = %d'%size)
+    if not empty: conn.execute('VACUUM')
+    return conn.execute('PRAGMA page_size').fetchone()[0]
+
+
+def tune(conn, profile='sd', rebuild=False):
+    '''
+    Apply a storage profile to an open connection. The page size is set
+    first (see page_size), then the journal mode and the other pragmas,
+    which all take effect at once. Returns the journal mode.
+    '''
+    pragmas = dict(PROFILES[profile])
+    if 'page_size' in pragmas:
+        log.debug('page_size {}'.format(page_size(conn, pragmas.pop('page_size'), rebuild)))
+    for pragma,value in pragmas.items():
+        row = conn.execute('PRAGMA %s = %s'%(pragma,value)).fetchone()
+        log.debug('PRAGMA {} = {} -> {}'.format(pragma,value,row))
+    return conn.execute('PRAGMA journal_mode').fetchone()[0]
+
+
+def insert(conn, rows):
+    '''
+    Write a cycle of rows with the shared INSERT and commit.
+    Returns the number of rows written.
+    '''
+    with conn:
+        cursor = conn.executemany(INSERT, rows)
+    return cursor.rowcount
+
+
+def checkpoint(conn, mode='PASSIVE'):
+    '''
+    Move WAL content into the database file. Called from idle windows;
+    use mode='TRUNCATE' after a rebuild to give the WAL space back.
+    Returns (busy, wal pages, pages checkpointed) or None when not in WAL mode.
+    '''
+    if conn.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+        return None
+    start = time.time()
+    result = conn.execute('PRAGMA wal_checkpoint(%s)'%mode).fetchone()
+    log.debug('checkpoint {} {} in {:.3f}s'.format(mode,result,time.time()-start))
+    return result
+
+
+########################################################
+##  Write accounting
+########################################################
+
+def blockdev(path):
+    '''
+    /sys directory of the block device (or partition) holding path, or None.
+    '''
+    st = os.stat(path)
+    sysdir = os.path.realpath('/sys/dev/block/%d:%d'%(os.major(st.st_dev),os.minor(st.st_dev)))
+    if not os.path.exists(os.path.join(sysdir,'stat')):
+        return None
+    return sysdir
+
+
+def sectors_written(sysdir):
+    with open(os.path.join(sysdir,'stat'),'r') as f:
+        return int(f.read().split()[6])
+
+
+def capacity(sysdir):
+    '''
+    Size in bytes of the whole card, not just the partition.
+    '''
+    if os.path.exists(os.path.join(sysdir,'partition')):
+        sysdir = os.path.dirname(sysdir)
+    with open(os.path.join(sysdir,'size'),'r') as f:
+        return int(f.read()) * SECTOR
+
+
+def lifetime(bytes_per_row, rows_per_day, card_bytes, pe_cycles=PE_CYCLES):
+    '''
+    Years until the card's rated writes are used up at the measured rate.
+    '''
+    per_day = bytes_per_row * rows_per_day
+    if per_day <= 0: return float('inf')
+    return card_bytes * pe_cycles / per_day / 365.
+
+
+class WriteMeter(object):
+    '''
+    Accumulates device bytes written per committed row, keyed by
+    profile and TYPE, in a json file under __RDIR__.
+
+    The device counter includes other writers (logs, the OS), so the
+    figure is the real cost of running the sensor rather than of sqlite alone.
+    '''
+
+    def __init__(self, directory, profile, statfile):
+        self.profile = profile
+        self.statfile = statfile
+        self.sysdir = blockdev(directory)
+        self.stats = {}
+        if os.path.exists(statfile):
+            try:
+                with open(statfile,'r') as f:
+                    self.stats = json.load(f)
+            except ValueError:
+                log.warning('Unreadable storage statistics, starting again')
+        self.last = self.read()
+        if self.sysdir is None:
+            log.warning('No block device statistics for {}'.format(directory))
+
+    def read(self):
+        if self.sysdir is None: return None
+        return (sectors_written(self.sysdir), time.time())
+
+    def record(self, rows, TYPE):
+        '''
+        Call after each commit. Returns bytes per row since the previous call.
+        '''
+        now = self.read()
+        if now is None or rows <= 0: return None
+        written = (now[0] - self.last[0]) * SECTOR
+        elapsed = now[1] - self.last[1]
+        self.last = now
+
+        key = '%s_%s'%(self.profile,TYPE)
+        entry = self.stats.setdefault(key,{'rows':0,'bytes':0,'seconds':0.})
+        entry['rows'] += rows
+        entry['bytes'] += written
+        entry['seconds'] += elapsed
+        entry['capacity'] = capacity(self.sysdir)
+
+        with open(self.statfile,'w') as f:
+            json.dump(self.stats,f)
+
+        log.debug('{} bytes written for {} rows ({})'.format(written,rows,key))
+        return written/float(rows)
+
+
+def report(stats):
+    '''
+    One line per profile and TYPE: bytes/row, rows/day and predicted years.
+    '''
+    lines = []
+    for key,entry in sorted(stats.items()):
+        if not entry['rows'] or not entry['seconds']: continue
+        per_row = entry['bytes']/float(entry['rows'])
+        per_day = entry['rows']/entry['seconds']*86400.
+        lines.append('%-12s %8d rows %10.0f B/row %8.0f rows/day %8.1f years'%(
+            key, entry['rows'], per_row, per_day,
+            lifetime(per_row, per_day, entry.get('capacity',0))))
+    return lines
+
+
+if __name__ == '__main__':
+    from .SensorMod.db import __RDIR__
+    statfile = os.path.join(__RDIR__,'.storage.json')
+    if not os.path.exists(statfile):
+        print('no statistics recorded yet')
+    else:
+        with open(statfile,'r') as f:
+            print('\n'.join(report(json.load(f))))
@@ -0,0 +1,255 @@
+'''
+Supervisor for the sensorpi process: code updates without a reboot.
+
+rc.local starts this instead of python3 -m sensorpi. It runs the sensor
+as a child process. When update() finds the checkout behind, the child
+stops at that idle point, commits, checkpoints and closes its database,
+writes a handover note and exits with EXIT_UPDATE. The supervisor merges
+and restarts just the Python process; the new process reads the note
+and logs how long sampling was down (also appended to updates.csv in
+__RDIR__).
+
+The Pi is only rebooted when the merge touched something a restart
+cannot pick up (REBOOT_PATHS: rc.local, which carries BB_VERSION and so
+triggers setup/package_updater.sh, the setup scripts, udev rules).
+
+On the serverpi it also runs the ingest and api services (SERVICES, named
+on the command line), each logging to LOGDIR/<name>.log. They are stopped
+with SIGINT, so they drain and close their databases, and started again
+after any merge that changed sensorpi/. A merge that changed the
+supervisor's own code (SELF_PATHS) stops the services and re-executes the
+supervisor, which then starts them on the new code.
+
+Exit codes of the child:
+    0            stopped on purpose (GPIO 21) - the supervisor exits too
+    EXIT_UPDATE  merge, then restart or reboot
+    anything else  crash - restarted after RESTART_DELAY, rebooting if it
+                 keeps crashing (MAX_CRASHES within CRASH_WINDOW)
+
+Usage: sudo python3 -m sensorpi.supervisor [SERVICE ...]   (from the BBSensor checkout)
+       e.g. sudo python3 -m sensorpi.supervisor ingest api    (on the serverpi)
+'''
+
+import os,sys,json,time,signal,subprocess
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+EXIT_UPDATE = 75
+ENV = 'SENSORPI_SUPERVISED'
+HANDOVER = '.handover'
+REBOOT_PATHS = ('rc.local', 'setup/', 'usb/optional_usb.rules')
+SELF_PATHS = ('sensorpi/supervisor.py', 'sensorpi/__init__.py', 'sensorpi/SensorMod')
+SERVICE_PATHS = ('sensorpi/',)
+SUBMODULE = 'sensorpi/SensorMod' # tracks its main branch, as rc.local does
+SERVICES = {'ingest': (sys.executable,'-m','sensorpi.ingest','serve'),
+            'api': (sys.executable,'-m','sensorpi.api','serve')}
+LOGDIR = '/root'   # where rc.local sends the supervisor's own output
+SERVICE_STOP = 30  # s a service has to drain after SIGINT
+RESTART_DELAY = 10
+MAX_CRASHES = 5
+CRASH_WINDOW = 3600
+
+
+########################################################
+##  Child side (called from sensorpi.__main__)
+########################################################
+
+def supervised():
+    return os.environ.get(ENV) == '1'
+
+
+def handover(rdir, reason='update'):
+    ''' note when sampling stopped, for the next process '''
+    with open(os.path.join(rdir,HANDOVER),'w') as f:
+        json.dump({'stopped':time.time(), 'reason':reason, 'pid':os.getpid()}, f)
+
+
+def resumed(rdir, first_sample=None):
+    '''
+    Called by the new process once it is about to sample: logs the
+    downtime since the handover and appends it to updates.csv.
+    Returns the downtime in seconds, or None if there was no handover.
+    '''
+    path = os.path.join(rdir,HANDOVER)
+    if not os.path.exists(path): return None
+    try:
+        with open(path,'r') as f:
+            note = json.load(f)
+    except ValueError:
+        note = None
+    os.remove(path)
+    if not note: return None
+    now = first_sample or time.time()
+    down = now - note['stopped']
+    commit = os.popen('git rev-parse --short HEAD').read().strip()
+    log.info('Resumed after {} in {:.1f} s (now at {})'.format(note['reason'], down, commit))
+    logfile = os.path.join(rdir,'updates.csv')
+    new = not os.path.exists(logfile)
+    with open(logfile,'a') as f:
+        if new: f.write('stopped,resumed,downtime,reason,commit\n')
+        f.write('%d,%d,%.1f,%s,%s\n'%(note['stopped'], now, down, note['reason'], commit))
+    return down
+
+
+########################################################
+##  Supervisor
+########################################################
+
+def git(*args):
+    return subprocess.run(('git',)+args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+
+
+def behind():
+    git('fetch', '-q', 'origin')
+    return 'behind' in git('status', '--branch', '--porcelain').stdout.split('\n')[0]
+
+
+def pull_submodule():
+    '''
+    Bring SensorMod up to its main branch, as rc.local does at boot (not
+    to the commit pinned in this checkout). True if it changed.
+    '''
+    if not os.path.exists(os.path.join(SUBMODULE,'.git')): return False
+    old = git('-C', SUBMODULE, 'rev-parse', 'HEAD').stdout.strip()
+    git('-C', SUBMODULE, 'checkout', '-q', 'main')
+    out = git('-C', SUBMODULE, 'pull', '-q', 'origin', 'main')
+    if out.returncode: log.error('SensorMod pull failed - {}'.format(out.stdout.strip()))
+    return git('-C', SUBMODULE, 'rev-parse', 'HEAD').stdout.strip() != old
+
+
+def merge():
+    '''
+    Merge the fetched branch and pull SensorMod. Returns the changed paths,
+    or None if the merge failed (the checkout is left as it was).
+    '''
+    old = git('rev-parse', 'HEAD').stdout.strip()
+    out = git('merge', '--ff-only')
+    if out.returncode:
+        log.error('git merge failed - {}'.format(out.stdout.strip()))
+        return None
+    new = git('rev-parse', 'HEAD').stdout.strip()
+    changed = [p for p in git('diff', '--name-only', old, new).stdout.split('\n') if p]
+    if pull_submodule() and SUBMODULE not in changed: changed.append(SUBMODULE)
+    log.info('Merged {} -> {}: {} files changed'.format(old[:7], new[:7], len(changed)))
+    return changed
+
+
+def touched(changed, paths):
+    return [p for p in changed if any(p == r or p.startswith(r) for r in paths)]
+
+
+def needs_reboot(changed):
+    return touched(changed, REBOOT_PATHS)
+
+
+def reboot(why):
+    log.critical('Rebooting: {}'.format(why))
+    subprocess.call(['sudo','reboot'])
+    sys.exit(0)
+
+
+def reexec(why, services):
+    log.info('Restarting the supervisor: {}'.format(why))
+    os.execv(sys.executable, [sys.executable,'-m','sensorpi.supervisor'] + list(services))
+
+
+class Supervisor(object):
+
+    def __init__(self, command=(sys.executable,'-m','sensorpi'), services=(), logdir=LOGDIR):
+        self.command = list(command)
+        self.services = list(services) # names in SERVICES
+        self.logdir = logdir
+        self.running = {}
+        self.child = None
+        self.crashes = []
+        self.stopping = False
+
+    def forward(self, signum, frame):
+        ''' SIGUSR1 (profiling.py) is for the sensor, not the supervisor '''
+        if self.child and self.child.poll() is None:
+            self.child.send_signal(signum)
+
+    def terminate(self, signum, frame):
+        ''' pass SIGTERM/SIGINT on to the sensor and stop once it has exited '''
+        self.stopping = True
+        if self.child and self.child.poll() is None:
+            self.child.send_signal(signum)
+
+    def update(self):
+        '''
+        Merge if behind, rebooting if what changed needs it.
+        Returns the changed paths.
+        '''
+        if not behind(): return []
+        changed = merge()
+        if changed is None: return []
+        reboot_for = needs_reboot(changed)
+        if reboot_for: reboot('updated {}'.format(', '.join(reboot_for)))
+        return changed
+
+    ## services
+
+    def start_services(self):
+        for name in self.services:
+            with open(os.path.join(self.logdir,name+'.log'),'a') as out:
+                self.running[name] = subprocess.Popen(list(SERVICES[name]), stdout=out, stderr=subprocess.STDOUT)
+            log.info('Started {} (pid {})'.format(name, self.running[name].pid))
+
+    def stop_services(self):
+        for name,p in sorted(self.running.items()):
+            if p.poll() is None:
+                p.send_signal(signal.SIGINT)
+                try:
+                    p.wait(SERVICE_STOP)
+                except subprocess.TimeoutExpired:
+                    log.error('{} did not stop in {} s, killed'.format(name, SERVICE_STOP))
+                    p.kill()
+                    p.wait()
+            log.info('Stopped {} (exit {})'.format(name, p.returncode))
+        self.running = {}
+
+    def updated(self, changed):
+        ''' bring the services, or the supervisor itself, onto merged code '''
+        own = touched(changed, SELF_PATHS)
+        if own:
+            self.stop_services()
+            reexec('updated {}'.format(', '.join(own)), self.services)
+        elif self.running and touched(changed, SERVICE_PATHS):
+            self.stop_services()
+            self.start_services()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.terminate)
+        signal.signal(signal.SIGINT, self.terminate)
+        signal.signal(signal.SIGUSR1, self.forward)
+        self.updated(self.update()) # at boot, before anything is sampling
+        self.start_services()
+        env = dict(os.environ, **{ENV:'1'})
+        while not self.stopping:
+            started = time.time()
+            self.child = subprocess.Popen(self.command, env=env)
+            log.info('Started sensorpi (pid {})'.format(self.child.pid))
+            code = self.child.wait()
+            exited = time.time()
+
+            if self.stopping or code == 0:
+                log.info('sensorpi stopped (exit {}), supervisor exiting'.format(code))
+                break
+
+            if code == EXIT_UPDATE:
+                self.updated(self.update())
+                log.info('Restarting sensorpi {:.1f} s after it exited'.format(time.time()-exited))
+                continue
+
+            self.crashes = [t for t in self.crashes if t > exited - CRASH_WINDOW] + [exited]
+            log.error('sensorpi exited with {} after {:.0f} s'.format(code, exited-started))
+            if len(self.crashes) >= MAX_CRASHES:
+                reboot('{} crashes within {} s'.format(len(self.crashes), CRASH_WINDOW))
+            time.sleep(RESTART_DELAY)
+        self.stop_services()
+
+
+if __name__ == '__main__':
+    Supervisor(services=sys.argv[1:]).run()
@@ -0,0 +1,326 @@
+'''
+Live telemetry: each accepted sample streamed to local subscribers.
+
+The OLED is the only live view on a sensor. With TELEMETRY set in
+__main__, every row measurement() accepts is also published as a compact
+binary frame to whoever is listening on
+
+    unix:/run/sensorpi.sock      a Unix socket
+    tcp:HOST:PORT                a TCP socket (HOST may be empty for all interfaces)
+    rfcomm:/dev/rfcomm1          a bluetooth serial device (sudo rfcomm watch rfcomm1 1)
+
+Frames are a 4 byte header (MAGIC, flags, payload length) and a payload:
+
+    hello    flags HELLO, the SERIAL, sent first to each subscriber
+    sample   BODY: UNIXTIME, TYPE, PM1, PM3, PM10, T, RH, SP, RC
+             then a length byte and the instrument name if flags & INST
+             then 16 uint16 bin counts if flags & BINS
+             then the encrypted LOC if flags & LOC (never in the clear)
+
+With OPC_EXTRA the rows of the additional OPCs carry SERIAL-name (see
+multiopc), and their frames carry the name, so a subscriber can tell the
+OPCs apart; the Pi's own OPC sends no name.
+
+publish() only encodes the row once and appends it to a bounded queue per
+subscriber (QUEUE frames); a sender thread per subscriber drains it. When
+a subscriber falls behind its oldest frames are dropped and counted, so a
+slow laptop or a stalled bluetooth link never holds up runcycle.
+
+Client (on a field laptop, from a checkout of this repository):
+
+    from sensorpi.telemetry import subscribe
+    for sample in subscribe('tcp:bbsensor07.local:8766'): print(sample)
+
+Usage: python3 -m sensorpi.telemetry listen ADDRESS
+'''
+
+import os,sys,time,struct,socket,threading
+from collections import deque
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+QUEUE = 256   # frames held per subscriber before the oldest are dropped
+RETRY = 5     # s between looking for an rfcomm connection
+MAGIC = 0xBB
+HELLO,BINS,LOC,INST = 0x80,0x01,0x02,0x04
+
+HEADER = struct.Struct('<BBH')
+BODY = struct.Struct('<IB6fH')
+BINCOUNTS = struct.Struct('<16H')
+FIELDS = ('UNIXTIME','TYPE','PM1','PM3','PM10','T','RH','SP','RC')
+
+
+########################################################
+##  Frames
+########################################################
+
+def instrument(serial, pi):
+    ''' the OPC name in a row's SERIAL on the Pi with SERIAL pi, None for the Pi's own '''
+    serial,pi = serial.strip().strip('\0'), pi.strip().strip('\0')
+    if serial == pi: return None
+    return serial[len(pi)+1:] if serial.startswith(pi+'-') else serial
+
+
+def encode(row, bins=True, loc=False, serial=None):
+    '''
+    a frame for a MEASUREMENTS row as built by measurement(); serial is the
+    Pi's, to name the OPC of a row with another SERIAL
+    '''
+    flags = 0
+    payload = BODY.pack(int(row[12]), int(row[1]), row[4], row[5], row[6], row[7], row[8],
+                        row[10], min(int(row[11]), 0xFFFF))
+    name = None if serial is None else instrument(row[0], serial)
+    if name:
+        flags |= INST
+        name = name.encode('ascii','replace')[:255]
+        payload += struct.pack('B', len(name)) + name
+    if bins and row[9] is not None:
+        flags |= BINS
+        payload += BINCOUNTS.pack(*[min(int(b), 0xFFFF) for b in row[9]])
+    if loc and row[3]:
+        flags |= LOC
+        payload += bytes(row[3])
+    return HEADER.pack(MAGIC, flags, len(payload)) + payload
+
+
+def hello(serial):
+    payload = serial.strip().strip('\0').encode('ascii','replace')
+    return HEADER.pack(MAGIC, HELLO, len(payload)) + payload
+
+
+def decode(flags, payload):
+    ''' a sample dict (INSTRUMENT None for the Pi's OPC), or {'SERIAL':...} for a hello '''
+    if flags & HELLO: return {'SERIAL':payload.decode('ascii')}
+    sample = dict(zip(FIELDS, BODY.unpack_from(payload)))
+    sample['INSTRUMENT'] = None
+    at = BODY.size
+    if flags & INST:
+        sample['INSTRUMENT'] = payload[at+1:at+1+payload[at]].decode('ascii')
+        at += 1 + payload[at]
+    if flags & BINS:
+        sample['BINS'] = list(BINCOUNTS.unpack_from(payload, at))
+        at += BINCOUNTS.size
+    if flags & LOC:
+        sample['LOC'] = payload[at:]
+    return sample
+
+
+def frames(read):
+    '''
+    (flags, payload) from a byte stream, read(n) returning b'' at the end.
+    Resynchronises on MAGIC after garbage (e.g. a bluetooth link coming up).
+    '''
+    buf = b''
+    def need(n):
+        nonlocal buf
+        while len(buf) < n:
+            more = read(4096)
+            if not more: return False
+            buf += more
+        return True
+    while need(HEADER.size):
+        magic,flags,length = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            buf = buf[1:]
+            continue
+        if not need(HEADER.size + length): return
+        yield flags, buf[HEADER.size:HEADER.size+length]
+        buf = buf[HEADER.size+length:]
+
+
+########################################################
+##  Publisher
+########################################################
+
+class Subscriber(object):
+
+    def __init__(self, name, write, close, size=QUEUE):
+        self.name = name
+        self.write = write
+        self.close = close
+        self.queue = deque(maxlen=size)
+        self.ready = threading.Condition()
+        self.alive = True
+        self.sent = self.dropped = 0
+
+    def put(self, frame):
+        with self.ready:
+            if len(self.queue) == self.queue.maxlen: self.dropped += 1
+            self.queue.append(frame)
+            self.ready.notify()
+
+    def run(self, gone):
+        try:
+            while self.alive:
+                with self.ready:
+                    while self.alive and not self.queue: self.ready.wait(1)
+                    if not self.alive: break
+                    frame = self.queue.popleft()
+                self.write(frame)
+                self.sent += 1
+        except (IOError, OSError) as e:
+            log.debug('telemetry subscriber {} gone - {}'.format(self.name, e))
+        finally:
+            self.alive = False
+            try: self.close()
+            except (IOError, OSError): pass
+            gone(self)
+
+    def stop(self):
+        with self.ready:
+            self.alive = False
+            self.ready.notify()
+
+
+class Publisher(object):
+
+    def __init__(self, address, serial='', bins=True, loc=False, size=QUEUE):
+        self.address = address
+        self.serial = serial
+        self.bins = bins
+        self.loc = loc
+        self.size = size
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.published = 0
+        self.listener = None
+        kind,_,where = address.partition(':')
+        if kind == 'unix':
+            if os.path.exists(where): os.remove(where)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(where)
+        elif kind == 'tcp':
+            host,_,port = where.rpartition(':')
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((host, int(port)))
+        elif kind != 'rfcomm':
+            raise ValueError('telemetry address must be unix:, tcp: or rfcomm:, not {}'.format(address))
+        self.kind,self.where = kind,where
+        if self.listener:
+            self.listener.listen(4)
+            self.listener.settimeout(1)
+            target = self.accept
+        else:
+            target = self.device
+        threading.Thread(target=target, name='telemetry', daemon=True).start()
+
+    @property
+    def port(self):
+        return self.listener.getsockname()[1] if self.kind == 'tcp' else None
+
+    def add(self, name, write, close):
+        sub = Subscriber(name, write, close, self.size)
+        sub.put(hello(self.serial))
+        with self.lock: self.subscribers.append(sub)
+        log.info('telemetry subscriber {}'.format(name))
+        t = threading.Thread(target=sub.run, args=(self.remove,), name='telemetry-'+str(name), daemon=True)
+        t.start()
+        return sub, t
+
+    def remove(self, sub):
+        with self.lock:
+            if sub in self.subscribers: self.subscribers.remove(sub)
+        log.info('telemetry subscriber {} left: {} sent, {} dropped'.format(sub.name, sub.sent, sub.dropped))
+
+    def accept(self):
+        while not self.stopped.is_set():
+            try:
+                conn,addr = self.listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            conn.settimeout(None)
+            if self.kind == 'tcp': conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.add(addr or self.where, conn.sendall, conn.close)
+
+    def device(self):
+        ''' rfcomm: the device only exists while a phone or laptop is connected '''
+        while not self.stopped.is_set():
+            if os.path.exists(self.where):
+                try:
+                    f = open(self.where, 'wb', buffering=0)
+                except (IOError, OSError) as e:
+                    log.debug('telemetry {} - {}'.format(self.where, e))
+                else:
+                    sub,t = self.add(self.where, f.write, f.close)
+                    while t.is_alive() and not self.stopped.is_set(): t.join(1)
+            self.stopped.wait(RETRY)
+
+    def publish(self, row):
+        ''' never blocks on a subscriber '''
+        if not self.subscribers: return
+        frame = encode(row, self.bins, self.loc, self.serial)
+        with self.lock:
+            for sub in self.subscribers: sub.put(frame)
+        self.published += 1
+
+    def metrics(self):
+        with self.lock:
+            return {'published':self.published,
+                    'subscribers':[{'name':str(s.name), 'sent':s.sent, 'dropped':s.dropped,
+                                    'queued':len(s.queue)} for s in self.subscribers]}
+
+    def close(self):
+        self.stopped.set()
+        if self.listener:
+            self.listener.close()
+            if self.kind == 'unix' and os.path.exists(self.where): os.remove(self.where)
+        with self.lock: subs = list(self.subscribers)
+        for sub in subs:
+            sub.stop()
+            try: sub.close() # unblocks a sender stuck writing
+            except (IOError, OSError): pass
+
+
+########################################################
+##  Client
+########################################################
+
+def connect(address, timeout=None):
+    ''' a read(n) function for a publisher's address '''
+    kind,_,where = address.partition(':')
+    if kind == 'rfcomm':
+        f = open(where, 'rb', buffering=0)
+        return f.read
+    if kind == 'unix':
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect(where)
+    else:
+        host,_,port = where.rpartition(':')
+        s = socket.create_connection((host or 'localhost', int(port)), timeout)
+    return s.recv
+
+
+def subscribe(address, timeout=None):
+    '''
+    Yield sample dicts from a sensor (see decode), with the SERIAL of the
+    OPC that took them added (SERIAL-name for an additional OPC, as in the
+    db), until it goes away.
+    '''
+    serial = None
+    for flags,payload in frames(connect(address, timeout)):
+        sample = decode(flags, payload)
+        if flags & HELLO:
+            serial = sample['SERIAL']
+            continue
+        sample['SERIAL'] = serial if sample['INSTRUMENT'] is None else '%s-%s'%(serial, sample['INSTRUMENT'])
+        yield sample
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 2 or args[0] != 'listen':
+        print(__doc__)
+        sys.exit(1)
+    try:
+        for s in subscribe(args[1]):
+            print('{} {} PM1 {PM1:6.1f} PM2.5 {PM3:6.1f} PM10 {PM10:6.1f} T {T:5.1f} RH {RH:5.1f}{}'.format(
+                time.strftime('%H:%M:%S', time.gmtime(s['UNIXTIME'])), s['SERIAL'],
+                '  LOC %d bytes'%len(s['LOC']) if 'LOC' in s else '', **s))
+    except KeyboardInterrupt:
+        pass
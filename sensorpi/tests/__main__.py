@@ -24,6 +24,54 @@ if 'gps' in args:
   from . import gps_test
 if 'oled' in args:
   from . import oled_test
+if 'multiopc' in args:
+  from . import multiopc_test
+if 'gpsbuffer' in args:
+  from . import gpsbuffer_test
+if 'replay' in args:
+  from . import replay_test
+if 'cyclebuffer' in args:
+  from . import cyclebuffer_test
+if 'adaptive' in args:
+  from . import adaptive_test
+if 'r1frame' in args:
+  from . import r1frame_test
+if 'ingest' in args:
+  from . import ingest_test
+if 'coverage' in args:
+  from . import coverage_test
+if 'gridding' in args:
+  from . import gridding_test
+if 'spatial' in args:
+  from . import spatial_test
+if 'exposure' in args:
+  from . import exposure_test
+if 'calibration' in args:
+  from . import calibration_test
+if 'resample' in args:
+  from . import resample_test
+if 'supervisor' in args:
+  from . import supervisor_test
+if 'watchdog' in args:
+  from . import watchdog_test
+if 'dutycycle' in args:
+  from . import dutycycle_test
+if 'api' in args:
+  from . import api_test
+if 'telemetry' in args:
+  from . import telemetry_test
+if 'anomaly' in args:
+  from . import anomaly_test
+if 'columncache' in args:
+  from . import columncache_test
+if 'storage' in args:
+  from . import storage_test
+if 'partition' in args:
+  from . import partition_test
+if 'datatransfer' in args:
+  from . import datatransfer_test
+if 'profiling' in args:
+  from . import profiling_test
 
 
 
@@ -0,0 +1,53 @@
+'''
+Adaptive sampling: backs off when steady, jumps to fast on a PM spike
+or when moving, does not flap, and takes a lasting step in PM as the
+new baseline instead of staying fast.
+
+python3 -m sensorpi.tests adaptive
+'''
+from ..adaptive import RateController
+from ..gpsbuffer import FixBuffer
+import random
+
+r = random.Random(1)
+fixes = FixBuffer()
+rate = RateController(2, 15, 5, fixes)
+
+t = 0.
+def step(pm25, lat=53.79):
+    global t
+    t += rate.delay
+    fixes.append(t, {'lat':lat,'lon':-1.75,'alt':100})
+    return rate.update({'PM2.5':pm25}, t)
+
+# steady clean air - back off to the slowest rate
+for i in range(200): step(5 + r.gauss(0,.3))
+assert rate.delay == 15, rate.delay
+changes = rate.changes
+
+# a bus goes past
+assert step(40) == 2
+for i in range(3): step(38)
+assert rate.delay == 2
+
+# back to clean, back off again without flapping
+for i in range(200): step(5 + r.gauss(0,.3))
+assert rate.delay == 15
+assert rate.changes - changes < 12, rate.changes
+
+# a lasting step to a new level (indoors, say) is fast for SPIKE_MAX, then the baseline
+for i in range(2000): step(40 + r.gauss(0,.3))
+assert not rate.spike and rate.delay == 15 and abs(rate.mean - 40) < 1, (rate.spike, rate.delay, rate.mean)
+# and a spike on top of it is still caught
+assert step(80) == 2
+for i in range(200): step(40 + r.gauss(0,.3))
+assert rate.delay == 15
+
+# walking at ~1.4 m/s in clean air
+lat = 53.79
+for i in range(20):
+    lat += 1.4*rate.delay/111000.
+    step(5 + r.gauss(0,.3), lat)
+assert rate.moving and rate.delay == 2
+
+print('Adaptive sampling PASSED')
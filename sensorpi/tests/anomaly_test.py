@@ -0,0 +1,75 @@
+'''
+Anomaly: a sensor reading high, one with a shifted bin distribution and
+one that steps away from its own past are flagged and ranked; sensors at
+school are only compared with each other; days are only recomputed when
+their partition changes, or an earlier day within HISTORY does.
+
+python3 -m sensorpi.tests anomaly
+'''
+from ..anomaly import Anomaly, DAY, HISTORY
+from .fixtures import row, partitions
+import os,pickle,shutil,time
+import numpy as np
+
+tmp,parts = partitions()
+day = 1600000000//DAY*DAY
+days = 8
+rng = np.random.RandomState(1)
+
+fine = pickle.dumps([float(100//(k+1)) for k in range(16)])
+coarse = pickle.dumps([float(100//(16-k)) for k in range(16)])
+
+def rows(serial, TYPE, d, hours, gain, bins=fine):
+    out = []
+    bias = np.exp(rng.normal(0, .02))
+    for t in range(d+hours[0]*3600, d+hours[1]*3600, 60):
+        pm = 10*(1 + (t % DAY)/DAY)*gain*bias*np.exp(rng.normal(0, .05))
+        out.append(row(serial, t, pm, TYPE, 60., bins=bins))
+    return out
+
+def fleet(d, last=False):
+    out = []
+    for s in 'abcde': out += rows(s, 1, d, (8,20), 1.)
+    for s in ('s1','s2','s3','s4'): out += rows(s, 4, d, (10,15), 3.) # at school, all reading more
+    out += rows('hot', 1, d, (8,20), 1.6)
+    out += rows('coarse', 1, d, (8,20), 1., coarse)
+    out += rows('drift', 1, d, (8,20), 1.6 if last else 1.)
+    return out
+
+for i in range(days): parts.insert(fleet(day+i*DAY, i == days-1))
+
+anomaly = Anomaly(os.path.join(tmp,'anomaly.db'), parts)
+t = time.time()
+assert anomaly.update() == [day+i*DAY for i in range(days)]
+took = time.time() - t
+alerts = anomaly.alerts(day, day+days*DAY)
+found = set((a['serial'],a['kind'],(a['day']-day)//DAY) for a in alerts)
+
+assert set(s for s,kind,d in found) == {'hot','coarse','drift'}, found # nobody at school
+assert set(d for s,kind,d in found if s == 'hot' and kind == 'level') == set(range(days))
+assert not [a for a in found if a[0] == 'hot' and a[1] == 'history'] # always high is not drift
+assert set(d for s,kind,d in found if s == 'coarse') == set(range(days))
+assert set(kind for s,kind,d in found if s == 'coarse') == {'shape'}
+assert ('drift','history',days-1) in found and ('drift','level',days-1) in found
+assert not [a for a in found if a[0] == 'drift' and a[2] < days-1]
+scores = [a['score'] for a in alerts]
+assert scores == sorted(scores, reverse=True)
+print('%d sensor days compared in %.0f ms, %d alerts, top: %s'%(
+    12*days, took*1e3, len(alerts), alerts[0]))
+
+# nothing new: nothing recomputed; a late upload to the last day recomputes only it
+assert anomaly.update() == []
+parts.insert(rows('late', 1, day+(days-1)*DAY, (8,9), 1.))
+assert anomaly.update() == [day+(days-1)*DAY]
+assert anomaly.conn.execute('SELECT COUNT(*) FROM DRIFT WHERE DAY=?', (day+(days-1)*DAY,)).fetchone()[0] == 13
+assert len(anomaly.alerts(day, day+days*DAY)) == len(alerts)
+
+# a late upload to an earlier day also recomputes the days whose history includes it,
+# those past the range asked for on the next update that covers them
+parts.insert(rows('late', 1, day+2*DAY, (8,9), 1.))
+assert anomaly.update(day, day+4*DAY) == [day+2*DAY, day+3*DAY]
+assert anomaly.update() == [day+i*DAY for i in range(4, days)]
+assert anomaly.update() == []
+
+shutil.rmtree(tmp)
+print('Anomaly PASSED')
@@ -0,0 +1,102 @@
+'''
+Data API: latest rows across server.db and the partitions, rollups,
+coverage, binary records (with an additional OPC's SERIAL-name kept
+whole), ETags that only change when rows are ingested,
+and reads that never hold up the writer. Ends with a short load test.
+
+python3 -m sensorpi.tests api
+'''
+from ..api import Api, ApiServer, unpack, bench
+from ..partition import Partitions
+from ..coverage import Coverage
+from ..ingest import fake_rows
+from ..SensorMod.db import builddb
+from .. import storage, multiopc
+import os,json,shutil,sqlite3,tempfile,threading,time
+import http.client
+
+tmp = tempfile.mkdtemp()
+now = int(time.time())//3600*3600
+conn = sqlite3.connect(os.path.join(tmp,'server.db'))
+storage.tune(conn)
+builddb.builddb(conn)
+storage.insert(conn, fake_rows('a', 600, now-600))   # a: the last 10 minutes
+parts = Partitions(os.path.join(tmp,'partitions'))
+parts.insert(fake_rows('b', 3600, now-86400))        # b: only in yesterday's partition
+cov = Coverage(os.path.join(tmp,'coverage.db'))
+cov.add('a', range(now-600, now))
+
+api = Api(tmp)
+status,body,ctype,tag = api.get('/latest', {})
+latest = json.loads(body.decode('utf-8'))
+assert status == 200 and [r['serial'] for r in latest] == ['a','b']
+assert latest[0]['unixtime'] == now-1 and latest[1]['unixtime'] == now-86400+3599
+
+# unchanged: 304 for the same tag, a cache hit without it
+assert api.get('/latest', {}, etag=tag)[0] == 304
+assert api.get('/latest', {})[3] == tag and api.hits == 1 and api.misses == 1
+
+# a write from another connection invalidates
+storage.insert(conn, fake_rows('a', 1, now))
+status,body,ctype,tag2 = api.get('/latest', {}, etag=tag)
+assert status == 200 and tag2 != tag and json.loads(body.decode('utf-8'))[0]['unixtime'] == now
+
+roll = json.loads(api.get('/rollup', {'start':[str(now-86400)], 'end':[str(now+1)], 'step':['3600']})[1].decode('utf-8'))
+assert [r['count'] for r in roll if r['serial'] == 'a'] == [600, 1]
+assert sum(r['count'] for r in roll if r['serial'] == 'b') == 3600 and roll[0]['mean'] == 2.
+assert api.get('/rollup', {'field':['LOC']})[0] == 400
+assert api.get('/nothing', {})[0] == 404
+
+status,body,ctype,tag = api.get('/coverage', {}, binary=True)
+days = unpack('coverage', body)
+assert ctype == 'application/octet-stream' and set(s for s,day,seconds in days) == {'a'}
+assert sum(seconds for s,day,seconds in days) == 599
+
+# a reader holding a read transaction open does not block ingest
+with api.server.connection() as ro:
+    cursor = ro.execute('SELECT * FROM MEASUREMENTS')
+    cursor.fetchone()
+    t = time.time()
+    storage.insert(conn, fake_rows('c', 100, now))
+    assert time.time() - t < 1
+    cursor.fetchall()
+
+# over HTTP, in binary
+httpd = ApiServer(api, '127.0.0.1', 0)
+threading.Thread(target=httpd.serve_forever, daemon=True).start()
+c = http.client.HTTPConnection('127.0.0.1', httpd.server_address[1])
+c.request('GET', '/latest?format=bin')
+r = c.getresponse()
+rows = unpack('latest', r.read())
+assert r.status == 200 and [s for s,t,*_ in rows] == ['a','b','c'] and rows[0][1] == now
+c.request('GET', '/latest?format=bin', headers={'If-None-Match':r.getheader('ETag')})
+r = c.getresponse(); r.read()
+assert r.status == 304
+c.close()
+httpd.shutdown(); httpd.server_close()
+
+# a Pi with a second OPC: SERIAL and SERIAL-b stay apart in binary records
+pi = '00000000abcdef01'
+storage.insert(conn, fake_rows(pi, 5, now) + fake_rows(multiopc.serial(pi, 'b'), 5, now))
+rows = unpack('latest', api.get('/latest', {}, binary=True)[1])
+assert [r[0] for r in rows if r[0].startswith(pi)] == [pi, pi+'-b'], rows
+storage.insert(conn, fake_rows('x'*40, 1, now))
+try:
+    unpack('latest', api.get('/latest', {}, binary=True)[1])
+    raise AssertionError('truncated SERIAL not detected')
+except ValueError:
+    pass
+with conn: conn.execute('DELETE FROM MEASUREMENTS WHERE SERIAL LIKE ? OR SERIAL = ?', (pi+'%', 'x'*40))
+
+# rows rolled over into a partition are still found
+parts.insert(fake_rows('d', 10, now-7200))
+assert [r['serial'] for r in json.loads(api.get('/latest', {})[1].decode('utf-8'))] == ['a','b','c','d']
+conn.close()
+shutil.rmtree(tmp)
+
+result = bench(sensors=10, clients=4, seconds=1.)
+for mode in ('conditional','full'):
+    print('{:12s} {requests_per_s:7.0f} req/s  p50 {p50_ms:.1f} ms  p99 {p99_ms:.1f} ms'.format(mode, **result[mode]))
+assert result['conditional']['requests_per_s'] > 0 and result['unchanged'] > 0
+
+print('API PASSED')
@@ -0,0 +1,75 @@
+'''
+Calibration: a sensor with a known bias and humidity response is fitted
+against a co-located reference, corrections apply by version and time,
+corrected partitions are served from the cache until a refit (also one by
+another process), and a bin count version is not skipped without its bins.
+
+python3 -m sensorpi.tests calibration
+'''
+from ..calibration import Calibration, growth
+from .fixtures import row, partitions
+import numpy as np
+import os,pickle,shutil,time
+
+tmp,parts = partitions()
+cal = Calibration(os.path.join(tmp,'calibration.db'))
+
+r = np.random.RandomState(3)
+day = 1600000000//86400*86400
+n = 86400//5
+t = day + np.arange(n)*5
+truth = 8 + 6*np.sin(np.arange(n)/900.)**2 + r.lognormal(0,.3,n)
+rh = 60 + 30*np.sin(np.arange(n)/5000.)
+# the low cost sensor reads 70% plus humidity growth plus an offset
+sensor = .7*truth*(1 + .4*growth(rh)) + 1.5 + r.normal(0,.3,n)
+
+bins = pickle.dumps([1.]*16)
+parts.insert([row('ref', t[i]+2, truth[i], RH=rh[i], bins=bins) for i in range(n)] +
+             [row('bb01', t[i], sensor[i], RH=rh[i], bins=bins) for i in range(n)])
+
+out = cal.fit_partitions(parts, 'bb01', 'ref', day, day+86400, 'rh')
+coeffs,r2,rmse,npoints = out['PM3']
+assert r2 > .85 and npoints > 1000, out['PM3']
+linear = cal.fit_partitions(parts, 'bb01', 'ref', day, day+86400, 'linear')
+assert linear['PM3'][1] < r2, (linear['PM3'][1], r2) # the humidity terms help
+# version 2 (linear) now applies from day; refit rh as version 3 from midday
+cal.fit_partitions(parts, 'bb01', 'ref', day, day+86400, 'rh')
+cal.conn.execute("UPDATE CALIBRATION SET VALID_FROM=? WHERE VERSION=3",(day+43200,))
+cal.conn.commit()
+cal.models.clear()
+
+corrected = cal.apply('bb01', 'PM3', t, sensor, rh)
+am,pm_ = t < day+43200, t >= day+43200
+err = lambda sel: np.sqrt(((corrected[sel]-truth[sel])**2).mean())
+assert err(pm_) < err(am) < np.sqrt(((sensor-truth)**2).mean()), (err(am), err(pm_))
+assert (cal.apply('other', 'PM3', t, sensor, rh) == sensor).all()
+
+began = time.time()
+first = list(cal.corrected(parts, day, day+86400))
+cold = time.time()-began
+began = time.time()
+second = list(cal.corrected(parts, day, day+86400))
+warm = time.time()-began
+assert len(cal.cache) == 1 and all((a[3] == b[3]).all() for a,b in zip(first,second))
+print('%d rows corrected in %.0f ms, %.1f ms cached'%(2*n, cold*1e3, warm*1e3))
+cal.fit_partitions(parts, 'bb01', 'ref', day, day+86400, 'linear')
+list(cal.corrected(parts, day, day+86400))
+assert len(cal.cache) == 2 # refit invalidates
+
+# a refit from the command line, i.e. another connection, reaches both the cache and apply()
+before = cal.apply('bb01', 'PM3', t, sensor, rh)
+Calibration(os.path.join(tmp,'calibration.db')).fit_partitions(parts, 'bb01', 'ref', day, day+86400, 'rh')
+after = list(cal.corrected(parts, day, day+86400))
+assert len(cal.cache) == 3
+now = cal.apply('bb01', 'PM3', t, sensor, rh)
+assert not np.allclose(now, before) and np.allclose([a[3] for a in after if a[0] == 'bb01'][0], now)
+
+# a bins version with no bins given falls back to the version before it rather than raw PM
+cal.fit_partitions(parts, 'bb01', 'ref', day, day+86400, 'bins')
+assert np.allclose(cal.apply('bb01', 'PM3', t, sensor, rh), now)
+fine = coarse = np.full(n, 16/5.)
+assert not np.allclose(cal.apply('bb01', 'PM3', t, sensor, rh, fine, coarse), sensor)
+assert (cal.apply('bb02', 'PM3', t, sensor, rh) == sensor).all()
+
+shutil.rmtree(tmp)
+print('Calibration PASSED')
@@ -0,0 +1,90 @@
+'''
+Column cache: cached columns match a decode of the partition, new rows
+are appended without decoding the old ones, a day evicted under the
+budget is decoded again when asked for, and a partition that is made
+again (also with more rows than were cached) or deleted is dropped.
+
+python3 -m sensorpi.tests columncache
+'''
+from ..columncache import ColumnCache, ROWBYTES, DAY
+from ..partition import Partitions
+from ..decoded import chunks
+import numpy as np
+import os,pickle,shutil,sqlite3,tempfile,time
+
+tmp = tempfile.mkdtemp()
+parts = Partitions(os.path.join(tmp,'partitions'))
+day = 1600000000//DAY*DAY
+r = np.random.RandomState(3)
+
+def rows(serial, start, n):
+    out = []
+    for i in range(n):
+        pm = float(r.lognormal(2, .5))
+        out.append((serial, 2, '', b'', pm/2, pm, pm*2, 20., 50., pickle.dumps([float(b+i) for b in range(16)]), 1., i,
+                    start + i*5))
+    return out
+
+for d in range(3):
+    for s in ('a\0','b'): parts.insert(rows(s, day + d*DAY, 5000))
+
+cache = ColumnCache(os.path.join(tmp,'columns'), parts)
+assert cache.update() == 30000
+assert cache.serials() == ['a','b'] and cache.size() == 30000*ROWBYTES
+
+c = cache.get('a', day+DAY)
+assert isinstance(c['PM3'], np.memmap) and not c['PM3'].flags.writeable
+assert len(c['rowid']) == 5000 and c['BINS'].shape == (5000,16) and c['BINS'][7,3] == 10.
+assert np.isnan(c['lat']).all() # no key, no positions
+src = sqlite3.connect(parts.path(day+DAY))
+ref = np.concatenate([x['PM3'][x['SERIAL'] == 'a'] for x in chunks(src, None)])
+assert np.array_equal(c['PM3'], ref)
+assert [d for d,c in cache.days('b', day+DAY)] == [day+DAY, day+2*DAY]
+
+# timing: open from the cache against decoding the day from SQLite
+began = time.time()
+for i in range(20): c = cache.get('b', day); c['PM3'].mean()
+cached = (time.time()-began)/20
+began = time.time()
+for x in chunks(src, None, bins=True): pass
+decoding = time.time()-began
+print('a SERIAL/day from the cache in %.2f ms, decoding its partition %.0f ms'%(cached*1e3, decoding*1e3))
+assert cached < decoding
+src.close()
+
+# new rows: only they are decoded and appended; an interrupted append is cut off
+with open(cache.path('b', day+2*DAY, 'PM3'), 'ab') as f: f.write(b'half written')
+parts.insert(rows('b', day+2*DAY+25000, 100))
+assert cache.update() == 100
+c = cache.get('b', day+2*DAY)
+assert len(c['PM3']) == 5100 and c['UNIXTIME'][-1] == day+2*DAY+25000+99*5
+assert os.path.getsize(cache.path('b', day+2*DAY, 'PM3')) == 5100*8
+assert cache.update() == 0
+
+# over budget the least recently used days go, and come back on demand
+cache.get('a', day)
+cache.evict(budget=2*5100*ROWBYTES)
+cached = dict(((s,d),k) for s,d,k in cache.conn.execute('SELECT SERIAL,DAY,CACHED FROM ENTRIES'))
+assert cached[('a',day)] == 1 and cached[('b',day+2*DAY)] == 1 and sum(cached.values()) == 2
+assert not os.path.exists(cache.path('a', day+DAY))
+parts.insert(rows('a', day+DAY+25000, 10)) # rows for an evicted day are not appended on their own
+cache.update()
+c = cache.get('a', day+DAY)
+assert cache.misses == 1 and len(c['PM3']) == 5010 and np.array_equal(c['PM3'][:5000], ref)
+
+# a partition emptied and refilled is recached, one deleted is dropped
+path = parts.path(day)
+os.remove(path)
+parts.insert(rows('c', day, 10))
+cache.update()
+assert cache.get('a', day) is None and len(cache.get('c', day)['PM3']) == 10
+os.remove(path) # made again with more rows than were cached
+parts.insert(rows('d', day, 30))
+cache.update()
+assert cache.get('c', day) is None and len(cache.get('d', day)['PM3']) == 30
+os.remove(parts.path(day+DAY))
+cache.update()
+assert cache.get('b', day+DAY) is None and not os.path.exists(cache.path('b', day+DAY))
+
+shutil.rmtree(tmp)
+print('Column cache PASSED')
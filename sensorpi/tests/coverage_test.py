@@ -0,0 +1,50 @@
+'''
+Coverage index: intervals merge across batches and out of order
+arrivals, re-adding is harmless, and gap/uptime queries match a scan.
+
+python3 -m sensorpi.tests coverage
+'''
+from ..coverage import Coverage, DAY
+import os,random,tempfile,time
+
+tmp = tempfile.mkdtemp()
+cov = Coverage(os.path.join(tmp,'coverage.db'))
+r = random.Random(4)
+
+# two sensors over three days: a on 08-16 every 5 s, b all day with an outage
+start = 1600000000//DAY*DAY
+times = {'a':[], 'b':[]}
+for d in range(3):
+    day = start + d*DAY
+    times['a'] += range(day+8*3600, day+16*3600, 5)
+    times['b'] += [t for t in range(day, day+DAY, 10) if not day+3600 <= t < day+3*3600]
+
+# arrive as shuffled batches, some twice
+batches = [(s,times[s][i:i+500]) for s in times for i in range(0,len(times[s]),500)]
+r.shuffle(batches)
+for serial,batch in batches + batches[:20]:
+    cov.add(serial, batch)
+
+sensors = cov.sensors()
+assert sensors['a'][2] == 3 and sensors['b'][2] == 4, sensors
+
+gaps = cov.gaps('a', start, start+3*DAY, 3600)
+assert len(gaps) == 4 and gaps[0] == (start, start+8*3600), gaps
+gaps = cov.gaps('b', start, start+3*DAY, 3600)
+assert [(g[0]-start, g[1]-start) for g in gaps] == [(d*DAY+3590, d*DAY+3*3600) for d in range(3)], gaps
+assert cov.gaps('b', start, start+DAY, 86400) == []
+
+began = time.time()
+up = cov.uptime(start, start+3*DAY)
+took = time.time()-began
+assert sorted(up) == [start, start+DAY, start+2*DAY]
+for day,sensors in up.items():
+    assert sensors['a'] == 8*3600-5, sensors
+    assert abs(sensors['b'] - 22*3600) <= 20, sensors
+print('uptime of 3 days in %.2f ms'%(took*1e3))
+
+cov.close()
+for f in os.listdir(tmp): os.remove(os.path.join(tmp,f))
+os.rmdir(tmp)
+
+print('Coverage PASSED')
@@ -0,0 +1,85 @@
+'''
+Columnar cycle buffer: round trip through sqlite, and what a cycle keeps
+allocated (bytes and blocks, counted from before the buffer exists)
+against the old list of lists.
+
+python3 -m sensorpi.tests cyclebuffer
+'''
+from ..cyclebuffer import CycleBuffer
+import os,pickle,sqlite3,tracemalloc
+
+N = 720 # an hour at 5 s
+
+def row(i):
+    return ['SERIAL0000000000', 2, '%06d'%i, os.urandom(256), 1.+i, 2.+i, 3.+i, 20.5, 50.5,
+            [float(b) for b in range(16)], 1.02, i%3, 1600000000+i]
+
+rows = [row(i) for i in range(N)]
+
+buf = CycleBuffer(8)
+for r in rows: buf.append(r)
+assert len(buf) == N and buf.capacity >= N
+
+conn = sqlite3.connect(':memory:')
+conn.execute('CREATE TABLE MEASUREMENTS (SERIAL,TYPE,TIME,LOC,PM1,PM3,PM10,T,RH,BINS,SP,RC,UNIXTIME)')
+conn.executemany('INSERT INTO MEASUREMENTS VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)', buf.rows())
+back = conn.execute('SELECT * FROM MEASUREMENTS ORDER BY rowid').fetchall()
+for r,b in zip(rows,back):
+    assert list(b[:9]) == r[:9], (b[:9],r[:9])
+    assert pickle.loads(b[9]) == r[9] and list(b[10:]) == r[10:]
+
+# reuse: a second cycle allocates nothing new
+capacity = buf.capacity
+buf.reset()
+for r in rows: buf.append(r)
+assert buf.capacity == capacity
+
+def old(n):
+    ''' the list of lists runcycle used to return '''
+    out = []
+    for i in range(n):
+        r = row(i)
+        out.append([r[0],r[1],r[2],r[3],float(r[4]),float(r[5]),float(r[6]),float(r[7]),float(r[8]),
+                    pickle.dumps(r[9]),float(r[10]),int(r[11]),int(r[12])])
+    return out
+
+def new(n):
+    ''' sized for the cycle up front, as __main__ does '''
+    buf = CycleBuffer(n + 8)
+    for i in range(n): buf.append(row(i))
+    return buf
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+# rows are made inside the measurement, as measurement() makes them per
+# sample, so the LOC and bins each sample brings are counted in both
+held = {}
+for f in (old,new):
+    r0 = rss()
+    tracemalloc.start()
+    kept = f(N)
+    snap = tracemalloc.take_snapshot()
+    size,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snap.statistics('filename'))
+    held[f.__name__] = size,blocks
+    print('%-4s %8d bytes in %5d blocks held after a cycle of %d rows (peak %d, rss %+d kB)'%(
+        f.__name__,size,blocks,N,peak,(rss()-r0)//1024))
+    if f is new: buf2 = kept
+    else: del kept
+
+# the buffer holds less, in a handful of blocks rather than ~12 objects a row
+assert held['new'][0] < held['old'][0] and held['new'][1] < held['old'][1]/100
+
+# and a later cycle in the same buffer keeps nothing new
+tracemalloc.start()
+buf2.reset()
+for i in range(N): buf2.append(row(i))
+size,peak = tracemalloc.get_traced_memory()
+tracemalloc.stop()
+print('next cycle in the same buffer: %d bytes held'%size)
+assert size < 4096
+
+print('Cycle buffer PASSED')
@@ -0,0 +1,85 @@
+'''
+USB export: each export holds only the rows since the last one, a table
+rebuilt (or emptied by rollover) and refilled past the old mark is
+exported whole, and the csv goes through the same verified manifest.
+
+python3 -m sensorpi.tests datatransfer
+'''
+from ..SensorMod.db import builddb
+from .. import storage
+import os,sys,shutil,sqlite3,tempfile,importlib.util
+
+spec = importlib.util.spec_from_file_location('datatransfer',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','usb','datatransfer.py'))
+dt = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dt)
+
+tmp = tempfile.mkdtemp()
+dt.DEST = os.path.join(tmp,'stick')
+spool = os.path.join(tmp,'spool')
+os.makedirs(dt.DEST); os.makedirs(spool)
+dt.SERIAL = '00000000abcdef01'
+db = os.path.join(tmp,'sensor.db')
+manifest = []
+
+conn = sqlite3.connect(db)
+storage.tune(conn)
+builddb.builddb(conn)
+t = [1600000000]
+def add(n):
+    rows = [('serial', 2, '', b'', 1., 2., 3., 20., 50., b'', 1., 0, t[0]+i) for i in range(n)]
+    t[0] += n
+    storage.insert(conn, rows)
+
+def rebuild():
+    conn.execute('DROP TABLE MEASUREMENTS')
+    builddb.builddb(conn)
+
+def exported():
+    ''' UNIXTIMEs in the file the last manifest entry names '''
+    f = sqlite3.connect(os.path.join(dt.DEST, manifest[-1]['file']))
+    out = [u for u, in f.execute('SELECT UNIXTIME FROM MEASUREMENTS ORDER BY rowid')]
+    f.close()
+    return out
+
+add(100)
+mark = dt.export(db, None, spool, manifest)
+assert mark['rowid'] == 100 and exported() == list(range(1600000000, 1600000100))
+add(50)
+mark = dt.export(db, mark, spool, manifest)
+assert exported() == list(range(1600000100, 1600000150)) and manifest[-1]['first_rowid'] == 101
+assert dt.export(db, mark, spool, manifest) == mark and len(manifest) == 2 # nothing new
+
+# rebuilt after an upload and refilled past the old mark: all of it
+rebuild()
+add(200)
+mark = dt.export(db, mark, spool, manifest)
+assert exported() == list(range(1600000150, 1600000350)), len(exported())
+# rebuilt and still shorter than the mark
+rebuild()
+add(10)
+mark = dt.export(db, mark, spool, manifest)
+assert exported() == list(range(1600000350, 1600000360))
+# rollover deleting the marked row and some after it (now in partitions): the rest
+add(5)
+conn.execute('DELETE FROM MEASUREMENTS WHERE rowid <= 12'); conn.commit()
+add(3)
+mark = dt.export(db, mark, spool, manifest)
+assert exported() == list(range(1600000362, 1600000368))
+assert len(set(e['file'] for e in manifest)) == len(manifest) # never one name twice
+# a mark from before row digests: everything, rather than a gap
+assert dt.export(db, 13, spool, manifest)['rowid'] == 18 and len(exported()) == 6
+for entry in manifest: assert dt.verify(os.path.join(dt.DEST, entry['file']), entry['sha256'])
+
+# the csv
+csv = os.path.join(tmp,'simplesensor.csv')
+with open(csv,'w') as f: f.write('SERIAL,PM1\n' + 'serial,1.0\n'*20)
+meta = dt.snapshot_csv(csv, spool)
+assert dt.transfer(meta, manifest)
+assert manifest[-1]['rows'] == 20 and manifest[-1]['file'].endswith('simplesensor.csv')
+assert dt.verify(os.path.join(dt.DEST, manifest[-1]['file']), manifest[-1]['sha256'])
+assert dt.loadjson(os.path.join(dt.DEST,'manifest.json'), []) == manifest
+
+conn.close()
+shutil.rmtree(tmp)
+print('Datatransfer PASSED')
@@ -0,0 +1,54 @@
+'''
+Warm standby: consecutive cycles keep the OPC running and lose no time,
+warm-up readings and a first histogram spanning a long gap are dropped,
+standby powers it down, and a replayed week
+covers more of the day than power cycling every cycle.
+
+python3 -m sensorpi.tests dutycycle
+'''
+from ..dutycycle import DutyCycle
+from ..simulate import SimOPC
+from ..clock import VirtualClock
+from ..replay import replay
+from .. import loop
+
+clock = VirtualClock(1600000000)
+opc = SimOPC(seed=1, latency=0, clock=clock)
+duty = DutyCycle(opc, clock, warmup=3)
+measurement = lambda pm, now: float(pm['Sampling Period'])
+
+# cold: a second to power up, the first histogram thrown away, the next dropped as warm-up
+t = clock.time()
+rows = loop.runcycle(duty, 60, 2, measurement, clock)
+assert opc.powered and duty.warm and duty.cold == 1 and duty.warming == 2
+assert len(rows) == 29 and clock.time() - t == 61
+
+# warm: no waits, every reading kept, and the first covers the time in between
+clock.sleep(7)
+t = clock.time()
+rows = loop.runcycle(duty, 60, 2, measurement, clock)
+assert duty.warm_starts == 1 and duty.cold == 1 and duty.warming == 2
+assert len(rows) == 30 and clock.time() - t == 60 and rows[0] == 9
+
+# warm after a 10 minute upload: the first histogram's period is the whole gap, so it is dropped
+clock.sleep(600)
+rows = loop.runcycle(duty, 60, 2, measurement, clock)
+assert duty.warm_starts == 2 and duty.overlong == 1 and len(rows) == 29 and max(rows) <= 2
+
+# standby powers it down; the next cycle is cold again
+duty.standby()
+assert not opc.powered and not duty.warm
+loop.runcycle(duty, 10, 2, measurement, clock)
+m = duty.metrics()
+assert m['cold'] == 2 and m['warm'] == 2 and m['samples'] == m['warming'] + m['overlong'] + 29 + 30 + 29 + 4, m
+assert 0 < m['coverage'] < 1
+
+cold, _ = replay(7, 'bbsensor', start=1600041600)
+warm, lines = replay(7, 'bbsensor', start=1600041600, warm=True)
+print(lines[-1])
+gain = (warm.covered - cold.covered)/3600.
+print('warm standby: %.1f h more sampled in a week, %d cold starts instead of %d cycles'%(
+    gain, warm.alpha.cold, warm.alpha.cold + warm.alpha.warm_starts))
+assert gain > 0 and warm.alpha.warm_starts > warm.alpha.cold
+
+print('DutyCycle PASSED')
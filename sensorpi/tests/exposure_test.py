@@ -0,0 +1,46 @@
+'''
+Exposure: sampling periods and gaps weight the dose correctly, rows are
+split into microenvironments, and cached days are only recomputed when
+their partition changes.
+
+python3 -m sensorpi.tests exposure
+'''
+from ..exposure import Exposure, DAY
+from .fixtures import row, partitions
+import os,shutil
+
+tmp,parts = partitions()
+day = 1600000000//DAY*DAY
+
+rows = []
+# a: commute 07:00-08:00 at 20 ug/m3 every 5 s, then a 10 minute gap, then 30 at school 10:00-11:00 every 10 s
+rows += [row('a', day+7*3600+i, 20., 2) for i in range(0, 3600, 5)]
+rows += [row('a', day+10*3600+i, 30., 4, 10.) for i in range(0, 3600, 10)]
+# b: a static sensor with a spike and a long gap (which the MAXSP cap must not fill)
+rows += [row('b', day+i, 10., 1) for i in range(0, 3600, 5)]
+rows += [row('b', day+3600+i, 60., 1) for i in range(0, 600, 5)]
+rows += [row('b', day+8*3600, 10., 1, 3600.)]
+parts.insert(rows)
+
+exposure = Exposure(os.path.join(tmp,'exposure.db'), parts)
+assert exposure.update() == [day]
+got = dict(((r['serial'],r['env']),r) for r in exposure.get(day, day+DAY))
+
+commute = got[('a','commute')]
+assert commute['seconds'] == 3600 and abs(commute['mean'] - 20) < 1e-9
+assert abs(commute['dose'] - 20.) < 1e-9 # 20 ug/m3 for an hour
+school = got[('a','school')]
+assert school['seconds'] == 3600 and school['peak'] == 30. and school['above']['25'] == 3600
+static = got[('b','static')]
+assert static['seconds'] == 3600 + 600 + 60, static['seconds']
+assert abs(static['dose'] - (10*3600 + 60*600 + 10*60)/3600.) < 1e-9
+assert static['above']['50'] == 600 and static['peak'] == 60.
+
+# nothing new: nothing recomputed; a new row: only its day
+assert exposure.update() == []
+parts.insert([row('a', day+DAY+3600, 5., 2)])
+assert exposure.update() == [day+DAY]
+assert [r['day'] for r in exposure.get(day, day+2*DAY)].count(day+DAY) == 1
+
+shutil.rmtree(tmp)
+print('Exposure PASSED')
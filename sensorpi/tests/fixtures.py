@@ -0,0 +1,17 @@
+'''
+Shared by the partition analysis tests (exposure, calibration, resample,
+anomaly): MEASUREMENTS rows and a Partitions in a temporary directory.
+'''
+from ..partition import Partitions
+import os,tempfile
+
+
+def row(serial, t, pm, TYPE=2, sp=5., T=20., RH=50., bins=b'', TIME=''):
+    ''' a MEASUREMENTS tuple reading pm as PM1, PM2.5 and PM10 '''
+    return (serial, TYPE, TIME, b'', pm, pm, pm, T, RH, bins, sp, 0, int(t))
+
+
+def partitions():
+    ''' (tmp, Partitions under tmp); shutil.rmtree(tmp) when done '''
+    tmp = tempfile.mkdtemp()
+    return tmp, Partitions(os.path.join(tmp,'partitions'))
@@ -0,0 +1,29 @@
+'''
+GPS fix buffer: interpolation, fix age and wrap around.
+
+python3 -m sensorpi.tests gpsbuffer
+'''
+from ..gpsbuffer import FixBuffer, fixtime
+
+b = FixBuffer(8)
+for s in range(20):
+    assert b.append(1000.+s, {'gpstime':'','lat':50.+s*.001,'lon':-1.,'alt':100.,'nsat':7})
+assert not b.append(1010., {}) # out of order
+
+loc = b.at(1015.5)
+print(loc)
+assert loc['lat'] == round(50.0155,7)
+assert loc['age'] == .5
+assert loc['nsat'] == 7
+
+loc = b.at(1030) # after the newest fix: no extrapolation
+assert loc['lat'] == 50.019 and loc['age'] == 11
+
+assert b.at(900)['lat'] == 50.012 # oldest fix still buffered
+
+assert FixBuffer().at(1000)['lat'] == ''
+
+assert fixtime('235959', now=86400*10 + 60) == 86400*10 - 1 # previous day
+assert fixtime('000100', now=86400*10 + 60) == 86400*10 + 60
+
+print('GPS buffer PASSED')
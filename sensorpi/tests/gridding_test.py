@@ -0,0 +1,89 @@
+'''
+Gridding: cell statistics match a direct calculation, grids merge
+exactly, a map survives a save and load, and updating a map adds rows
+rolled late into old partitions exactly once.
+
+python3 -m sensorpi.tests gridding
+'''
+from ..gridding import Grid, update
+from ..partition import Partitions
+from .. import decoded
+import numpy as np
+import os,shutil,tempfile,time
+
+r = np.random.RandomState(7)
+n = 2000000
+lat = r.uniform(53.70, 53.90, n)
+lon = r.uniform(-1.90, -1.60, n)
+t = 1600000000 + r.randint(0, 30*86400, n)
+pm = r.lognormal(2, .6, n)
+lat[:1000] = np.nan # no fix
+lon[1000:2000] = 0. # off the map
+
+grid = Grid()
+began = time.time()
+for i in range(0, n, 250000):
+    grid.add(lat[i:i+250000], lon[i:i+250000], pm[i:i+250000], t[i:i+250000])
+took = time.time()-began
+print('%d points on %d cells in %.2f s'%(n, grid.cells, took))
+assert grid.count.sum() == n-2000
+
+# one cell against the points in it
+i = np.floor((lat-53.70)/grid.dlat)
+j = np.floor((lon+1.90)/grid.dlon)
+hour = (t % 86400)/3600.
+inside = (i == 100) & (j == 80) & (hour >= 9) & (hour < 15)
+assert grid.count[2,100,80] == inside.sum()
+assert abs(grid.mean()[2,100,80] - pm[inside].mean()) < 1e-9
+assert abs(grid.std()[2,100,80] - pm[inside].std()) < 1e-6
+p50 = grid.percentile(50)[2,100,80]
+assert abs(np.log(p50/np.median(pm[inside]))) < .2, (p50, np.median(pm[inside]))
+day = grid.mean(axis=0)
+allday = (i == 100) & (j == 80)
+assert abs(day[100,80] - pm[allday].mean()) < 1e-9
+
+# two halves merged equal the whole
+a,b = Grid(),Grid()
+a.add(lat[:n//2], lon[:n//2], pm[:n//2], t[:n//2]); a.sources = ['a']
+b.add(lat[n//2:], lon[n//2:], pm[n//2:], t[n//2:]); b.sources = ['b']
+a.merge(b)
+assert (a.count == grid.count).all() and (a.hist == grid.hist).all()
+assert np.allclose(a.sum, grid.sum)
+
+tmp = tempfile.mkdtemp()
+path = os.path.join(tmp,'map.npz')
+a.save(path)
+print('map file %d kB'%(os.path.getsize(path)//1024))
+c = Grid.load(path)
+assert c.sources == ['a','b'] and c.geometry() == a.geometry()
+assert (c.hist == a.hist).all()
+os.remove(path)
+
+# LOC in plain text here; on the server it is decrypted with the private key
+decoded.decrypt = lambda locs, key: np.array([decoded.parse_loc(l) for l in locs]).reshape(-1,6)
+parts = Partitions(os.path.join(tmp,'partitions'))
+day = 1600000000//86400*86400
+def rows(k, t0):
+    return [('s', 2, '', ('%.17g_%.17g'%(lat[i],lon[i])).encode(), pm[i], pm[i], pm[i], 20., 50., b'', 1., 0, t0+i)
+            for i in range(k, k+1000)]
+parts.insert(rows(2000, day) + rows(3000, day+86400))
+mapfile = os.path.join(tmp,'map.npz')
+m = update(mapfile, parts, None)
+assert m.count.sum() == 2000 and len(m.sources) == 2
+# a sensor uploads late: its rows roll into yesterday's partition, which is not the newest
+parts.insert(rows(4000, day+3600))
+m = update(mapfile, parts, None)
+assert m.count.sum() == 3000
+m = update(mapfile, parts, None)
+assert m.count.sum() == 3000
+whole = Grid()
+whole.add(lat[2000:5000], lon[2000:5000], pm[2000:5000], np.zeros(3000))
+assert (m.count.sum(axis=0) == whole.count.sum(axis=0)).all() and np.allclose(m.sum.sum(axis=0), whole.sum.sum(axis=0))
+# rows taken out of a partition: the map is rebuilt rather than left counting them
+conn = parts.connect(day)
+with conn: conn.execute('DELETE FROM MEASUREMENTS WHERE rowid <= 500')
+conn.close()
+assert update(mapfile, parts, None).count.sum() == 2500
+shutil.rmtree(tmp)
+
+print('Gridding PASSED')
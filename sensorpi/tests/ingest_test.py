@@ -0,0 +1,89 @@
+'''
+Ingest server: many simultaneous syncs all land in the db, batches are
+group committed, a malformed batch is refused without losing the rest, and
+a sync that drops partway can be retried without storing any row twice.
+push() carries the sensor's profiling reports and removes them once sent.
+
+python3 -m sensorpi.tests ingest
+'''
+from .. import ingest
+from ..SensorMod.db import builddb
+import asyncio,os,shutil,tempfile,sqlite3,threading
+
+tmp = tempfile.mkdtemp()
+dbfile = os.path.join(tmp,'server.db')
+
+async def main():
+    r = await ingest.bench(40, 1200, dbfile)
+    print('{sensors} sensors: {rows_per_s:.0f} rows/s, sync p99 {p99:.2f} s, {commits} group commits'.format(**r))
+    assert r['rows'] == r['stored'] == 40*1200, r
+    assert r['commits'] < 40*1200//ingest.BATCH, r
+
+    server = ingest.IngestServer(dbfile, '127.0.0.1', 0)
+    await server.start()
+    bad = ingest.fake_rows('broken', 3)
+    bad[1] = bad[1][:10]
+    try:
+        await ingest.sync('127.0.0.1', server.port, 'broken', bad)
+        raise AssertionError('short row accepted')
+    except IOError:
+        pass
+    assert await ingest.sync('127.0.0.1', server.port, 'fine', ingest.fake_rows('fine', 10)) == 10
+
+    # the link drops after two batches have gone; the retry has more rows and batches them differently
+    device = [(i+1,) + row for i,row in enumerate(ingest.fake_rows('retry', 1500))]
+    def dropping(rows, after):
+        for i,row in enumerate(rows):
+            if i == after: raise ConnectionError('link lost')
+            yield row
+    try:
+        await ingest.sync('127.0.0.1', server.port, 'retry', dropping(device[:1200], 1100), generation='g1')
+        raise AssertionError('dropped sync succeeded')
+    except ConnectionError:
+        pass
+    for i in range(100):
+        if server.rows == 10 + 2*ingest.BATCH: break
+        await asyncio.sleep(.05)
+    assert server.rows == 10 + 2*ingest.BATCH, server.rows
+    assert await ingest.sync('127.0.0.1', server.port, 'retry', device, batch=300, generation='g1') == 1500
+    assert server.skipped == 2*ingest.BATCH, server.skipped
+    # a rebuilt device db is a new generation: the same rowids are new rows
+    assert await ingest.sync('127.0.0.1', server.port, 'retry', device[:100], generation='g2') == 100
+    await server.stop()
+
+asyncio.new_event_loop().run_until_complete(main())
+
+conn = sqlite3.connect(dbfile)
+assert conn.execute("SELECT count(*) FROM MEASUREMENTS WHERE SERIAL='broken'").fetchone()[0] == 0
+assert conn.execute("SELECT count(*) FROM MEASUREMENTS WHERE SERIAL='fine'").fetchone()[0] == 10
+assert conn.execute("SELECT count(*), count(DISTINCT UNIXTIME) FROM MEASUREMENTS WHERE SERIAL='retry'").fetchone() == (1600, 1500)
+conn.close()
+
+# push() from a device db, with two profiling reports waiting on the sensor
+sensor = os.path.join(tmp,'sensor')
+os.makedirs(os.path.join(sensor,'profiles'))
+for name in ('profile_1600000000.txt','profile_1600000100.txt','notes.txt'):
+    with open(os.path.join(sensor,'profiles',name),'w') as f: f.write('report '+name)
+device = sqlite3.connect(os.path.join(sensor,'device.db'))
+builddb.builddb(device)
+with device: device.executemany(ingest.storage.INSERT, ingest.fake_rows('pusher', 20))
+
+loop = asyncio.new_event_loop()
+server = ingest.IngestServer(dbfile, '127.0.0.1', 0, reportdir=os.path.join(tmp,'profiles'))
+loop.run_until_complete(server.start())
+thread = threading.Thread(target=loop.run_forever)
+thread.start()
+try:
+    assert ingest.push('pusher', device, '127.0.0.1', server.port, reportdir=os.path.join(sensor,'profiles'))
+finally:
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+loop.run_until_complete(server.stop())
+device.close()
+assert server.reports == 2 and os.listdir(os.path.join(sensor,'profiles')) == ['notes.txt']
+assert sorted(os.listdir(os.path.join(tmp,'profiles','pusher'))) == ['profile_1600000000.txt','profile_1600000100.txt']
+assert open(os.path.join(tmp,'profiles','pusher','profile_1600000100.txt')).read() == 'report profile_1600000100.txt'
+
+shutil.rmtree(tmp)
+
+print('Ingest PASSED')
@@ -0,0 +1,64 @@
+'''
+Multi OPC acquisition with simulated instruments.
+Throughput should grow linearly with the number of instruments; the first
+keeps the Pi's SERIAL, the others get SERIAL-name. A read that never
+returns is abandoned without stalling the cycle or the other OPCs.
+
+python3 -m sensorpi.tests multiopc
+'''
+from ..simulate import SimOPC
+from .. import multiopc
+import threading,time
+
+SAMPLE_LENGTH = 4
+SAMPLING_DELAY = .05
+
+def measurement(pm, now):
+    return ['00000000abcdef01\0', 1, now.strftime("%H%M%S"), b'', pm['PM1'], pm['PM2.5'], pm['PM10'],
+            pm['Temperature'], pm['Humidity'], [pm['Bin %d'%i] for i in range(16)], pm['Sampling Period'], pm['Reject count glitch'], int(now.strftime("%s"))]
+
+rates = {}
+for n in (1,2,4):
+    stored = []
+    instruments = [multiopc.Instrument('s%d'%i, SimOPC(seed=i, latency=.02),
+                                       multiopc.serial('00000000abcdef01\0','s%d'%i) if i else None) for i in range(n)]
+    start = time.time()
+    written = multiopc.run(instruments, SAMPLE_LENGTH, SAMPLING_DELAY, measurement, lambda batch: stored.extend(batch.rows(copy=True)))
+    assert written == len(stored)
+    assert set(r[0] for r in stored) == set(['00000000abcdef01\0'] + ['00000000abcdef01-s%d'%i for i in range(1,n)])
+    rates[n] = written/float(SAMPLE_LENGTH)
+    print('%d instruments: %d rows, %.1f rows/s'%(n,written,rates[n]))
+    for inst in instruments:
+        print('   ',inst.metrics())
+
+assert rates[4] > 3.5*rates[1], 'throughput did not scale'
+
+class Stuck(SimOPC):
+    ''' its tenth read blocks until released '''
+    released = threading.Event()
+    reads = 0
+    def histogram(self):
+        self.reads += 1
+        if self.reads == 10: self.released.wait()
+        return SimOPC.histogram(self)
+
+multiopc.HANG = 1.
+stuck = Stuck(seed=9, latency=.02)
+instruments = [multiopc.Instrument('a', SimOPC(seed=8, latency=.02)), multiopc.Instrument('b', stuck, 'b')]
+for cycle in range(2):
+    stored = []
+    start = time.time()
+    written = multiopc.run(instruments, 2, SAMPLING_DELAY, measurement, lambda batch: stored.extend(batch.rows(copy=True)))
+    took = time.time() - start
+    serials = set(r[0] for r in stored)
+    print('cycle %d with a stuck OPC: %d rows in %.1f s from %s'%(cycle, written, took, sorted(serials)))
+    assert took < 2 + multiopc.HANG + 3.5 and instruments[1].hung() and stuck.powered
+    assert written > 20 and len([r for r in stored if r[0] == 'b']) == (8 if cycle == 0 else 0)
+stuck.released.set()
+instruments[1].thread.join(5)
+assert not instruments[1].hung()
+stored = []
+multiopc.run(instruments, 1, SAMPLING_DELAY, measurement, lambda batch: stored.extend(batch.rows(copy=True)))
+assert 'b' in set(r[0] for r in stored) and not stuck.powered
+
+print('Multi OPC PASSED')
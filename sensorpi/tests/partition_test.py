@@ -0,0 +1,73 @@
+'''
+Partitions: rows are routed to per-day files, rollover empties the landing
+db into them without copying rows twice when the landing db lost its
+DELETE to a power cut, view() answers one query over any range (attached
+up to the ATTACH limit, copied beyond it), and expiry only touches
+uploaded partitions.
+
+python3 -m sensorpi.tests partition
+'''
+from ..partition import Partitions, COLUMNS
+from ..SensorMod.db import builddb
+from .. import storage
+import os,shutil,sqlite3,tempfile
+
+tmp = tempfile.mkdtemp()
+parts = Partitions(os.path.join(tmp,'partitions'))
+day = 1600000000//86400*86400
+
+def row(serial, t):
+    return (serial, 2, '', b'', 1., 2., 3., 20., 50., b'', 1., 0, t)
+
+# 12 days through the landing db
+landing = sqlite3.connect(os.path.join(tmp,'server.db'))
+storage.tune(landing)
+builddb.builddb(landing)
+storage.insert(landing, [row('a', day + d*86400 + i*60) for d in range(12) for i in range(100)])
+storage.insert(landing, [row('b', None)]) # no time: stays behind
+before = sqlite3.connect(':memory:')
+landing.backup(before)
+assert parts.rollover(landing) == 1200
+assert landing.execute('SELECT count(*) FROM MEASUREMENTS').fetchone()[0] == 1
+# the partitions kept their commits but the landing db came back as it was, and more rows arrived
+before.backup(landing)
+before.close()
+storage.insert(landing, [row('a', day + 11*86400 + 7000 + i) for i in range(5)])
+assert parts.rollover(landing) == 5
+assert landing.execute('SELECT count(*) FROM MEASUREMENTS').fetchone()[0] == 1
+assert parts.signature(day + 11*86400) == '105:105' and parts.signature(day) == '100:100'
+# rowids handed out again after the rollover are new rows
+storage.insert(landing, [row('a', day + 11*86400 + 8000 + i) for i in range(3)])
+assert parts.rollover(landing) == 3
+assert parts.signature(day + 11*86400) == '108:108'
+assert parts.keys() == [day + d*86400 for d in range(12)]
+assert parts.keys(day + 86400, day + 3*86400) == [day + 86400, day + 2*86400]
+# a late row goes to its day
+assert parts.insert([row('c', day + 5*86400 + 10)]) == 1
+sig = parts.signature(day + 5*86400)
+assert sig == '101:101', sig
+
+# a few days: attached view
+conn = parts.view(day, day + 3*86400)
+assert conn.execute('SELECT count(*),min(UNIXTIME),max(UNIXTIME) FROM MEASUREMENTS').fetchone() == \
+    (300, day, day + 2*86400 + 99*60)
+conn.close()
+# every day: more than can be attached, same answer
+conn = parts.view()
+assert conn.execute('SELECT SERIAL,count(*) FROM MEASUREMENTS GROUP BY SERIAL').fetchall() == [('a',1208),('c',1)]
+conn.close()
+assert parts.view(day - 10*86400, day - 86400).execute('SELECT count(*) FROM MEASUREMENTS').fetchone() == (0,)
+assert sum(1 for r in parts.query('SELECT * FROM MEASUREMENTS WHERE SERIAL=?', ('a',))) == 1208
+
+# expiry: nothing before an upload, then only uploaded days older than keep
+assert parts.expire(0) == []
+parts.mark_uploaded(day + 4*86400)
+dest = os.path.join(tmp,'offload')
+os.makedirs(dest)
+removed = parts.expire(0, dest)
+assert [os.path.basename(p) for p in removed] == [os.path.basename(parts.path(day + d*86400)) for d in range(4)]
+assert parts.keys()[0] == day + 4*86400 and len(os.listdir(dest)) == 4
+
+landing.close()
+shutil.rmtree(tmp)
+print('Partitions PASSED')
@@ -0,0 +1,48 @@
+'''
+Profiling: a flag file or SIGUSR1 profiles the next cycles, the report
+names the functions that ran and the lines that allocated, and reports
+land in files of which only the newest are kept.
+
+python3 -m sensorpi.tests profiling
+'''
+from ..profiling import Profiler, store
+import os,signal,shutil,tempfile
+
+tmp = tempfile.mkdtemp()
+flag = os.path.join(tmp,'.profile')
+profiler = Profiler(flag)
+
+def busy_cycle():
+    return [bytes(1000) for i in range(2000)]
+
+kept = []
+def cycle():
+    profiler.begin()
+    kept.append(busy_cycle())
+    return profiler.end()
+
+# nothing requested: nothing profiled
+assert cycle() is None and profiler.profile is None
+
+with open(flag,'w') as f: f.write('2\n')
+assert cycle() is None and not os.path.exists(flag)
+report = cycle()
+assert report.startswith('2 cycles profiled') and 'busy_cycle' in report and 'tracemalloc' in report
+assert 'profiling_test.py' in report.split('tracemalloc')[1] # the allocating line
+assert cycle() is None
+
+os.kill(os.getpid(), signal.SIGUSR1)
+report = None
+for i in range(3): report = cycle() or report
+assert report.startswith('3 cycles profiled')
+
+directory = os.path.join(tmp,'profiles')
+os.makedirs(directory)
+for i in range(4): # earlier reports
+    with open(os.path.join(directory,'profile_%d.txt'%(1600000000+i)),'w') as f: f.write('old')
+path = store(directory, '00000000abcdef01\0', report, keep=3)
+assert open(path).read().startswith('00000000abcdef01\n3 cycles profiled')
+assert sorted(os.listdir(directory)) == ['profile_1600000002.txt','profile_1600000003.txt',os.path.basename(path)]
+
+shutil.rmtree(tmp)
+print('Profiling PASSED')
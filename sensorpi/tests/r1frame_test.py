@@ -0,0 +1,64 @@
+'''
+R1 histogram frames: decode, checksum rejection and retry, and the cost
+of a read against the py-opc style dictionary.
+
+python3 -m sensorpi.tests r1frame
+'''
+from ..r1frame import R1Frame, Histogram, LAYOUT, crc16
+from ..simulate import MockSPI
+import time
+
+class Alpha(object):
+    ''' what R1Frame needs of the py-opc object '''
+    def __init__(self, cnxn): self.cnxn = cnxn
+    def on(self): return True
+    def off(self): return True
+
+# CRC-16/MODBUS check value
+assert crc16(bytearray(b'123456789'), 9) == 0x4B37
+
+# a clean bus decodes to the values the OPC was asked to send
+spi = MockSPI(seed=3, busy=2)
+r1 = R1Frame(Alpha(spi))
+for i in range(20):
+    got = r1.histogram()
+    want = spi.sent
+    assert got.bins == tuple(min(want['Bin %s'%j],65535) for j in range(16))
+    assert abs(got['PM2.5'] - want['PM2.5']) < 1e-3*max(want['PM2.5'],1)
+    assert abs(got.temperature - want['Temperature']) < .01
+    assert abs(got.humidity - want['Humidity']) < .01
+    assert got['Bin 3'] == got.bins[3]
+assert r1.reads == 20 and r1.crc_errors == 0
+# 3 ready polls and one frame transfer per read
+assert spi.ioctls == 20*4, spi.ioctls
+
+# a noisy bus: bad frames are retried, never returned
+spi = MockSPI(seed=5, corrupt=.3)
+r1 = R1Frame(Alpha(spi), retries=5)
+for i in range(200):
+    h = r1.histogram()
+    assert h.pm1 == 0 or h.checksum == crc16(r1.buf)
+m = r1.metrics()
+assert m['crc_errors'] > 20 and m['reads'] + m['failures'] == 200, m
+print('checksum errors {crc_errors}, failed reads {failures} of 200'.format(**m))
+
+# every retry failing gives an empty histogram, which measurement discards
+r1 = R1Frame(Alpha(MockSPI(seed=1, corrupt=1.)), retries=2)
+h = r1.histogram()
+assert h.pm1 + h.pm10 == 0 and r1.failures == 1
+
+# decode cost against a dictionary of the same values
+buf = MockSPI(seed=2).frame()
+n = 20000
+start = time.time()
+for i in range(n):
+    crc16(buf); h = Histogram.decode(buf)
+frame = (time.time()-start)/n
+start = time.time()
+for i in range(n):
+    d = dict(('Bin %s'%j,b) for j,b in enumerate(LAYOUT.unpack_from(buf)[:16]))
+    [float(d['Bin %s'%j]) for j in range(16)]
+dictionary = (time.time()-start)/n
+print('frame check+decode {:.1f} us, dictionary bins {:.1f} us'.format(frame*1e6, dictionary*1e6))
+
+print('R1 frames PASSED')
@@ -0,0 +1,21 @@
+'''
+A simulated week of the main loop on a virtual clock.
+
+python3 -m sensorpi.tests replay
+'''
+from ..replay import replay
+import time
+
+start = time.time()
+node, lines = replay(7, 'bbsensor', start=1600041600) # Monday 14/09/2020
+print('\n'.join(lines[-4:]))
+
+assert time.time()-start < 60, 'replay too slow'
+assert set(node.modes) == {'ENROUTE','SCHOOL','NIGHT'}, node.modes
+assert len(node.samples) > 7*4*3600/5, 'too few samples' # at least 4 h a day at 5 s
+assert any('sync to serverpi' in what for t,what in node.events)
+
+node, lines = replay(2, 'bbstatic', start=1600041600)
+assert 'NIGHT' not in node.modes
+
+print('Replay PASSED')
@@ -0,0 +1,66 @@
+'''
+Resampling: sample period weighted slot means, gaps masked, chunks that
+join up seamlessly, NULLs left out of their own variable only, and GPS
+clock correction.
+
+python3 -m sensorpi.tests resample
+'''
+from ..resample import Resampler
+from . import fixtures
+import numpy as np
+import os,shutil,time
+
+tmp,parts = fixtures.partitions()
+day = 1600000000//86400*86400
+
+def hhmmss(t):
+    t = int(t) % 86400
+    return '%02d%02d%02d'%(t//3600, t//60%60, t%60)
+
+def row(serial, t, pm, sp, gps=None, T=20.):
+    return fixtures.row(serial, t, pm, sp=sp, T=T, TIME=hhmmss(t if gps is None else gps))
+
+rows = []
+# a: every 5 s with PM = minute of the day, a gap 01:00-01:30
+rows += [row('a', day+t, t//60, 5.) for t in range(0, 2*3600, 5) if not 3600 <= t < 5400]
+# b: every 7 s at 10, its Pi clock 30 s slow of GPS
+rows += [row('b', day+t-30, 10., 7., day+t) for t in range(0, 2*3600, 7)]
+# c: never reports
+# d: every 10 s, T on every other row and NULL on the rest
+rows += [row('d', day+t, 5., 10., T=None if t % 20 else 20.) for t in range(0, 2*3600, 10)]
+parts.insert(rows)
+
+rs = Resampler(parts, ['a','b','c','d'], step=60, chunk=50)
+began = time.time()
+chunks = list(rs.chunks(day, day+2*3600))
+took = time.time()-began
+values = np.concatenate([c.values for c in chunks])
+mask = np.concatenate([c.mask for c in chunks])
+times = np.concatenate([c.times for c in chunks])
+assert values.shape == (120, 4, 5) and len(chunks) == 3
+assert (np.diff(times) == 60).all() and times[0] == day
+
+# a's slot means are the minute, exactly, across chunk boundaries
+assert np.allclose(values[:60,0,1], np.arange(60))
+assert not mask[60:90,0].any() and np.isnan(values[60:90,0]).all()
+assert mask[91:,0].all()
+# b covered, c never
+assert mask[1:,1].all() and np.allclose(values[1:,1,1], 10.)
+assert not mask[:,2].any()
+# d's T is the mean of the rows that have one, over half the slot; its PM covers all of it
+assert np.allclose(values[:,3,3], 20.) and mask[:,3].all()
+assert np.allclose(chunks[0].cover[:,3,3], 30.) and np.allclose(chunks[0].cover[:,3,1], 60.)
+
+# clock correction: on the Pi clock b stops 30 s early
+pi = next(Resampler(parts, ['b'], step=60).chunks(day+6600, day+7200))
+gps = next(Resampler(parts, ['b'], step=60, clock='gps').chunks(day+6600, day+7200))
+assert pi.cover[-1,0,1] < 40 and gps.cover[-1,0,1] == 60, (pi.cover[-1,0,1], gps.cover[-1,0,1])
+
+path = os.path.join(tmp,'fleet')
+shape = rs.save(path, day, day+2*3600)
+saved = np.load(path+'.npy', mmap_mode='r')
+assert shape == (120,4,5) and np.array_equal(np.isnan(saved), np.isnan(values))
+print('%d sensors x %d slots in %.0f ms'%(4, 120, took*1e3))
+
+shutil.rmtree(tmp)
+print('Resample PASSED')
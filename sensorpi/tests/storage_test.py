@@ -0,0 +1,74 @@
+'''
+Storage profile: a new db gets the profile's page size and WAL, an
+existing one keeps its page size until it is rebuilt, inserts count their
+rows, and WriteMeter divides the sectors written between commits by the
+rows committed.
+
+python3 -m sensorpi.tests storage
+'''
+from .. import storage
+from ..SensorMod.db import builddb
+import os,json,shutil,sqlite3,tempfile
+
+tmp = tempfile.mkdtemp()
+row = ('serial', 2, '120000', b'', 1., 2., 3., 20., 50., b'', 1., 0, 1600000000)
+
+def pragma(conn, name):
+    return conn.execute('PRAGMA %s'%name).fetchone()[0]
+
+# new db
+conn = sqlite3.connect(os.path.join(tmp,'new.db'))
+assert storage.tune(conn).lower() == 'wal'
+builddb.builddb(conn)
+assert pragma(conn,'page_size') == 4096 and pragma(conn,'synchronous') == 1 # NORMAL
+assert storage.insert(conn, [row]*100) == 100
+conn.close()
+
+# an existing WAL db with small pages keeps them until rebuilt
+path = os.path.join(tmp,'old.db')
+conn = sqlite3.connect(path)
+conn.execute('PRAGMA page_size = 1024')
+conn.execute('PRAGMA journal_mode = WAL')
+builddb.builddb(conn)
+storage.insert(conn, [row]*1000)
+conn.close()
+conn = sqlite3.connect(path)
+assert storage.tune(conn).lower() == 'wal' and pragma(conn,'page_size') == 1024
+conn.execute('DROP TABLE MEASUREMENTS')
+builddb.builddb(conn)
+assert storage.tune(conn, rebuild=True).lower() == 'wal' and pragma(conn,'page_size') == 4096
+assert storage.insert(conn, [row]*10) == 10
+conn.close()
+conn = sqlite3.connect(path)
+assert pragma(conn,'page_size') == 4096 and pragma(conn,'journal_mode') == 'wal'
+assert conn.execute('SELECT count(*) FROM MEASUREMENTS').fetchone()[0] == 10
+assert storage.checkpoint(conn,'TRUNCATE')[0] == 0
+conn.close()
+
+# write accounting against a fake /sys block device
+sysdir = os.path.join(tmp,'mmcblk0')
+os.makedirs(sysdir)
+def written(sectors):
+    with open(os.path.join(sysdir,'stat'),'w') as f:
+        f.write('0 0 0 0 0 0 %d 0 0 0 0\n'%sectors)
+with open(os.path.join(sysdir,'size'),'w') as f: f.write('%d\n'%(32*2**30//512))
+written(1000)
+statfile = os.path.join(tmp,'.storage.json')
+meter = storage.WriteMeter(tmp, 'sd', statfile)
+meter.sysdir = sysdir
+meter.last = meter.read()
+written(1008)
+assert meter.record(4, 1) == 8*512/4.
+written(1016)
+assert meter.record(4, 1) == 8*512/4.
+assert meter.record(0, 1) is None
+stats = json.load(open(statfile))
+assert stats['sd_1']['rows'] == 8 and stats['sd_1']['bytes'] == 16*512 and stats['sd_1']['capacity'] == 32*2**30
+assert storage.WriteMeter(tmp, 'sd', statfile).stats == stats # kept across restarts
+stats['sd_1']['seconds'] = 86400.
+line, = storage.report(stats)
+assert line.startswith('sd_1') and '1024 B/row' in line, line
+print(line)
+
+shutil.rmtree(tmp)
+print('Storage PASSED')
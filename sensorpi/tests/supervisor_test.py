@@ -0,0 +1,112 @@
+'''
+Supervisor: an update merges and restarts the sensor process without a
+reboot, the new process logs the downtime, only rc.local, setup or udev
+rule changes ask for a reboot, SensorMod follows its main branch, services
+are restarted on an update to sensorpi/, an update to the supervisor
+restarts the supervisor, and SIGUSR1 reaches the sensor process.
+
+python3 -m sensorpi.tests supervisor
+'''
+from .. import supervisor
+import os,sys,shutil,signal,subprocess,tempfile,threading,time
+
+tmp = tempfile.mkdtemp()
+here = os.getcwd()
+
+def sh(cmd, cwd):
+    subprocess.check_call(cmd, shell=True, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+origin, clone = os.path.join(tmp,'origin'), os.path.join(tmp,'clone')
+os.mkdir(origin)
+sh('git init -q && git config user.email t@t && git config user.name t && echo 1 > VERSION && git add . && git commit -qm one', origin)
+sh('git clone -q origin clone', tmp)
+
+assert supervisor.needs_reboot(['sensorpi/loop.py','README.md']) == []
+assert supervisor.needs_reboot(['rc.local','setup/package_updater.sh','usb/optional_usb.rules','setup.py']) \
+    == ['rc.local','setup/package_updater.sh','usb/optional_usb.rules']
+assert supervisor.touched(['sensorpi/api.py','sensorpi/SensorMod'], supervisor.SELF_PATHS) == ['sensorpi/SensorMod']
+
+# a service records each start and runs until SIGINT
+starts = os.path.join(tmp,'starts')
+supervisor.SERVICES['svc'] = (sys.executable, '-c', 'import time\nopen(%r,"a").write("start\\n")\ntime.sleep(60)'%starts)
+
+# child: an update is pushed while it runs, so it hands over; once updated it stops cleanly
+child = '''
+import sys,time,subprocess
+sys.path.insert(0, %r)
+from sensorpi import supervisor
+assert supervisor.supervised()
+time.sleep(1) # the service is up
+if open('VERSION').read().strip() == '1':
+    subprocess.check_call('echo 2 > VERSION && mkdir sensorpi && echo > sensorpi/loop.py && git add . && git commit -qm two',
+                          shell=True, cwd=%r)
+    supervisor.handover(%r)
+    sys.exit(supervisor.EXIT_UPDATE)
+assert supervisor.resumed(%r) > 0
+'''%(here, origin, tmp, tmp)
+
+reboots = []
+supervisor.reboot = reboots.append
+os.chdir(clone)
+try:
+    s = supervisor.Supervisor([sys.executable, '-c', child], ['svc'], tmp)
+    s.run()
+    assert open('VERSION').read().strip() == '2'
+finally:
+    os.chdir(here)
+
+assert reboots == []
+assert open(starts).read() == 'start\nstart\n' and s.running == {}
+assert not os.path.exists(os.path.join(tmp,supervisor.HANDOVER))
+lines = open(os.path.join(tmp,'updates.csv')).read().split('\n')
+assert lines[0] == 'stopped,resumed,downtime,reason,commit' and lines[1].split(',')[3] == 'update'
+print('downtime %s s'%lines[1].split(',')[2])
+
+# SIGUSR1 (a profiling request) is passed on to the sensor rather than stopping the supervisor
+usr1 = os.path.join(tmp,'usr1')
+child = 'import signal,sys,time\nsignal.signal(signal.SIGUSR1, lambda *a: open(%r,"w") and sys.exit(0))\ntime.sleep(30)'%usr1
+os.chdir(clone)
+try:
+    s = supervisor.Supervisor([sys.executable, '-c', child])
+    threading.Timer(2, os.kill, (os.getpid(), signal.SIGUSR1)).start()
+    s.run()
+finally:
+    os.chdir(here)
+assert os.path.exists(usr1) and s.child.returncode == 0
+
+# an update to the supervisor restarts it, with its services
+reexecs = []
+supervisor.reexec = lambda why, services: reexecs.append((why, services))
+sh('echo > sensorpi/supervisor.py && git add sensorpi && git commit -qm self', origin)
+os.chdir(clone)
+try:
+    s = supervisor.Supervisor(services=['svc'], logdir=tmp)
+    s.updated(s.update())
+finally:
+    os.chdir(here)
+assert reexecs == [('updated sensorpi/supervisor.py', ['svc'])]
+
+# SensorMod is pulled to its main branch, not left at a pinned commit
+mod = os.path.join(tmp,'mod')
+os.mkdir(mod)
+sh('git init -q -b main && git config user.email t@t && git config user.name t && echo 1 > db.py && git add . && git commit -qm one', mod)
+sh('git clone -q ../mod sensorpi/SensorMod && cd sensorpi/SensorMod && git checkout -q --detach', clone)
+sh('echo 2 > db.py && git commit -qam two', mod)
+os.chdir(clone)
+try:
+    assert supervisor.pull_submodule() and not supervisor.pull_submodule()
+    assert open('sensorpi/SensorMod/db.py').read().strip() == '2'
+finally:
+    os.chdir(here)
+
+# an update to rc.local asks for a reboot
+sh('echo x > rc.local && git add rc.local && git commit -qm three', origin)
+os.chdir(clone)
+try:
+    supervisor.Supervisor().update()
+finally:
+    os.chdir(here)
+assert len(reboots) == 1 and 'rc.local' in reboots[0]
+
+shutil.rmtree(tmp)
+print('Supervisor PASSED')
@@ -0,0 +1,111 @@
+'''
+Telemetry: frames round trip (LOC only when asked for), subscribers on a
+Unix socket, TCP and a serial device get every sample, samples from
+several OPCs keep their own SERIAL, and a subscriber that stops reading
+loses its oldest frames without slowing publish().
+
+python3 -m sensorpi.tests telemetry
+'''
+from ..telemetry import Publisher, subscribe, encode, decode, frames, HEADER, BODY
+from ..simulate import SimOPC
+from .. import multiopc
+import os,pty,tty,socket,shutil,tempfile,threading,time
+
+tmp = tempfile.mkdtemp()
+
+def row(i):
+    return ['00000000abcdef01\0', 2, '120000', b'encrypted-loc', 1.+i, 2.+i, 3.+i, 20., 50.,
+            [float(b) for b in range(16)], 5., 0, 1600000000+i]
+
+def stream(*chunks):
+    chunks = list(chunks)
+    return lambda n: chunks.pop(0) if chunks else b''
+
+f = encode(row(1))
+flags,payload = next(frames(stream(f)))
+s = decode(flags, payload)
+assert s['PM3'] == 3. and s['UNIXTIME'] == 1600000001 and s['BINS'] == list(range(16)) and 'LOC' not in s
+assert decode(*next(frames(stream(encode(row(1), loc=True)))))['LOC'] == b'encrypted-loc'
+assert len(f) == HEADER.size + BODY.size + 32 and s['INSTRUMENT'] is None
+b = row(1); b[0] = multiopc.serial(b[0], 'b')
+assert decode(*next(frames(stream(encode(b, loc=True, serial=row(1)[0])))))['INSTRUMENT'] == 'b'
+# garbage before a frame is skipped
+assert next(frames(stream(b'\x00\x01junk' + f)))[1] == payload
+
+def collect(address, n, out):
+    for s in subscribe(address, timeout=10):
+        out.append(s)
+        if len(out) == n: break
+
+def wait(pub, n):
+    for i in range(200):
+        if len(pub.subscribers) >= n: return
+        time.sleep(.01)
+
+for address in ('unix:%s/telemetry.sock'%tmp, 'tcp:127.0.0.1:0'):
+    pub = Publisher(address, '00000000abcdef01\0')
+    if pub.kind == 'tcp': address = 'tcp:127.0.0.1:%d'%pub.port
+    got = []
+    t = threading.Thread(target=collect, args=(address, 100, got))
+    t.start()
+    wait(pub, 1)
+    for i in range(100): pub.publish(row(i))
+    t.join(10)
+    assert [s['UNIXTIME'] for s in got] == [1600000000+i for i in range(100)], address
+    assert got[0]['SERIAL'] == '00000000abcdef01'
+    pub.close()
+
+# two OPCs on one Pi, published from their threads once each row has its SERIAL
+pi = '00000000abcdef01\0'
+pub = Publisher('unix:%s/multi.sock'%tmp, pi)
+got = []
+t = threading.Thread(target=collect, args=('unix:%s/multi.sock'%tmp, 20, got))
+t.start()
+wait(pub, 1)
+measure = lambda pm, now: row(0)[:12] + [int(now.strftime('%s'))]
+instruments = [multiopc.Instrument('a', SimOPC(seed=1, latency=0)), multiopc.Instrument('b', SimOPC(seed=2, latency=0), multiopc.serial(pi, 'b'))]
+multiopc.run(instruments, 1, .05, measure, lambda batch: None, publish=pub.publish)
+t.join(10)
+pub.close()
+assert set(s['SERIAL'] for s in got) == {'00000000abcdef01', '00000000abcdef01-b'}, got
+
+# a bluetooth serial link, as a pty
+master,slave = pty.openpty()
+tty.setraw(slave)
+pub = Publisher('rfcomm:%s'%os.ttyname(slave), 'serial')
+wait(pub, 1)
+for i in range(10): pub.publish(row(i))
+got = []
+for flags,payload in frames(lambda n: os.read(master, n)):
+    got.append(decode(flags, payload))
+    if len(got) == 11: break
+assert got[0] == {'SERIAL':'serial'} and got[-1]['UNIXTIME'] == 1600000009
+pub.close()
+
+# a subscriber that never reads: publish stays fast and drops its oldest frames
+pub = Publisher('unix:%s/slow.sock'%tmp, 'serial', size=64)
+slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+slow.connect('%s/slow.sock'%tmp)
+wait(pub, 1)
+n = 20000
+began = time.time()
+for i in range(n): pub.publish(row(i))
+took = time.time()-began
+m = pub.metrics()['subscribers'][0]
+assert m['dropped'] > 0 and m['sent'] + m['dropped'] + m['queued'] in (n, n+1), m # one may be mid write
+print('%d samples published in %.0f ms (%.1f us each) to a stalled subscriber, %d dropped'%(
+    n, took*1e3, took/n*1e6, m['dropped']))
+assert took/n < 1e-3
+# once it reads again it gets the newest samples
+slow.settimeout(5)
+last = None
+for flags,payload in frames(slow.recv):
+    last = decode(flags, payload)
+    if last.get('UNIXTIME') == 1600000000+n-1: break
+assert last['UNIXTIME'] == 1600000000+n-1
+pub.close()
+slow.close()
+
+shutil.rmtree(tmp)
+print('Telemetry PASSED')
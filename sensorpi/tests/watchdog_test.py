@@ -0,0 +1,173 @@
+'''
+Watchdog: a stalled stage is re-initialised and its time to recover
+recorded, idle stages are left alone, recoveries that fail or hang
+escalate to a restart, a GPS restarted through gpsbuffer.Receiver only
+counts as recovered once fixes come again, and a hung OPC read is
+recovered in-process, also when it is one of several OPCs sampling at once.
+
+python3 -m sensorpi.tests watchdog
+'''
+from ..watchdog import Watchdog, EXIT_WATCHDOG
+from ..gpsbuffer import Receiver
+from ..simulate import SimOPC
+from .. import multiopc
+import os,shutil,tempfile,threading,time
+
+tmp = tempfile.mkdtemp()
+
+class Clock(object):
+    t = 1000.
+    def time(self): return self.t
+clock = Clock()
+
+exits = []
+resets = []
+wd = Watchdog(os.path.join(tmp,'watchdog.csv'), exit=exits.append, clock=clock, retries=2)
+wd.watch('sampler', 60, lambda: resets.append('opc'))
+wd.watch('writer', 120)
+
+class GPS(object):
+    ''' SensorMod.gps: init() starts a daemon thread that runs until stop_event '''
+    def __init__(self):
+        self.last = {'gpstime':'000000'}
+        self.stop_event = threading.Event()
+    def init(self, wait=True):
+        resets.append('gps')
+        self.stop_event.clear()
+        return Daemon(self)
+class Daemon(object):
+    def __init__(self, gps): self.gps = gps
+    def is_alive(self): return not self.gps.stop_event.is_set()
+    def join(self, timeout): clock.t += 2 # the old daemon takes a moment to stop
+gps = GPS()
+receiver = Receiver(gps)
+receiver.watchdog = wd
+wd.watch('gps', 600, receiver.reinit, lambda: str(gps.last), restart=False)
+resets.remove('gps')
+
+# idle stages have no deadline
+wd.idle('sampler'); wd.idle('writer')
+clock.t += 3600; wd.check()
+assert resets == [] and exits == []
+
+# a sampler stall: re-initialised once, then heartbeats again
+wd.beat('sampler')
+clock.t += 30; wd.check()
+clock.t += 31; wd.check()
+assert resets == ['opc']
+clock.t += 5; wd.beat('sampler')
+clock.t += 1; wd.check()
+r = wd.records[-1]
+assert r['action'] == 'reinit' and r['ttr'] == 5 and r['outage'] == 66, r
+assert wd.metrics()['sampler']['recovered'] == 1
+
+# re-initialising does not help: two retries, then a restart
+wd.beat('sampler')
+for i in range(4):
+    clock.t += 61; wd.check()
+assert resets.count('opc') == 3 and exits == [EXIT_WATCHDOG]
+assert wd.metrics()['sampler']['restarts'] == 1
+
+# the writer has nothing to re-initialise: straight to a restart
+with wd.stage('writer'):
+    clock.t += 121; wd.check()
+assert exits == [EXIT_WATCHDOG]*2
+
+# gps is probed, has no deadline between journeys, and after a restart of
+# its daemon only recovers once a new fix arrives
+receiver.start(); wd.check()
+for i in range(3):
+    clock.t += 300; gps.last = {'gpstime':'%06d'%i}; wd.check()
+receiver.stop()
+clock.t += 3600; wd.check()
+assert resets.count('gps') == 0
+receiver.start() # a new daemon for the next journey
+clock.t += 601; wd.check()
+assert resets.count('gps') == 2 and wd.stages['gps'].armed
+clock.t += 60; wd.check()
+assert wd.records[-1]['stage'] != 'gps' # restarting the daemon is not a heartbeat
+clock.t += 60; gps.last = {'gpstime':'000100'}; wd.check()
+r = wd.records[-1]
+assert r['stage'] == 'gps' and r['action'] == 'reinit' and r['ttr'] == 2+120, r
+# and is given up on rather than restarting the process
+for i in range(4):
+    clock.t += 601; wd.check()
+assert resets.count('gps') == 4 and len(exits) == 2 and not wd.stages['gps'].armed
+assert open(os.path.join(tmp,'watchdog.csv')).read().count('\n') == 1 + len(wd.records)
+
+# a recovery that hangs itself escalates
+hung = Watchdog(exit=exits.append, clock=clock, recover_timeout=.2, tick=.05)
+hung.watch('sampler', 60, lambda: time.sleep(5))
+hung.beat('sampler'); clock.t += 61; hung.check()
+assert len(exits) == 3
+
+
+# in real time: an OPC whose read blocks until it is power cycled
+class HangingOPC(object):
+    def __init__(self):
+        self.stuck = False
+        self.reset = threading.Event()
+    def on(self): pass
+    def off(self): self.reset.set()
+    def histogram(self):
+        if self.stuck: # like a wedged SPI transfer, until the OPC is power cycled
+            self.reset.wait()
+            self.stuck = False
+            self.reset.clear()
+        time.sleep(.01)
+
+opc = HangingOPC()
+def reinit():
+    opc.off(); time.sleep(.05); opc.on()
+
+live = Watchdog(exit=exits.append, tick=.02)
+live.watch('sampler', .2, reinit)
+live.start()
+reads = []
+def sampler():
+    with live.stage('sampler'):
+        for i in range(60):
+            if i == 20: opc.stuck = True
+            opc.histogram()
+            live.beat('sampler')
+            reads.append(i)
+t = threading.Thread(target=sampler); t.start(); t.join(10)
+live.stop()
+assert len(reads) == 60, len(reads)
+m = live.metrics()['sampler']
+assert m['stalls'] == 1 and m['recovered'] == 1 and len(exits) == 3, m
+print('hung OPC read recovered in %.0f ms after detection (deadline 200 ms)'%(m['max_ttr']*1e3))
+
+# with several OPCs each has its own stage: the healthy one does not hide the hung one
+class PowerCycled(SimOPC):
+    ''' its 20th read hangs until it is power cycled '''
+    def __init__(self, *args, **kw):
+        SimOPC.__init__(self, *args, **kw)
+        self.reads = 0
+        self.cycled = threading.Event()
+    def off(self):
+        self.cycled.set()
+        return SimOPC.off(self)
+    def histogram(self):
+        self.reads += 1
+        if self.reads == 20: self.cycled.wait()
+        return SimOPC.histogram(self)
+
+reinits = []
+instruments = [multiopc.Instrument('a', PowerCycled(seed=1, latency=.01)), multiopc.Instrument('b', PowerCycled(seed=2, latency=.01), 'b')]
+instruments[0].alpha.reads = -10**6 # never hangs
+multi = Watchdog(exit=exits.append, tick=.02)
+for inst in instruments:
+    multi.watch(inst.stage, .3, lambda inst=inst: (reinits.append(inst.name), inst.alpha.off(), inst.alpha.on()))
+multi.start()
+measure = lambda pm, now: ['pi', 1, '', b'', pm['PM1'], 0., 0., 0., 0., [0.]*16, 0., 0, int(now.strftime('%s'))]
+stored = []
+multiopc.run(instruments, 3, .05, measure, lambda batch: stored.extend(batch.rows(copy=True)), watchdog=multi)
+multi.stop()
+m = multi.metrics()
+assert reinits == ['b'] and m['sampler-b']['recovered'] == 1 and m['sampler-a']['stalls'] == 0, (reinits, m)
+assert not instruments[1].hung() and len([r for r in stored if r[0] == 'b']) > 30
+print('hung OPC b of 2 re-initialised alone, recovered in %.0f ms'%(m['sampler-b']['max_ttr']*1e3))
+
+shutil.rmtree(tmp)
+print('Watchdog PASSED')
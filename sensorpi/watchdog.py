@@ -0,0 +1,245 @@
+'''
+Acquisition watchdog: stall detection and in-process recovery.
+
+The sampling loop is single threaded, so one SPI or serial call that never
+returns stops everything. Each stage of the loop heartbeats:
+
+    sampler   every histogram read, while a cycle runs (with OPC_EXTRA one
+              stage per OPC, sampler-<name>, see multiopc.py)
+    writer    while a cycle is written to the db
+    gps       every change of gps.last, while en route (probed, see watch())
+    uploader  while syncing or uploading
+
+A stage only has a deadline while it is armed (between beat() and idle(),
+or inside stage()). While a stage is being recovered only a beat() (or a
+change of its probe) counts as it coming back: idle() and arm(), which a
+recover function may itself call as it stops and restarts its device, do
+not move the heartbeat. A thread checks the armed stages every TICK; when one
+misses its deadline the watchdog climbs a ladder:
+
+ 1. re-initialise just that device (its recover function, e.g. alpha.off/on
+    or a new gps daemon), run on its own thread so a recovery that hangs
+    too cannot take the watchdog with it. Up to RETRIES times, each given
+    the stage's deadline to produce a new heartbeat.
+ 2. restart the process: exit with EXIT_WATCHDOG under the supervisor
+    (see supervisor.py), which starts a fresh one; reboot if unsupervised.
+ 3. the Pi hardware watchdog (/dev/watchdog, optional): petted every TICK
+    by the watchdog thread, so if the interpreter itself wedges the SoC
+    resets once it times out (15 s on the Pi).
+
+Every stall is written to watchdog.csv (stage, last heartbeat, detected,
+recovered, time to recover, outage, attempts, action) and summarised by
+metrics().
+
+Test: python3 -m sensorpi.tests watchdog
+'''
+
+import os,time,threading
+from contextlib import contextmanager
+
+from .SensorMod.log_manager import getlog
+log = getlog(__name__)
+
+EXIT_WATCHDOG = 70
+TICK = 1.            # s between checks
+RETRIES = 2          # device re-initialisations before restarting the process
+RECOVER_TIMEOUT = 30 # s a re-initialisation may take before it counts as hung
+
+
+def restart(code=EXIT_WATCHDOG):
+    ''' leave it to the supervisor to start a new process, otherwise reboot '''
+    from . import supervisor
+    if supervisor.supervised(): os._exit(code)
+    os.system('sudo reboot')
+    os._exit(code)
+
+
+class Stage(object):
+    __slots__ = ('name','deadline','recover','probe','restart','last','armed','seen',
+                 'lost','stalled','tried','attempts')
+
+    def __init__(self, name, deadline, recover=None, probe=None, restart=True):
+        self.name = name
+        self.deadline = deadline
+        self.recover = recover
+        self.probe = probe
+        self.restart = restart
+        self.last = 0.
+        self.armed = False
+        self.seen = None
+        self.lost = None    # the last heartbeat before a stall
+        self.stalled = None # when the stall was detected
+        self.tried = None   # when recovery was last attempted
+        self.attempts = 0
+
+
+class Watchdog(object):
+
+    def __init__(self, logfile=None, hardware=None, exit=restart, clock=time,
+                 tick=TICK, retries=RETRIES, recover_timeout=RECOVER_TIMEOUT):
+        self.stages = {}
+        self.logfile = logfile
+        self.hardware = hardware
+        self.exit = exit
+        self.clock = clock
+        self.tick = tick
+        self.retries = retries
+        self.recover_timeout = recover_timeout
+        self.records = []
+        self.device = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def watch(self, name, deadline, recover=None, probe=None, restart=True):
+        '''
+        Add a stage. recover() re-initialises its device (None goes straight
+        to a restart); probe() returns something that changes whenever the
+        stage makes progress, for stages that cannot call beat() themselves.
+        With restart=False the watchdog gives up on the stage (disarming it)
+        instead of restarting the process once the retries are used up.
+        '''
+        self.stages[name] = Stage(name, deadline, recover, probe, restart)
+
+    def beat(self, name):
+        st = self.stages[name]
+        st.last = self.clock.time()
+        st.armed = True
+
+    def arm(self, name):
+        ''' beat unless already armed, so calling it every loop keeps the deadline '''
+        st = self.stages[name]
+        if st.armed: return
+        if st.stalled is None: self.beat(name)
+        else: st.armed = True # recovering: wait for real progress
+
+    def idle(self, name):
+        ''' no deadline until the next beat '''
+        st = self.stages[name]
+        if st.stalled is None: st.last = self.clock.time()
+        st.armed = False
+
+    @contextmanager
+    def stage(self, name):
+        self.beat(name)
+        try:
+            yield
+        finally:
+            self.idle(name)
+
+    def check(self):
+        ''' one pass over the stages, see the module docstring '''
+        now = self.clock.time()
+        for st in self.stages.values():
+            if st.probe and st.armed:
+                seen = st.probe()
+                if seen != st.seen:
+                    st.seen = seen
+                    st.last = now
+
+            if st.stalled is not None:
+                if st.last > st.tried:
+                    self.record(st, st.last, 'reinit' if st.recover else 'none')
+                    st.stalled = None
+                elif now - st.tried > st.deadline:
+                    self.recover(st, now)
+                continue
+
+            if st.armed and now - st.last > st.deadline:
+                st.stalled,st.lost = now,st.last
+                st.attempts = 0
+                log.warning('{} stalled - no heartbeat for {:.0f} s'.format(st.name, now - st.last))
+                self.recover(st, now)
+
+    def recover(self, st, now):
+        st.tried = now
+        st.attempts += 1
+        if st.recover is None or st.attempts > self.retries:
+            if st.restart: return self.escalate(st, now)
+            log.error('{} did not recover after {} attempts - giving up'.format(st.name, st.attempts-1))
+            self.record(st, None, 'gave up')
+            st.stalled,st.armed = None,False
+            return
+        log.warning('Re-initialising {} (attempt {})'.format(st.name, st.attempts))
+        done = threading.Event()
+        def run():
+            try: st.recover()
+            except Exception as e: log.error('Re-initialising {} failed - {}'.format(st.name, e))
+            done.set()
+        threading.Thread(target=run, name='recover-'+st.name, daemon=True).start()
+        began = time.time()
+        while not done.wait(min(self.tick, self.recover_timeout)):
+            self.pet() # the hardware watchdog is for a wedged interpreter, not a slow recovery
+            if time.time() - began >= self.recover_timeout:
+                log.error('Re-initialising {} hung'.format(st.name))
+                return self.escalate(st, now)
+
+    def escalate(self, st, now):
+        log.critical('{} did not recover after {} attempts - restarting'.format(st.name, st.attempts-1))
+        self.record(st, None, 'restart')
+        st.stalled,st.armed = None,False
+        self.close()
+        self.exit(EXIT_WATCHDOG)
+
+    def record(self, st, recovered, action):
+        r = dict(stage=st.name, last=st.lost, detected=st.stalled, recovered=recovered,
+                 ttr=None if recovered is None else recovered - st.stalled,
+                 outage=None if recovered is None else recovered - st.lost,
+                 attempts=st.attempts, action=action)
+        self.records.append(r)
+        if recovered is not None:
+            log.info('{} recovered {:.1f} s after the stall was detected'.format(st.name, r['ttr']))
+        if not self.logfile: return
+        new = not os.path.exists(self.logfile)
+        with open(self.logfile,'a') as f:
+            if new: f.write('stage,last,detected,recovered,ttr,outage,attempts,action\n')
+            f.write('{stage},{last:.1f},{detected:.1f},{0},{1},{2},{attempts},{action}\n'.format(
+                *('' if r[k] is None else '%.1f'%r[k] for k in ('recovered','ttr','outage')), **r))
+
+    def metrics(self):
+        ''' per stage: stalls, recoveries, restarts, mean and max time to recover '''
+        out = {}
+        for name in self.stages:
+            rs = [r for r in self.records if r['stage'] == name]
+            ttr = [r['ttr'] for r in rs if r['ttr'] is not None]
+            out[name] = dict(stalls=len(rs), recovered=len(ttr),
+                             restarts=sum(r['action'] == 'restart' for r in rs),
+                             mean_ttr=sum(ttr)/len(ttr) if ttr else None,
+                             max_ttr=max(ttr) if ttr else None)
+        return out
+
+    ## thread
+
+    def start(self):
+        if self.hardware:
+            try:
+                self.device = open(self.hardware, 'wb', buffering=0)
+                log.info('Hardware watchdog {} armed'.format(self.hardware))
+            except (IOError, OSError) as e:
+                log.warning('Hardware watchdog {} not available - {}'.format(self.hardware, e))
+        self.thread = threading.Thread(target=self.run, name='watchdog', daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.tick):
+            try:
+                self.check()
+            except Exception as e:
+                log.error('watchdog check failed - {}'.format(e))
+            self.pet()
+
+    def pet(self):
+        if self.device: self.device.write(b'\0')
+
+    def close(self):
+        ''' disarm the hardware watchdog (magic close) '''
+        if self.device:
+            self.device.write(b'V')
+            self.device.close()
+            self.device = None
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(self.tick*2)
+        self.close()
@@ -1,82 +1,297 @@
 '''
 copy files if approved
+
+Each database is exported as a consistent snapshot (sqlite backup API, safe
+while the sampler is writing) holding only the rows added since the last
+successful export to that stick. Snapshots are copied in large chunks with
+an inline sha256, read back to verify, and listed in transferdata/manifest.json.
+An interrupted copy resumes from its .part file the next time the same
+stick is plugged in.
+
+The export mark is the last rowid copied together with a digest of that
+row. Rowids start again at 1 when the device db is rebuilt after an upload
+or server.db is emptied by rollover, so a mark whose row is gone (with the
+table now shorter) or holds something else means a new table: all of it is
+exported.
 '''
 
-import os,re,glob,time
-os.system('echo none | sudo tee /sys/class/leds/led0/trigger')
+import os,re,glob,time,json,shutil,hashlib,sqlite3
 
 def ledon():
     os.system('echo 0 | sudo tee /sys/class/leds/led0/brightness > /dev/null')
-    
+
 def ledoff():
     os.system('echo 1 | sudo tee /sys/class/leds/led0/brightness > /dev/null')
-    
+
 SERIAL = os.popen('cat /sys/firmware/devicetree/base/serial-number').read() #16 char key
-PEM = glob.glob('/root/BBSensor/s*pi/crypt/encrypt.pem')[0]
-DBs = glob.glob('/root/s*.db')
+DBs = glob.glob('/root/s*.db') + sorted(glob.glob('/root/partitions/measurements_*.db'))
+CSV = '/root/simplesensor.csv'
 
+STATE = '/root/.usbexport' # export mark (last rowid and its row digest) per stick and database
+SPOOL = '/root/.usbspool'  # snapshots waiting to be copied
+DEST = '/media/transferdata'
+CHUNK = 4*1024*1024
 
 checksum = 'b50ef6e46fec55460787f2b86fb59a099ec78a98'
-uuids = tuple(open('/root/BBSensor/usb/approved.dev','r'))
-
-# wait for usb to fully load
-time.sleep(10)
-
-
-usbs = []
-
-for u in os.popen('sudo blkid').readlines():
-    loc = [u.split(':')[0]]
-    if '/dev/sd' not in loc[0]: continue
-    loc+=re.findall(r'"[^"]+"',u)
-    columns = ['loc']+re.findall(r'\b(\w+)=',u)
-    
-    usbs.append(dict(zip(columns,loc)))
-    
-    
-    
-for u in usbs:
-    
-    print ('Connecting to %(LABEL)s'%u)
-
-    os.system('sudo umount /media')
-    os.system('sudo mount %(loc)s /media'%u)
-    
-    if u['UUID']+'\n' not in uuids:
-        print('UUID not allowed: %(UUID)s - %(LABEL)s'%u)
-        continue
-    if not os.path.exists('/media/transferdata'): 
-        print('FAILED on %(LABEL)s'%u)
-        continue
-    if checksum != os.popen('shasum /media/transferdata/encrypt.pem').read().split(' ')[0]:
-        print ('CHECKSUM did not match - check /media/transferdata/encrypt.pem')
-        continue
-    
-    ledoff()
-    
-    for db in DBs:
-        dname = db.rsplit('/',1)[-1]
-        print('Transferring',dname)
-        start = time.time()
-        mod = os.popen('date -r '+db+' "+%Y_%m_%d_%H%M"').read()
-             
-        cmd = 'cp -n %s /media/transferdata/'%(db,SERIAL[:16],mod,dname)
-        os.system(cmd)# -n for no clobber
-        #try csv
-        cmd = 'cp -n %s /media/transferdata/%s_%s_%s'%('/root/simplesensor.csv',SERIAL[:16],mod,dname)
-        os.system(cmd)# -n for no clobber
-        print(cmd)
-        
-        cmd = 'cp /root/simplesensor.csv /media/transferdata/simplesensor.csv'
-        os.system(cmd)# -n for no clobber
-        print(cmd)
-   
-        print('%d bytes - %.0e seconds'%(os.path.getsize(db),(time.time()-start)/60))
- 
-        
-
-    os.system('sudo umount /media')
-
-    
-ledon()
-print('--end--')
+APPROVED = '/root/BBSensor/usb/approved.dev'
+
+
+def sha1(path):
+    h = hashlib.sha1()
+    with open(path,'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def loadjson(path, default):
+    try:
+        with open(path,'r') as f:
+            return json.load(f)
+    except (IOError,OSError,ValueError):
+        return default
+
+
+def savejson(path, data):
+    with open(path+'.tmp','w') as f:
+        json.dump(data,f,indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path+'.tmp',path)
+
+
+########################################################
+## Snapshot
+########################################################
+
+def fingerprint(conn, rowid):
+    ''' sha256 of a MEASUREMENTS row, or None if there is no such row '''
+    row = conn.execute('SELECT * FROM MEASUREMENTS WHERE rowid = ?',(rowid,)).fetchone()
+    return None if row is None else hashlib.sha256(repr(row).encode('utf-8')).hexdigest()
+
+
+def resume_after(conn, mark):
+    '''
+    The rowid to export after, given the mark {'rowid','row'} of the last
+    export: 0 (everything) if the table is not the one the mark was made on.
+    '''
+    if not isinstance(mark, dict): return 0 # none yet, or an old bare rowid
+    since = mark['rowid']
+    row = fingerprint(conn, since)
+    if row is not None:
+        return since if row == mark['row'] else 0
+    # the marked row was deleted: by rollover if later rows remain, by a rebuild if not
+    hi, = conn.execute('SELECT max(rowid) FROM MEASUREMENTS').fetchone()
+    return since if hi is not None and hi > since else 0
+
+
+def snapshot(db, mark, spool):
+    '''
+    Online backup of db into the spool, trimmed to the rows after the
+    export mark (see resume_after). Returns the snapshot metadata, or None when
+    there is nothing new.
+    '''
+    dname = db.rsplit('/',1)[-1]
+    out = os.path.join(spool, dname)
+    if os.path.exists(out): os.remove(out)
+
+    src = sqlite3.connect('file:%s?mode=ro'%db, uri=True)
+    snap = sqlite3.connect(out)
+    src.backup(snap, pages=1024)
+    src.close()
+
+    try:
+        since = resume_after(snap, mark)
+        lo,hi = snap.execute('SELECT min(rowid),max(rowid) FROM MEASUREMENTS WHERE rowid > ?',(since,)).fetchone()
+    except sqlite3.OperationalError:
+        hi = None
+    if hi is None:
+        snap.close(); os.remove(out)
+        return None
+    last = fingerprint(snap, hi)
+    snap.execute('DELETE FROM MEASUREMENTS WHERE rowid <= ?',(since,))
+    snap.commit()
+    rows, = snap.execute('SELECT count(*) FROM MEASUREMENTS').fetchone()
+    snap.execute('VACUUM')
+    snap.close()
+
+    mod = time.strftime('%Y_%m_%d_%H%M', time.localtime(os.path.getmtime(db)))
+    meta = {'source':db, 'snapshot':out, 'file':'%s_%s_%d-%d_%s'%(SERIAL[:16],mod,lo,hi,dname),
+            'rows':rows, 'first_rowid':lo, 'last_rowid':hi, 'last_row':last}
+    savejson(out+'.json', meta)
+    return meta
+
+
+def snapshot_csv(csv, spool):
+    ''' a copy of the csv (which the sampler appends to) in the spool, as snapshot() '''
+    out = os.path.join(spool, os.path.basename(csv))
+    shutil.copyfile(csv, out)
+    with open(out,'rb') as f:
+        rows = max(sum(1 for line in f) - 1, 0)
+    mod = time.strftime('%Y_%m_%d_%H%M', time.localtime(os.path.getmtime(csv)))
+    meta = {'source':csv, 'snapshot':out, 'file':'%s_%s_%s'%(SERIAL[:16],mod,os.path.basename(csv)), 'rows':rows}
+    savejson(out+'.json', meta)
+    return meta
+
+
+########################################################
+## Copy
+########################################################
+
+def copy(src, dest):
+    '''
+    Chunked copy with an inline sha256. An existing dest+'.part' is checked
+    against src and the copy resumes after the matching prefix.
+    Returns (sha256, bytes written this time).
+    '''
+    part = dest+'.part'
+    h = hashlib.sha256()
+    done = 0
+    with open(src,'rb') as fin:
+        if os.path.exists(part):
+            with open(part,'rb') as fpart:
+                while True:
+                    a = fin.read(CHUNK)
+                    b = fpart.read(len(a))
+                    if not a or a != b: break
+                    h.update(a)
+                    done += len(a)
+            print('resuming %s at %d bytes'%(dest,done))
+            fin.seek(done)
+        with open(part,'ab' if done else 'wb') as fout:
+            fout.truncate(done)
+            written = 0
+            for chunk in iter(lambda: fin.read(CHUNK), b''):
+                h.update(chunk)
+                fout.write(chunk)
+                written += len(chunk)
+            fout.flush()
+            os.fsync(fout.fileno())
+    os.rename(part,dest)
+    return h.hexdigest(), written
+
+
+def verify(path, digest):
+    ''' read back from the stick, not the page cache '''
+    h = hashlib.sha256()
+    with open(path,'rb') as f:
+        os.posix_fadvise(f.fileno(),0,0,os.POSIX_FADV_DONTNEED)
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest() == digest
+
+
+def transfer(meta, manifest):
+    dest = os.path.join(DEST, meta['file'])
+    print('Transferring', meta['file'], '%(rows)d rows'%meta)
+    start = time.time()
+    digest, written = copy(meta['snapshot'], dest)
+    seconds = time.time()-start
+    if not verify(dest, digest):
+        print('VERIFY FAILED for %s - removing'%dest)
+        os.remove(dest)
+        return False
+
+    size = os.path.getsize(dest)
+    entry = dict(meta, sha256=digest, bytes=size, serial=SERIAL[:16],
+                 exported=time.strftime('%Y-%m-%d %H:%M:%S'), seconds=round(seconds,2),
+                 MBps=round(written/1e6/max(seconds,1e-6),2))
+    entry.pop('snapshot')
+    manifest.append(entry)
+    savejson(os.path.join(DEST,'manifest.json'), manifest)
+    print('%d bytes - %.1f s - %.2f MB/s'%(size,seconds,entry['MBps']))
+    return True
+
+
+########################################################
+## Run
+########################################################
+
+def export(db, mark, spool, manifest):
+    '''
+    Snapshot and transfer one database, finishing a snapshot left by an
+    interrupted transfer first. Returns the new export mark, or the old
+    one if nothing was copied.
+    '''
+    dname = db.rsplit('/',1)[-1]
+    meta = loadjson(os.path.join(spool,dname+'.json'), None)
+    if meta is None or not os.path.exists(meta['snapshot']):
+        meta = snapshot(db, mark, spool)
+    if meta is None:
+        print('Nothing new in', dname)
+        return mark
+    if not transfer(meta, manifest):
+        return mark
+    os.remove(meta['snapshot'])
+    os.remove(meta['snapshot']+'.json')
+    return {'rowid':meta['last_rowid'], 'row':meta.get('last_row')}
+
+
+def main():
+    os.system('echo none | sudo tee /sys/class/leds/led0/trigger')
+    uuids = [l.strip() for l in open(APPROVED,'r')]
+
+    # wait for usb to fully load
+    time.sleep(10)
+
+    usbs = []
+
+    for u in os.popen('sudo blkid').readlines():
+        loc = [u.split(':')[0]]
+        if '/dev/sd' not in loc[0]: continue
+        loc+=re.findall(r'"[^"]+"',u)
+        columns = ['loc']+re.findall(r'\b(\w+)=',u)
+
+        usbs.append(dict(zip(columns,loc)))
+
+
+    state = loadjson(STATE, {})
+
+    for u in usbs:
+
+        print ('Connecting to %(LABEL)s'%u)
+
+        os.system('sudo umount /media')
+        os.system('sudo mount %(loc)s /media'%u)
+
+        if u['UUID'] not in uuids:
+            print('UUID not allowed: %(UUID)s - %(LABEL)s'%u)
+            continue
+        if not os.path.exists(DEST):
+            print('FAILED on %(LABEL)s'%u)
+            continue
+        if checksum != sha1(os.path.join(DEST,'encrypt.pem')):
+            print ('CHECKSUM did not match - check /media/transferdata/encrypt.pem')
+            continue
+
+        ledoff()
+
+        uuid = u['UUID'].strip('"')
+        spool = os.path.join(SPOOL, uuid)
+        if not os.path.exists(spool): os.makedirs(spool)
+        manifest = loadjson(os.path.join(DEST,'manifest.json'), [])
+        done = state.setdefault(uuid, {})
+
+        for db in DBs:
+            dname = db.rsplit('/',1)[-1]
+            mark = export(db, done.get(dname), spool, manifest)
+            if mark != done.get(dname):
+                done[dname] = mark
+                savejson(STATE, state)
+
+        if os.path.exists(CSV):
+            meta = snapshot_csv(CSV, spool)
+            if transfer(meta, manifest):
+                os.remove(meta['snapshot'])
+                os.remove(meta['snapshot']+'.json')
+
+        os.system('sync')
+        os.system('sudo umount /media')
+
+
+    ledon()
+    print('--end--')
+
+
+if __name__ == '__main__':
+    main()